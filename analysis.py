@@ -1,7 +1,7 @@
 import numpy as np
 
 from one_slack_ssvm import OneSlackSSVM
-from latent_structured_svm import LatentSSVM
+from latent_structured_svm import LatentSSVM, weighted_score, mean_loss
 from heterogenous_crf import HCRF
 
 from test_weak_labeled import load_msrc
@@ -123,12 +123,17 @@ def compute_score_per_iter(result, score_types=['raw']):
     clf.w_history_ = result.data['w_history']
     clf.iter_done = clf.w_history_.shape[0]
 
+    # 'train' and 'raw' share the predictions on Xtrain
+    train_cache = {}
     if 'train' in score_types:
-        result.data['train_scores'] = np.array([s for s in clf.staged_score(Xtrain, Ytrain_full)])
+        result.data['train_scores'] = clf.staged_evaluate(
+            Xtrain, [(weighted_score, Ytrain_full)], train_cache)[:, 0]
     if 'test' in score_types:
-        result.data['test_scores'] = np.array([s for s in clf.staged_score(Xtest, Ytest)])
+        result.data['test_scores'] = clf.staged_evaluate(
+            Xtest, [(weighted_score, Ytest)])[:, 0]
     if 'raw' in score_types:
-        result.data['raw_scores'] = np.array([s for s in clf.staged_score2(Xtrain, Ytrain)])
+        result.data['raw_scores'] = clf.staged_evaluate(
+            Xtrain, [(mean_loss, Ytrain)], train_cache)[:, 0]
 
     result.update_data()
 
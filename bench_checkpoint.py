@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from time import time
+
+from bench_graph_utils import superpixel_graph
+from heterogenous_crf import HCRF
+from label import Label
+from latent_structured_svm import LatentSSVM
+from one_slack_ssvm import OneSlackSSVM
+
+# checks that a LatentSSVM resumed from its checkpoint continues exactly
+# like an uninterrupted fit
+
+
+def random_problem(n_samples=24, n_nodes=20, n_states=4, n_features=6,
+                   random_state=0):
+    # every third sample is fully labeled, the others only know their
+    # classes
+    rnd = np.random.RandomState(random_state)
+    X, Y = [], []
+    for i in xrange(n_samples):
+        edges = superpixel_graph(n_nodes, i).astype(np.int32)
+        full = rnd.randint(0, n_states, n_nodes)
+        features = (rnd.randn(n_nodes, n_features)
+                    + 1.5 * np.eye(n_states, n_features)[full])
+        edge_features = np.c_[np.ones(edges.shape[0]),
+                              rnd.rand(edges.shape[0])]
+        X.append((features, edges, edge_features))
+        weights = np.ones(n_nodes) / n_nodes
+        if i % 3 == 0:
+            Y.append(Label(full.astype(np.int32), None, weights, True))
+        else:
+            Y.append(Label(None, np.unique(full).astype(np.int32), weights,
+                           False))
+    return X, Y
+
+
+def latent_ssvm(latent_iter, checkpoint=None):
+    model = HCRF(4, 6, 2, inference_method='gco', n_iter=5, alpha=0.5)
+    base_ssvm = OneSlackSSVM(model, max_iter=500, C=0.1, tol=1e-3,
+                             inactive_window=10, inference_cache=2)
+    return LatentSSVM(base_ssvm, latent_iter=latent_iter, tol=-1,
+                      checkpoint=checkpoint)
+
+
+def check_resume(n_iter=2, latent_iter=4, warm_start='rescore'):
+    X, Y = random_problem()
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'checkpoint.h5')
+        uninterrupted = latent_ssvm(latent_iter)
+        uninterrupted.fit(X, Y, warm_start=warm_start)
+
+        interrupted = latent_ssvm(n_iter, filename)
+        interrupted.fit(X, Y, warm_start=warm_start)
+        resumed = latent_ssvm(latent_iter, filename)
+        start = time()
+        resumed.resume(X, Y)
+        resume_time = time() - start
+    finally:
+        shutil.rmtree(directory)
+
+    assert len(interrupted.w_history_) < len(uninterrupted.w_history_)
+    assert np.array_equal(resumed.w_history_, uninterrupted.w_history_)
+    assert np.array_equal(resumed.objective_curve_,
+                          uninterrupted.objective_curve_)
+    # timestamps_ continue from the saved time
+    n_saved = len(interrupted.timestamps_)
+    assert np.array_equal(resumed.timestamps_[:n_saved],
+                          interrupted.timestamps_)
+    assert np.all(np.diff(resumed.timestamps_) >= 0)
+    print ('warm_start={}: resumed after {} of {} iterations in {:.2f}s, '
+           'same w_history_ and objective_curve_'.format(
+               warm_start, n_saved - 1, len(resumed.w_history_) - 1,
+               resume_time))
+
+
+if __name__ == '__main__':
+    check_resume(warm_start=False)
+    check_resume(warm_start='rescore')
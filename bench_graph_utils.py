@@ -0,0 +1,97 @@
+import numpy as np
+
+from time import time
+from scipy.spatial import Delaunay
+
+from graph_utils import monotonic_chains, split_chains
+
+# benchmark of the chain decomposition on graphs of the size of MSRC
+# superpixel graphs
+
+
+def monotonic_chains_lists(n_nodes, edges):
+    # previous implementation, kept as a reference
+    used_edges = set()
+    incidence = [[] for i in xrange(n_nodes)]
+    chains = []
+
+    for i, j in edges:
+        assert i < j
+        incidence[i].append(j)
+
+    start_node = 0
+    k = 0
+    chains.append([])
+
+    while start_node < n_nodes:
+        i = start_node
+        flag1 = False
+        while True:
+            flag2 = False
+            for j in incidence[i]:
+                if (i, j) not in used_edges:
+                    chains[k].append(i)
+                    used_edges.add((i, j))
+                    i = j
+                    flag1 = True
+                    flag2 = True
+                    break
+            if not flag2 and flag1:
+                chains[k].append(i)
+                break
+            if not flag2:
+                break
+        if not flag1:
+            start_node += 1
+        else:
+            chains.append([])
+            k += 1
+
+    return [np.array(chain, dtype=np.int32) for chain in chains[:-1]]
+
+
+def superpixel_graph(n_nodes, random_state=0):
+    # Delaunay triangulation of random points, edges sorted as i < j
+    rnd = np.random.RandomState(random_state)
+    points = rnd.rand(n_nodes, 2)
+    simplices = Delaunay(points).simplices
+    edges = np.vstack([simplices[:, [0, 1]], simplices[:, [1, 2]],
+                       simplices[:, [0, 2]]])
+    edges = np.sort(edges, axis=1)
+    edges = np.unique(edges[:, 0] * n_nodes + edges[:, 1])
+    edges = np.c_[edges // n_nodes, edges % n_nodes]
+    return edges[rnd.permutation(edges.shape[0])]
+
+
+def check_monotonic_chains(n_nodes, edges):
+    nodes, chain_ptr = monotonic_chains(n_nodes, edges)
+    chains = split_chains(nodes, chain_ptr)
+    expected = monotonic_chains_lists(n_nodes, edges)
+
+    assert len(chains) == len(expected)
+    for chain, chain_expected in zip(chains, expected):
+        assert np.all(chain == chain_expected)
+    assert chain_ptr[-1] - (chain_ptr.shape[0] - 1) == edges.shape[0]
+
+
+def bench_monotonic_chains(sizes=(500, 1000, 5000, 20000), repeat=3):
+    for n_nodes in sizes:
+        edges = superpixel_graph(n_nodes)
+        check_monotonic_chains(n_nodes, edges)
+
+        timings = []
+        for f in [monotonic_chains_lists, monotonic_chains]:
+            start = time()
+            for r in xrange(repeat):
+                f(n_nodes, edges)
+            timings.append((time() - start) / repeat)
+
+        print 'n_nodes={} n_edges={}: lists {:.4f}s, csr {:.4f}s ({:.1f}x)'.format(
+            n_nodes, edges.shape[0], timings[0], timings[1],
+            timings[0] / timings[1])
+
+
+if __name__ == '__main__':
+    check_monotonic_chains(0, np.zeros((0, 2), dtype=np.int32))
+    check_monotonic_chains(3, np.array([[0, 1], [1, 2], [0, 2]]))
+    bench_monotonic_chains()
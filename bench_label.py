@@ -0,0 +1,73 @@
+import numpy as np
+
+from time import time
+
+from heterogenous_crf import HCRF
+from label import Label, LabelBatch
+
+# benchmark and equivalence checks of LabelBatch against the per sample
+# loops over Label objects it replaces
+
+
+def random_labels(n_samples, n_states=24, random_state=0):
+    # MSRC like: a few hundred to a thousand superpixels, up to 6 classes
+    rnd = np.random.RandomState(random_state)
+    Y, Y_hat = [], []
+    for i in xrange(n_samples):
+        n_nodes = rnd.randint(1, 1000)
+        weak = np.sort(rnd.choice(n_states, rnd.randint(1, 7),
+                                  replace=False)).astype(np.int32)
+        full = rnd.choice(weak, n_nodes).astype(np.int32)
+        weights = rnd.rand(n_nodes)
+        full_labeled = rnd.rand() < 0.3
+        Y.append(Label(full, weak, weights, full_labeled))
+        changed = full.copy()
+        if rnd.rand() < 0.5:
+            changed[rnd.randint(n_nodes)] = rnd.choice(weak)
+        Y_hat.append(Label(changed, weak, weights, full_labeled))
+    return Y, Y_hat
+
+
+def check_label_batch(n_samples=200):
+    Y, Y_hat = random_labels(n_samples)
+    batch = LabelBatch.from_labels(Y)
+    for y, view in zip(Y, batch):
+        assert np.all(view.full == y.full)
+        assert np.all(view.weak == y.weak)
+        assert np.all(view.weights == y.weights)
+        assert view.full_labeled == y.full_labeled
+
+    changes = [np.any(y_new.full != y.full) for y_new, y in zip(Y_hat, Y)]
+    assert np.all(LabelBatch.from_labels(Y_hat).changed(batch) == changes)
+
+    model = HCRF(24, 1, 1, alpha=0.5)
+    losses = [model.loss(y, y_hat) for y, y_hat in zip(Y, Y_hat)]
+    assert np.allclose(model.batch_loss(Y, Y_hat), losses, rtol=1e-12,
+                       atol=1e-12)
+
+
+def bench_label_batch(n_samples=2000, repeat=3):
+    Y, Y_hat = random_labels(n_samples)
+    model = HCRF(24, 1, 1, alpha=0.5)
+    # LatentSSVM keeps the batch of the previous completion
+    batch = LabelBatch.from_labels(Y)
+    timings = []
+    for f in [lambda: [np.any(y_new.full != y.full)
+                       for y_new, y in zip(Y_hat, Y)],
+              lambda: LabelBatch.from_labels(Y_hat).changed(batch),
+              lambda: [model.loss(y, y_hat) for y, y_hat in zip(Y, Y_hat)],
+              lambda: model.batch_loss(Y, Y_hat)]:
+        start = time()
+        for r in xrange(repeat):
+            f()
+        timings.append((time() - start) / repeat)
+
+    print ('n_samples={}: changes {:.4f}s, batch {:.4f}s ({:.1f}x); '
+           'losses {:.4f}s, batch {:.4f}s ({:.1f}x)'.format(
+               n_samples, timings[0], timings[1], timings[0] / timings[1],
+               timings[2], timings[3], timings[2] / timings[3]))
+
+
+if __name__ == '__main__':
+    check_label_batch()
+    bench_label_batch()
@@ -0,0 +1,404 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import cvxopt
+import cvxopt.solvers
+
+from time import time
+
+from bench_graph_utils import superpixel_graph
+from heterogenous_crf import HCRF
+from label import Label
+from latent_structured_svm import LatentSSVM, mean_loss, weighted_score
+from one_slack_ssvm import (ConstraintStore, InferenceCache, OneSlackSSVM,
+                            SimplexQP, _fingerprint)
+from pystruct.models import MultiClassClf
+
+# benchmark of the warm started active set solver against cvxopt on
+# sequences of 1-slack QPs as produced by the cutting plane method
+
+
+def solve_cvxopt(P, losses, C):
+    # the QP as _solve_qp_cvxopt sets it up, without negativity constraints
+    n = losses.shape[0]
+    cvxopt.solvers.options['show_progress'] = False
+    cvxopt.solvers.options['feastol'] = 1e-5
+    solution = cvxopt.solvers.qp(cvxopt.matrix(P), cvxopt.matrix(-losses),
+                                 cvxopt.spmatrix(-1.0, range(n), range(n)),
+                                 cvxopt.matrix(np.zeros(n)),
+                                 cvxopt.matrix(1.0, (1, n)),
+                                 cvxopt.matrix(float(C)))
+    return np.ravel(solution['x']), solution['primal objective']
+
+
+def most_violated_plane(w, rnd, pool_size=50):
+    # the most violated of a pool of random cutting planes
+    pool = (0.1 * rnd.randn(pool_size, w.shape[0])
+            + 0.05 * rnd.randn(w.shape[0]))
+    losses = np.abs(rnd.randn(pool_size)) + 1
+    best = np.argmax(losses - np.dot(pool, w))
+    return pool[best], losses[best]
+
+
+def check_simplex_qp(n_problems=300):
+    # cold starts on random, often singular problems of all scales
+    for i in xrange(n_problems):
+        rnd = np.random.RandomState(i)
+        n = rnd.randint(1, 80)
+        J = rnd.randn(n, rnd.randint(1, 60)) * rnd.choice([1e-3, 1, 100])
+        if i % 3 == 0:
+            # duplicate constraints
+            J[rnd.randint(n, size=n // 2)] = J[0]
+        if i % 5 == 0:
+            J[0] = 0
+        P = np.dot(J, J.T)
+        losses = np.abs(rnd.randn(n)) * rnd.choice([1e-3, 1, 10])
+        C = rnd.choice([0.1, 1., 100.])
+
+        alpha, objective, converged = SimplexQP().solve(P, losses, C)
+        assert np.all(alpha >= 0)
+        assert abs(np.sum(alpha) - C) < 1e-9 * C
+        if converged:
+            objective_cvxopt = solve_cvxopt(P, losses, C)[1]
+            assert (objective - objective_cvxopt
+                    < 1e-6 * max(1, abs(objective)))
+
+
+def bench_simplex_qp(size_joint_feature=1000, n_planes=300, C=20.,
+                     inactive_window=20):
+    rnd = np.random.RandomState(0)
+    qp = SimplexQP()
+    w = np.zeros(size_joint_feature)
+    J = np.zeros((0, size_joint_feature))
+    losses = np.zeros(0)
+    alphas = []
+    timings = [0, 0]
+
+    for i in xrange(n_planes):
+        joint_feature, loss = most_violated_plane(w, rnd)
+        J = np.vstack([J, joint_feature])
+        losses = np.hstack([losses, loss])
+        alphas.append([])
+        P = np.dot(J, J.T)
+
+        start = time()
+        alpha, objective, converged = qp.solve(P, losses, C)
+        timings[0] += time() - start
+        start = time()
+        objective_cvxopt = solve_cvxopt(P, losses, C)[1]
+        timings[1] += time() - start
+        assert converged
+        assert objective - objective_cvxopt < 1e-6 * max(1, abs(objective))
+        w = np.dot(alpha, J)
+
+        # prune as OneSlackSSVM does
+        for history, a in zip(alphas, alpha):
+            history.append(a)
+        inactive = [j for j, history in enumerate(alphas)
+                    if max(history[-inactive_window:]) < 1e-5 * C]
+        qp.delete(inactive)
+        J = np.delete(J, inactive, axis=0)
+        losses = np.delete(losses, inactive)
+        alphas = [history for history in alphas
+                  if max(history[-inactive_window:]) >= 1e-5 * C]
+
+    print ('size_joint_feature={} constraints={} support={}: cvxopt {:.3f}s, '
+           'active set {:.3f}s ({:.1f}x)'.format(
+               size_joint_feature, losses.shape[0], np.sum(alpha > 0),
+               timings[1], timings[0], timings[1] / timings[0]))
+
+
+def store_nbytes(store):
+    if store.sparse:
+        matrix = store.joint_features
+        return (matrix.data.nbytes + matrix.indices.nbytes
+                + matrix.indptr.nbytes)
+    return store.joint_features.nbytes
+
+
+def check_constraint_store(size_joint_feature=2000, n_planes=150, C=20.,
+                           density=0.1, rtol=1e-5):
+    # cutting plane runs with float32 and sparse stores against float64;
+    # the planes are sparse like the unary part with sparse features
+    rnd = np.random.RandomState(0)
+    planes = []
+    w = np.zeros(size_joint_feature)
+    for i in xrange(n_planes):
+        joint_feature, loss = most_violated_plane(w, rnd)
+        joint_feature[rnd.rand(size_joint_feature) > density] = 0
+        planes.append((joint_feature, loss))
+        w = 0.01 * np.sum([p[0] for p in planes], axis=0)
+
+    configurations = [(np.float64, False), (np.float32, False),
+                      (np.float64, True), (np.float32, True)]
+    results = {}
+    for dtype, sparse in configurations:
+        store = ConstraintStore(size_joint_feature, dtype=dtype,
+                                sparse=sparse)
+        qp = SimplexQP()
+        objectives = []
+        for joint_feature, loss in planes:
+            store.append((joint_feature, loss))
+            assert (joint_feature, loss) in store
+            alpha, objective, converged = qp.solve(store.gram, store.losses,
+                                                   C)
+            assert converged
+            objectives.append(objective)
+            w = store.combine(alpha)
+            gram = np.dot(store.dense(), store.dense().T)
+            assert np.allclose(store.gram, gram, rtol=1e-12, atol=1e-12)
+            assert np.allclose(store.dot(w), np.dot(store.dense(), w))
+        results[dtype, sparse] = np.array(objectives), w, store_nbytes(store)
+
+        # moving the planes to another ground truth keeps the first one
+        offset = 0.01 * rnd.randn(size_joint_feature)
+        expected = store.dense()
+        expected[1:] += offset
+        store.shift(offset)
+        assert np.allclose(store.dense(), expected, atol=1e-6)
+        assert np.all(store.dense()[0] == expected[0])
+        gram = np.dot(store.dense(), store.dense().T)
+        assert np.allclose(store.gram, gram, rtol=1e-12, atol=1e-12)
+        assert np.all(store.gram == store.gram.T)
+        assert (store[1][0], store.losses[1]) in store
+
+    objectives, w, nbytes = results[np.float64, False]
+    for dtype, sparse in configurations[1:]:
+        objectives_, w_, nbytes_ = results[dtype, sparse]
+        assert np.allclose(objectives_, objectives, rtol=rtol)
+        assert np.allclose(w_, w, rtol=rtol, atol=rtol * np.abs(w).max())
+        print ('dtype={} sparse={}: {:.0f}% memory, max objective '
+               'difference {:.1e}'.format(
+                   np.dtype(dtype).name, sparse, 100. * nbytes_ / nbytes,
+                   np.max(np.abs(objectives_ - objectives)
+                          / np.abs(objectives))))
+
+
+class ListInferenceCache(object):
+    # previous inference cache of OneSlackSSVM, kept as a reference: a list
+    # of (joint_feature, loss, y_hat) per sample, the oldest evicted first
+    def __init__(self, n_samples, cache_size):
+        self.cache_size = cache_size
+        self.cached = [[] for i in xrange(n_samples)]
+
+    def add(self, sample, joint_feature, loss, y):
+        cached = self.cached[sample]
+        if np.any([y == entry[2] for entry in cached]):
+            return
+        if len(cached) == self.cache_size:
+            cached.pop(0)
+        cached.append((joint_feature, loss, y))
+
+    def most_violated(self, w):
+        Y_hat = []
+        joint_feature_acc = 0
+        loss_acc = 0
+        for cached in self.cached:
+            violations = [np.dot(joint_feature, w) + loss
+                          for joint_feature, loss, _ in cached]
+            joint_feature, loss, y_hat = cached[np.argmax(violations)]
+            Y_hat.append(y_hat)
+            joint_feature_acc += joint_feature
+            loss_acc += loss
+        return Y_hat, joint_feature_acc, loss_acc
+
+
+def check_inference_cache(n_samples=30, size_joint_feature=20, cache_size=3,
+                          n_labelings=6, n_iter=40):
+    # labelings are drawn from a small pool per sample, so many are cached
+    # already; small integer joint features and losses produce ties
+    rnd = np.random.RandomState(0)
+    pool = [[Label(rnd.randint(0, 3, size=5), None, np.ones(5), True)
+             for j in xrange(n_labelings)] for i in xrange(n_samples)]
+    joint_features = rnd.randint(-2, 3, size=(n_samples, n_labelings,
+                                              size_joint_feature))
+    losses = rnd.randint(0, 3, size=(n_samples, n_labelings))
+
+    directory = tempfile.mkdtemp()
+    try:
+        caches = [InferenceCache(n_samples, size_joint_feature, cache_size),
+                  InferenceCache(n_samples, size_joint_feature, cache_size,
+                                 dtype=np.float32),
+                  InferenceCache(n_samples, size_joint_feature, cache_size,
+                                 filename=os.path.join(directory, 'cache'))]
+        reference = ListInferenceCache(n_samples, cache_size)
+        for iteration in xrange(n_iter):
+            for sample in xrange(n_samples):
+                j = rnd.randint(n_labelings)
+                # a copy, labelings are recognized by value
+                y = Label(pool[sample][j].full.copy(), None, np.ones(5),
+                          True)
+                reference.add(sample, joint_features[sample, j],
+                              losses[sample, j], y)
+                for cache in caches:
+                    if (sample, y) not in cache:
+                        cache.add(sample, joint_features[sample, j],
+                                  losses[sample, j], y)
+            w = rnd.randint(-2, 3, size=size_joint_feature)
+            Y_ref, joint_feature_ref, loss_ref = reference.most_violated(w)
+            for cache in caches:
+                Y_hat, joint_feature, loss = cache.most_violated(w)
+                assert all(y_hat is y_ref
+                           for y_hat, y_ref in zip(Y_hat, Y_ref))
+                assert np.all(joint_feature == joint_feature_ref)
+                assert loss == loss_ref
+        del caches
+    finally:
+        shutil.rmtree(directory)
+
+
+def random_crf_problem(n_samples=40, n_nodes=60, n_states=4, n_features=6,
+                       random_state=0):
+    # fully labeled superpixel graphs with noisy one hot node features
+    rnd = np.random.RandomState(random_state)
+    X, Y = [], []
+    for i in xrange(n_samples):
+        edges = superpixel_graph(n_nodes, i).astype(np.int32)
+        full = rnd.randint(0, n_states, n_nodes)
+        features = (rnd.randn(n_nodes, n_features)
+                    + 1.5 * np.eye(n_states, n_features)[full])
+        edge_features = np.c_[np.ones(edges.shape[0]),
+                              rnd.rand(edges.shape[0])]
+        X.append((features, edges, edge_features))
+        Y.append(Label(full.astype(np.int32), None,
+                       np.ones(n_nodes) / n_nodes, True))
+    return X, Y
+
+
+def check_parallel_inference(n_jobs=(2, 4), max_iter=10):
+    # the worker pool returns the same labelings as serial inference, so
+    # the whole cutting plane run is identical
+    X, Y = random_crf_problem()
+    results = []
+    for jobs in (1,) + n_jobs:
+        model = HCRF(4, 6, 2, inference_method='ad3', n_iter=100)
+        ssvm = OneSlackSSVM(model, max_iter=max_iter, C=1, tol=1e-4,
+                            n_jobs=jobs)
+        start = time()
+        ssvm.fit(X, Y)
+        results.append(ssvm)
+        print 'n_jobs={}: fit {:.2f}s, inference {:.2f}s'.format(
+            jobs, time() - start, ssvm.inference_time)
+
+    serial = results[0]
+    for ssvm in results[1:]:
+        assert np.array_equal(ssvm.w, serial.w)
+        assert np.array_equal(ssvm.objective_curve_, serial.objective_curve_)
+        assert np.array_equal(ssvm.constraints_.dense(),
+                              serial.constraints_.dense())
+
+
+def check_staged_evaluate(n_stages=6, n_jobs=1):
+    # scores of all stages from one staged_evaluate against predicting
+    # with base_ssvm once per stage and per score, as staged_score and
+    # staged_score2 did; every other sample of Y is weakly labeled
+    X, Y_full = random_crf_problem()
+    Y = [y if i % 2 else Label(None, np.unique(y.full).astype(np.int32),
+                               y.weights, False)
+         for i, y in enumerate(Y_full)]
+    model = HCRF(4, 6, 2, inference_method='ad3', n_iter=100, alpha=0.5)
+    model.initialize(X, Y)
+    clf = LatentSSVM(OneSlackSSVM(model), n_jobs=n_jobs)
+    rnd = np.random.RandomState(0)
+    clf.w_history_ = rnd.randn(n_stages, model.size_joint_feature)
+    clf.iter_done = n_stages
+
+    start = time()
+    expected = []
+    for w in clf.w_history_:
+        clf.base_ssvm.w = w
+        Y_pred = clf.base_ssvm.predict(X)
+        score = 1. - np.sum([model.loss(y, y_pred) / float(np.sum(y.weights))
+                             for y, y_pred in zip(Y_full, Y_pred)]) / len(X)
+        Y_pred = clf.base_ssvm.predict(X)
+        loss = np.mean([model.loss(y, y_pred)
+                        for y, y_pred in zip(Y, Y_pred)])
+        expected.append((score, loss))
+    loop_time = time() - start
+    expected = np.array(expected)
+
+    cache = {}
+    start = time()
+    scores = clf.staged_evaluate(X, [(weighted_score, Y_full),
+                                     (mean_loss, Y)], cache)
+    staged_time = time() - start
+    assert np.allclose(scores, expected, rtol=1e-12, atol=1e-12)
+    assert np.allclose(list(clf.staged_score(X, Y_full)), expected[:, 0],
+                       rtol=1e-12, atol=1e-12)
+    assert np.allclose(list(clf.staged_score2(X, Y)), expected[:, 1],
+                       rtol=1e-12, atol=1e-12)
+
+    # all predictions are cached, a second metric runs no inference
+    assert len(cache) == n_stages * len(X)
+    calls = model.inference_calls
+    losses = clf.staged_evaluate(X, [(mean_loss, Y)], cache)
+    assert model.inference_calls == calls
+    assert np.allclose(losses[:, 0], expected[:, 1], rtol=1e-12, atol=1e-12)
+    print ('n_stages={}: per stage loop {:.2f}s, staged_evaluate {:.2f}s '
+           '({:.1f}x)'.format(n_stages, loop_time, staged_time,
+                              loop_time / staged_time))
+
+
+class RecordingSSVM(OneSlackSSVM):
+    # remembers the labelings of every cutting plane and checks rescored
+    # planes against the planes of these labelings for the new ground truth
+    def fit(self, X, Y, **kwargs):
+        self._X, self._Y = X, Y
+        if not hasattr(self, 'labelings_'):
+            self.labelings_ = {}
+        return OneSlackSSVM.fit(self, X, Y, **kwargs)
+
+    def _find_new_constraint(self, X, Y, joint_feature_gt, constraints,
+                             check=True):
+        Y_hat, djoint_feature, loss = OneSlackSSVM._find_new_constraint(
+            self, X, Y, joint_feature_gt, constraints, check)
+        self.labelings_[_fingerprint(constraints._stored(djoint_feature),
+                                     loss)] = Y_hat
+        return Y_hat, djoint_feature, loss
+
+    def _rescore_constraints(self, constraints, joint_feature_gt, n_samples):
+        labelings = [self.labelings_.get(fingerprint)
+                     for fingerprint in constraints._fingerprints]
+        losses = constraints.losses.copy()
+        OneSlackSSVM._rescore_constraints(self, constraints, joint_feature_gt,
+                                          n_samples)
+        # the first plane is the ground truth one, zero before and after
+        assert labelings[0] is None
+        assert not np.any(constraints[0][0]) and constraints[0][1] == 0
+        for i, Y_hat in enumerate(labelings[1:], 1):
+            expected = (joint_feature_gt - self.model.batch_joint_feature(
+                self._X, Y_hat)) / n_samples
+            assert np.allclose(constraints[i][0], expected, atol=1e-12)
+            assert constraints[i][1] == losses[i]
+        self.n_rescored_ = len(labelings) - 1
+
+
+def check_rescore(n_samples=200, n_features=10, n_classes=5,
+                  inactive_window=3):
+    # with a small inactive_window pruning removes planes often, rescoring
+    # must still move every plane but the ground truth one
+    rnd = np.random.RandomState(0)
+    Y = rnd.randint(n_classes, size=n_samples)
+    X = rnd.randn(n_samples, n_features) + np.eye(n_classes, n_features)[Y]
+    ssvm = RecordingSSVM(MultiClassClf(n_features, n_classes), C=1.,
+                         tol=1e-4, inactive_window=inactive_window)
+    ssvm.fit(X, Y)
+    # a new ground truth for a tenth of the samples
+    Y_new = Y.copy()
+    changed = rnd.rand(n_samples) < 0.1
+    Y_new[changed] = rnd.randint(n_classes, size=np.sum(changed))
+    ssvm.fit(X, Y_new, warm_start='rescore')
+    print 'rescored {} planes after pruning with inactive_window={}'.format(
+        ssvm.n_rescored_, inactive_window)
+
+
+if __name__ == '__main__':
+    check_simplex_qp()
+    check_constraint_store()
+    check_rescore()
+    check_inference_cache()
+    check_parallel_inference()
+    check_staged_evaluate()
+    bench_simplex_qp(100)
+    bench_simplex_qp(1000)
@@ -0,0 +1,164 @@
+import numpy as np
+import itertools
+
+from time import time
+
+from chain_opt import optimize_chains_fast
+from label import Label
+from trw_utils import optimize_chains, optimize_kappa
+
+# benchmark and equivalence checks of optimize_kappa against the subset
+# enumeration it replaces and of the compiled optimize_chains_fast against
+# optimize_chains
+
+
+def optimize_kappa_bruteforce(y, unaries, alpha, n_nodes, n_states, augment=True):
+    # previous implementation, kept as a reference; subsets that remove
+    # every label are skipped instead of failing in np.max
+    unaries = unaries.copy()
+
+    c = np.sum(y.weights) / float(n_states)
+    c *= alpha
+
+    if augment:
+        for label in xrange(n_states):
+            if label not in y.weak:
+                unaries[:,label] += y.weights * alpha
+
+    max_energy = -np.Inf
+    best_y = None
+    all_labels = set([l for l in xrange(n_states)])
+    gt_labels = set(y.weak)
+
+    for k in xrange(len(y.weak) + 1):
+        for l in itertools.combinations(y.weak, k):
+            labels = list(all_labels - set(l))
+            if not labels:
+                continue
+            l = list(l)
+            t_unaries = unaries.copy()
+            t_unaries[:, l] = -np.Inf
+            y_hat = np.argmax(t_unaries, axis=1)
+            energy = np.sum(np.max(unaries[:,labels], axis=1))
+            present_labels = set(np.unique(y_hat))
+            energy -= c * len(present_labels.intersection(gt_labels))
+            if energy > max_energy:
+                max_energy = energy
+                best_y = y_hat
+
+    return best_y, max_energy
+
+
+def random_problem(n_nodes, n_states, n_weak, integer=False, random_state=0):
+    rnd = np.random.RandomState(random_state)
+    if integer:
+        # small integers produce many ties
+        unaries = rnd.randint(-3, 3, size=(n_nodes, n_states)).astype(np.float64)
+        weights = np.ones(n_nodes)
+    else:
+        unaries = rnd.randn(n_nodes, n_states)
+        weights = rnd.rand(n_nodes)
+    weak = np.sort(rnd.choice(n_states, n_weak, replace=False)).astype(np.int32)
+    y = Label(np.zeros(n_nodes, dtype=np.int32), weak, weights, False)
+    return y, unaries
+
+
+def check_optimize_kappa(y, unaries, alpha, augment):
+    n_nodes, n_states = unaries.shape
+    before = unaries.copy()
+    y_hat, energy = optimize_kappa(y, unaries, alpha, n_nodes, n_states,
+                                   augment=augment)
+    y_ref, energy_ref = optimize_kappa_bruteforce(y, unaries, alpha, n_nodes,
+                                                  n_states, augment=augment)
+
+    assert np.all(unaries == before)
+    assert energy == energy_ref
+    assert np.all(y_hat == y_ref)
+
+
+def check_all(n_problems=200):
+    for i in xrange(n_problems):
+        rnd = np.random.RandomState(i)
+        n_nodes = rnd.randint(1, 50)
+        n_states = rnd.randint(2, 10)
+        n_weak = rnd.randint(0, n_states + 1)
+        y, unaries = random_problem(n_nodes, n_states, n_weak,
+                                    integer=i % 2 == 0, random_state=i)
+        for alpha in [0, 0.5, 1]:
+            for augment in [True, False]:
+                check_optimize_kappa(y, unaries, alpha, augment)
+
+
+def bench_optimize_kappa(n_nodes=1000, n_states=24, weak_sizes=(1, 3, 5, 6),
+                         repeat=3):
+    # MSRC: about a thousand superpixels, 24 classes, up to 6 per image
+    for n_weak in weak_sizes:
+        y, unaries = random_problem(n_nodes, n_states, n_weak)
+        check_optimize_kappa(y, unaries, 1, True)
+
+        timings = []
+        for f in [optimize_kappa_bruteforce, optimize_kappa]:
+            start = time()
+            for r in xrange(repeat):
+                f(y, unaries, 1, n_nodes, n_states)
+            timings.append((time() - start) / repeat)
+
+        print 'n_weak={}: subsets {:.4f}s, incremental {:.4f}s ({:.1f}x)'.format(
+            n_weak, timings[0], timings[1], timings[0] / timings[1])
+
+
+def random_chains(n_chains, n_nodes, n_states, n_edges, integer=False,
+                  random_state=0):
+    rnd = np.random.RandomState(random_state)
+    shape = (n_chains, n_nodes, n_states)
+    if integer:
+        # small integers produce many ties
+        unary_cost = rnd.randint(-3, 3, size=shape).astype(np.float64)
+        pairwise_cost = rnd.randint(-3, 3, size=(n_edges, n_states,
+                                                 n_states)).astype(np.float64)
+    else:
+        unary_cost = rnd.randn(*shape)
+        pairwise_cost = rnd.randn(n_edges, n_states, n_states)
+    edge_ids = rnd.randint(0, n_edges, size=(n_chains, n_nodes - 1))
+    return unary_cost, pairwise_cost, edge_ids
+
+
+def check_optimize_chains(n_problems=400):
+    for i in xrange(n_problems):
+        rnd = np.random.RandomState(i)
+        n_chains = rnd.randint(1, 20)
+        n_nodes = rnd.randint(1, 30)
+        n_states = rnd.randint(1, 8)
+        n_edges = rnd.randint(1, 40)
+        unary_cost, pairwise_cost, edge_ids = random_chains(
+            n_chains, n_nodes, n_states, n_edges, integer=i % 2 == 0,
+            random_state=i)
+        for minimize in [False, True]:
+            x, energy = optimize_chains_fast(unary_cost, pairwise_cost,
+                                             edge_ids, minimize=minimize)
+            x_ref, energy_ref = optimize_chains(unary_cost, pairwise_cost,
+                                                edge_ids, minimize=minimize)
+            assert np.all(x == x_ref)
+            assert np.all(energy == energy_ref)
+
+
+def bench_optimize_chains(n_chains=200, n_nodes=50, n_states=24, repeat=3):
+    # chains of a decomposed MSRC superpixel graph, 24 classes
+    unary_cost, pairwise_cost, edge_ids = random_chains(
+        n_chains, n_nodes, n_states, n_chains * (n_nodes - 1))
+    timings = []
+    for f in [optimize_chains, optimize_chains_fast]:
+        start = time()
+        for r in xrange(repeat):
+            f(unary_cost, pairwise_cost, edge_ids)
+        timings.append((time() - start) / repeat)
+
+    print 'n_chains={}: numpy {:.4f}s, compiled {:.4f}s ({:.1f}x)'.format(
+        n_chains, timings[0], timings[1], timings[0] / timings[1])
+
+
+if __name__ == '__main__':
+    check_all()
+    bench_optimize_kappa()
+    check_optimize_chains()
+    bench_optimize_chains()
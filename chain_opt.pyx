@@ -1,45 +1,131 @@
 # distutils: language = c++
 
 import numpy as np
-cimport numpy as np
 
 cimport cython
 
-from libcpp.map cimport map
-from libcpp.pair cimport pair
-from libcpp.vector cimport vector
 
+cdef inline bint _better(double a, double b, bint minimize) nogil:
+    if minimize:
+        return a < b
+    return a > b
 
-def optimize_chain_fast(
-    np.ndarray[np.int64_t, ndim=1, mode='c'] chain,
-    np.ndarray[np.float64_t, ndim=2, mode='c'] unary_cost,
-    np.ndarray[np.float64_t, ndim=3, mode='c'] pairwise_cost,
-    map[pair[int,int],int] edge_index):
 
-    cdef int n_nodes = chain.shape[0]
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double _viterbi(const double[:, ::1] unary_cost,
+                     const double[:, :, ::1] pairwise_cost,
+                     const int[::1] edge_ids,
+                     double[:, ::1] p,
+                     int[:, ::1] track,
+                     int[::1] x,
+                     bint minimize) nogil:
+    # p and track are (n_nodes, n_states) work buffers owned by the caller;
+    # min/max and argmin/argmax are computed together in a single pass
+    cdef int n_nodes = unary_cost.shape[0]
     cdef int n_states = unary_cost.shape[1]
+    cdef int i, j, k, edge, current
+    cdef double score, prev, best
 
-    cdef np.ndarray[np.float64_t, ndim=2, mode='c'] p = np.zeros((n_states, n_nodes), dtype=np.float64)
-    cdef np.ndarray[np.int32_t, ndim=2, mode='c'] track = np.zeros((n_states, n_nodes), dtype=np.int32)
-
-    p[:,0] = unary_cost[0,:]
-    track[:,0] = -1
-
-    cdef int i, k
-    cdef int edge
+    for k in range(n_states):
+        p[0, k] = unary_cost[0, k]
+        track[0, k] = -1
 
     for i in range(1, n_nodes):
-        p[:,i] = unary_cost[i,:]
-        edge = edge_index[(chain[i - 1], chain[i])]
-        p_cost = pairwise_cost[edge]
+        edge = edge_ids[i - 1]
+        prev = p[i - 1, 0]
+        for k in range(n_states):
+            p[i, k] = prev + pairwise_cost[edge, 0, k]
+            track[i, k] = 0
+        for j in range(1, n_states):
+            prev = p[i - 1, j]
+            for k in range(n_states):
+                score = prev + pairwise_cost[edge, j, k]
+                if _better(score, p[i, k], minimize):
+                    p[i, k] = score
+                    track[i, k] = j
         for k in range(n_states):
-            p[k,i] += np.min(p[:,i - 1] + p_cost[:,k])
-            track[k,i] = np.argmin(p[:,i - 1] + p_cost[:,k])
+            p[i, k] += unary_cost[i, k]
+
+    current = 0
+    best = p[n_nodes - 1, 0]
+    for k in range(1, n_states):
+        if _better(p[n_nodes - 1, k], best, minimize):
+            best = p[n_nodes - 1, k]
+            current = k
 
-    cdef np.ndarray[np.int32_t, ndim=1, mode='c'] x = np.zeros(n_nodes, dtype=np.int32)
-    cdef int current = np.argmin(p[:,n_nodes - 1])
     for i in range(n_nodes - 1, -1, -1):
         x[i] = current
-        current = track[current,i]
+        current = track[i, current]
+
+    return best
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def optimize_chains_fast(unary_cost, pairwise_cost, edge_ids, minimize=False):
+    """Viterbi over a batch of chains of equal length, runs without the GIL.
+
+    Same interface as trw_utils.optimize_chains: unary_cost has shape
+    (n_chains, chain_len, n_states), edge_ids has shape
+    (n_chains, chain_len - 1) and indexes pairwise_cost.
+    """
+    # const views, the chain decomposition hands out read-only arrays
+    cdef const double[:, :, ::1] unary = np.ascontiguousarray(
+        unary_cost, dtype=np.float64)
+    cdef const double[:, :, ::1] pairwise = np.ascontiguousarray(
+        pairwise_cost, dtype=np.float64)
+    edge_ids = np.ascontiguousarray(edge_ids, dtype=np.int32)
+
+    cdef int n_chains = unary.shape[0]
+    cdef int n_nodes = unary.shape[1]
+    cdef int n_states = unary.shape[2]
+    cdef bint _minimize = minimize
+
+    if edge_ids.shape != (n_chains, n_nodes - 1):
+        raise ValueError("Expected edge_ids of shape %s, got %s"
+                         % (repr((n_chains, n_nodes - 1)),
+                            repr(edge_ids.shape)))
+    if edge_ids.size and (edge_ids.min() < 0
+                          or edge_ids.max() >= pairwise.shape[0]):
+        raise ValueError("edge_ids out of range")
+    if n_states and (pairwise.shape[1] != n_states
+                     or pairwise.shape[2] != n_states):
+        raise ValueError("pairwise_cost does not match n_states=%d"
+                         % n_states)
+
+    cdef const int[:, ::1] edges = edge_ids
+
+    x = np.zeros((n_chains, n_nodes), dtype=np.int32)
+    energy = np.zeros(n_chains, dtype=np.float64)
+    cdef int[:, ::1] x_view = x
+    cdef double[::1] energy_view = energy
+
+    cdef double[:, ::1] p = np.zeros((n_nodes, n_states), dtype=np.float64)
+    cdef int[:, ::1] track = np.zeros((n_nodes, n_states), dtype=np.int32)
+
+    cdef int c
+    if n_nodes == 0 or n_states == 0:
+        return x, energy
+
+    with nogil:
+        for c in range(n_chains):
+            energy_view[c] = _viterbi(unary[c], pairwise, edges[c], p, track,
+                                      x_view[c], _minimize)
+
+    return x, energy
+
+
+def optimize_chain_fast(unary_cost, pairwise_cost, edge_ids, minimize=False):
+    """Viterbi over a single chain.
 
-    return x, np.min(p[:,n_nodes - 1])
+    edge_ids[i] is the index in pairwise_cost of the edge between positions
+    i and i + 1 of the chain.
+    """
+    unary_cost = np.asarray(unary_cost)
+    edge_ids = np.asarray(edge_ids)
+    x, energy = optimize_chains_fast(unary_cost[np.newaxis],
+                                     pairwise_cost,
+                                     edge_ids[np.newaxis],
+                                     minimize=minimize)
+    return x[0], energy[0]
@@ -0,0 +1,274 @@
+import cPickle
+import h5py
+import numpy as np
+
+from label import Label, LabelBatch
+from latent_structured_svm import HISTORIES
+from one_slack_ssvm import ConstraintStore, InferenceCache
+
+
+def _append(group, name, values):
+    # writes the rows of values that are not in the dataset yet
+    values = np.asarray(values)
+    if name not in group:
+        group.create_dataset(name, data=values, chunks=True,
+                             maxshape=(None,) + values.shape[1:])
+        return
+    dataset = group[name]
+    n_written = dataset.shape[0]
+    if values.shape[0] > n_written:
+        dataset.resize(values.shape[0], axis=0)
+        dataset[n_written:] = values[n_written:]
+
+
+def _write(group, name, values):
+    # writes values in place, the dataset is only recreated if its shape
+    # or type changed
+    values = np.asarray(values)
+    if name in group:
+        dataset = group[name]
+        if dataset.shape == values.shape and dataset.dtype == values.dtype:
+            if values.size:
+                dataset[...] = values
+            return
+        del group[name]
+    group.create_dataset(name, data=values)
+
+
+def _splice(group, name, values, start, n_axes=1):
+    # values[:start] along the first n_axes axes are in the dataset already,
+    # the rest is written and the dataset resized to values
+    values = np.asarray(values)
+    if name in group and group[name].dtype != values.dtype:
+        del group[name]
+    if name not in group:
+        group.create_dataset(name, data=values, chunks=True,
+                             maxshape=(None,) * n_axes + values.shape[n_axes:])
+        return
+    dataset = group[name]
+    dataset.resize(values.shape)
+    for axis in xrange(n_axes):
+        if values.shape[axis] > start:
+            index = (slice(None, start),) * axis + (slice(start, None),)
+            dataset[index] = values[index]
+
+
+def _cache_slots(fingerprints):
+    # label fingerprint of every used slot of an InferenceCache, by sample
+    return [dict((slot, fingerprint)
+                 for fingerprint, slot in sample.iteritems())
+            for sample in fingerprints]
+
+
+def _state(obj):
+    # what pickle would store of obj
+    if hasattr(obj, '__getstate__'):
+        return obj.__getstate__()
+    return obj.__dict__.copy()
+
+
+def _restore(cls, state):
+    obj = object.__new__(cls)
+    obj.__dict__.update(state)
+    return obj
+
+
+class Checkpoint(object):
+    """Training state of a LatentSSVM in a single HDF5 file.
+
+    The file holds the histories of the latent iterations, the completed
+    labels, w, the cutting planes and dual variables of base_ssvm and its
+    inference cache. Large arrays are HDF5 datasets written incrementally:
+    histories only get their new rows, cutting planes with their losses
+    and Gram matrix are rewritten from the first one that changed since
+    the last save, and of the completed labels and the inference cache only
+    the samples whose completion changed and the slots that got a new
+    labeling are written. The remaining small state, with the lengths of
+    the histories, is pickled into a single dataset.
+
+    Parameters
+    ----------
+    filename : string
+        Path of the HDF5 file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._reset()
+
+    def _reset(self):
+        # what is in the file: fingerprints of the cutting planes and their
+        # Gram matrix, the completed labels and the label fingerprints of
+        # the inference cache slots
+        self._planes = []
+        self._gram = np.zeros((0, 0))
+        self._labels = None
+        self._slots = []
+
+    def clear(self):
+        """Empties the file for a new training."""
+        h5py.File(self.filename, 'w', libver='latest').close()
+        self._reset()
+
+    def save(self, clf, Y, iteration):
+        """Saves clf after the latent iteration with the given number.
+
+        Y are the labels base_ssvm was fit on in that iteration.
+        """
+        base = clf.base_ssvm
+        state = {'iteration': iteration, 'lengths': {},
+                 'fit_params': clf._fit_params}
+        with h5py.File(self.filename, 'a', libver='latest') as f:
+            latent = f.require_group('latent')
+            for name in HISTORIES:
+                values = getattr(clf, name)
+                state['lengths'][name] = len(values)
+                if len(values):
+                    _append(latent, name, values)
+            if clf.save_inner_w and clf.inner_w:
+                state['inner_w'] = [w.shape[0] for w in clf.inner_w]
+                _append(latent, 'inner_w', np.vstack(clf.inner_w))
+
+            self._save_labels(f.require_group('labels'),
+                              LabelBatch.from_labels(Y))
+
+            base_state = _state(base)
+            base_state.pop('model')
+            base_state['_lazy'] = None
+            group = f.require_group('base')
+            constraints = base_state.pop('constraints_', None)
+            if constraints is not None:
+                base_state['constraints_'] = self._save_constraints(
+                    group, constraints)
+            cache = base_state.pop('inference_cache_', None)
+            if cache is not None:
+                base_state['inference_cache_'] = self._save_inference_cache(
+                    group, cache)
+            state['base'] = base_state
+
+            _write(f, 'state', np.void(cPickle.dumps(state, 2)))
+
+    def _save_labels(self, group, labels):
+        previous = self._labels
+        if (previous is None or 'full' not in group
+                or not np.array_equal(labels.offsets, previous.offsets)):
+            _write(group, 'full', labels.full)
+        else:
+            dataset = group['full']
+            offsets = labels.offsets
+            for i in np.flatnonzero(labels.changed(previous)):
+                nodes = slice(offsets[i], offsets[i + 1])
+                dataset[nodes] = labels.full[nodes]
+        self._labels = labels
+
+    def _save_constraints(self, group, constraints):
+        store_state = _state(constraints)
+        losses = store_state.pop('_losses')
+        gram = store_state.pop('_gram')
+        unchanged = 0
+        for old, new in zip(self._planes, constraints._fingerprints):
+            if old != new:
+                break
+            unchanged += 1
+        # the Gram matrix of unchanged planes is compared as well, it is
+        # recomputed when the planes are moved to a new completion
+        differs = np.any(self._gram[:unchanged, :unchanged]
+                         != gram[:unchanged, :unchanged], axis=1)
+        if np.any(differs):
+            unchanged = np.argmax(differs)
+        _splice(group, 'losses', losses, unchanged)
+        _splice(group, 'gram', gram, unchanged, n_axes=2)
+        if not constraints.sparse:
+            _splice(group, 'joint_features',
+                    store_state.pop('_joint_features'), unchanged)
+        self._planes = list(constraints._fingerprints)
+        self._gram = gram
+        return store_state
+
+    def _save_inference_cache(self, group, cache):
+        # the joint features are taken from the cache itself, a memory
+        # mapped cache is not read into memory
+        cache_state = cache.__dict__.copy()
+        joint_features = cache_state.pop('joint_features')
+        slots = _cache_slots(cache_state['_fingerprints'])
+        dataset = group.get('inference_cache')
+        if (dataset is None or dataset.shape != joint_features.shape
+                or dataset.dtype != joint_features.dtype
+                or len(self._slots) != len(slots)):
+            _write(group, 'inference_cache', joint_features)
+        else:
+            for sample, (old, new) in enumerate(zip(self._slots, slots)):
+                touched = sorted(slot for slot, fingerprint in new.iteritems()
+                                 if old.get(slot) != fingerprint)
+                if touched:
+                    dataset[sample, touched] = \
+                        joint_features[sample, touched]
+        self._slots = slots
+        return cache_state
+
+    def load(self, clf, Y):
+        """Restores clf from the file.
+
+        Y are the labels the training started with; the weakly labeled
+        ones are returned with their completion from the checkpoint.
+
+        Returns
+        -------
+        Y : list
+            Labels as in the last saved iteration.
+        """
+        base = clf.base_ssvm
+        with h5py.File(self.filename, 'r', libver='latest') as f:
+            state = cPickle.loads(f['state'][()].tostring())
+            clf._fit_params = state['fit_params']
+            latent = f['latent']
+            for name in HISTORIES:
+                length = state['lengths'][name]
+                values = []
+                if length:
+                    values = list(latent[name][:length])
+                setattr(clf, name, values)
+            if 'inner_w' in state:
+                rows = latent['inner_w'][:np.sum(state['inner_w'])]
+                clf.inner_w = np.split(rows, np.cumsum(state['inner_w'])[:-1])
+            clf.iter_done = len(clf.w_history_)
+
+            labels = LabelBatch.from_labels(Y)
+            full = f['labels/full'][:labels.full.shape[0]]
+            offsets = labels.offsets
+            Y = [y if y.full_labeled else
+                 Label(full[offsets[i]:offsets[i + 1]], y.weak, y.weights,
+                       y.full_labeled)
+                 for i, y in enumerate(Y)]
+            self._reset()
+            self._labels = LabelBatch.from_labels(Y)
+
+            base_state = state['base']
+            group = f['base']
+            store_state = base_state.pop('constraints_', None)
+            if store_state is not None:
+                n = store_state['n_constraints']
+                store_state['_losses'] = group['losses'][:]
+                store_state['_gram'] = group['gram'][:]
+                if not store_state['sparse']:
+                    store_state['_joint_features'] = \
+                        group['joint_features'][:n]
+                base_state['constraints_'] = _restore(ConstraintStore,
+                                                      store_state)
+                self._planes = list(store_state['_fingerprints'])
+                self._gram = store_state['_gram'].copy()
+            cache_state = base_state.pop('inference_cache_', None)
+            if cache_state is not None:
+                joint_features = group['inference_cache'][:]
+                if getattr(base, 'cache_file', None) and joint_features.size:
+                    mapped = np.memmap(base.cache_file,
+                                       dtype=joint_features.dtype, mode='w+',
+                                       shape=joint_features.shape)
+                    mapped[...] = joint_features
+                    joint_features = mapped
+                cache_state['joint_features'] = joint_features
+                base_state['inference_cache_'] = _restore(InferenceCache,
+                                                          cache_state)
+                self._slots = _cache_slots(cache_state['_fingerprints'])
+            base.__dict__.update(base_state)
+        return Y
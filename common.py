@@ -1,5 +1,9 @@
 import numpy as np
 
+from time import time
+
+from scheduling import CostScheduler, scheduled_map, staged_map
+
 def compute_error(Y, Y_pred):
     err = 0.0
     N = len(Y)
@@ -17,3 +21,49 @@ def weak_from_hidden(H):
 
 def latent(model, x, y, w):
     return model.latent(x, y, w)
+
+
+def inference(model, x, y, w):
+    return model.inference(x, w)
+
+
+class LatentCompletion(object):
+    """Completes the latent variables of the weakly labeled samples.
+
+    The samples are split once into fully and weakly labeled ones. Only the
+    weak ones are sent to model.latent, the labels of the others are passed
+    through unchanged. The time of every completion is kept in ``times``.
+
+    Parameters
+    ----------
+    X : list
+        Samples.
+
+    Y : list
+        Labels, only full_labeled is used.
+
+    n_jobs : int, default=1
+        Number of jobs for scheduled_map.
+    """
+
+    def __init__(self, X, Y, n_jobs=1):
+        self.weak = np.array([i for i, y in enumerate(Y)
+                              if not y.full_labeled], dtype=np.intp)
+        self.n_jobs = n_jobs
+        self._X_weak = [X[i] for i in self.weak]
+        self.scheduler = CostScheduler(self._X_weak,
+                                       [Y[i] for i in self.weak])
+        self.times = []
+
+    def __call__(self, model, Y, w):
+        """Returns Y with the weakly labeled samples completed at w."""
+        start = time()
+        Y_new = list(Y)
+        if self.weak.shape[0]:
+            Y_weak = scheduled_map(latent, model, self._X_weak,
+                                   [Y[i] for i in self.weak], w,
+                                   self.n_jobs, self.scheduler)
+            for i, y in zip(self.weak, Y_weak):
+                Y_new[i] = y
+        self.times.append(time() - start)
+        return Y_new
@@ -5,7 +5,7 @@ import logging
 
 from frankwolfe_ssvm import FrankWolfeSSVM
 from one_slack_ssvm import OneSlackSSVM
-from latent_structured_svm import LatentSSVM
+from latent_structured_svm import LatentSSVM, weighted_score, mean_loss
 from subgradient_ssvm import SubgradientSSVM
 from over import Over
 from over_weak import OverWeak
@@ -56,17 +56,10 @@ def syntetic_weak(n_full=10, n_train=200, C=0.1, dataset=1, latent_iter=15,
     logger.info('Norm of weight vector: |w|=%f', np.linalg.norm(clf.w))
     logger.info('Elapsed time: %f s', time_elapsed)
 
-    test_scores = []
-    for score in clf.staged_score(x_test, y_test):
-        test_scores.append(score)
-
-    train_scores = []
-    for score in clf.staged_score(x_train, y_train_full):
-        train_scores.append(score)
-
-    raw_scores = []
-    for score in clf.staged_score2(x_train, y_train):
-        raw_scores.append(score)
+    # inference on the train set once per stage for both scores
+    test_scores = clf.staged_evaluate(x_test, [(weighted_score, y_test)])[:, 0]
+    train_scores, raw_scores = clf.staged_evaluate(
+        x_train, [(weighted_score, y_train_full), (mean_loss, y_train)]).T
 
     exp_data = clf._get_data()
     exp_data['test_scores'] = np.array(test_scores)
@@ -125,17 +118,10 @@ def msrc_weak(n_full=20, n_train=276, C=100, latent_iter=25,
     logger.info('Norm of weight vector: |w|=%f', np.linalg.norm(clf.w))
     logger.info('Elapsed time: %f s', time_elapsed)
 
-    test_scores = []
-    for score in clf.staged_score(x_test, y_test):
-        test_scores.append(score)
-
-    train_scores = []
-    for score in clf.staged_score(x_train, y_train_full):
-        train_scores.append(score)
-
-    raw_scores = []
-    for score in clf.staged_score2(x_train, y_train):
-        raw_scores.append(score)
+    # inference on the train set once per stage for both scores
+    test_scores = clf.staged_evaluate(x_test, [(weighted_score, y_test)])[:, 0]
+    train_scores, raw_scores = clf.staged_evaluate(
+        x_train, [(weighted_score, y_train_full), (mean_loss, y_train)]).T
 
     exp_data = clf._get_data()
     exp_data['test_scores'] = np.array(test_scores)
@@ -1,5 +1,8 @@
 import numpy as np
 import pygraphviz as pgv
+import hashlib
+
+from collections import OrderedDict
 
 
 def create_graph(n_nodes, edges):
@@ -12,56 +15,84 @@ def create_graph(n_nodes, edges):
 
 
 def monotonic_chains(n_nodes, edges):
-    used_edges = set()
-    incidence = [[] for i in xrange(n_nodes)]
-    edge_index = {}
-    contains = [[] for i in xrange(n_nodes)]
-    chains = []
+    """Greedily peels monotonic paths i < j < ... off the graph.
 
-    for i, j in edges:
-        assert i < j
-        incidence[i].append(j)
+    Every walk starts at the smallest node with an unused outgoing edge and
+    follows the first unused outgoing edge (in the order of edges) until it
+    gets stuck, so every edge is used by exactly one chain. Runs in
+    O(n_nodes + n_edges).
+
+    Returns all chains concatenated in one int32 array and their offsets:
+    chain k is nodes[chain_ptr[k]:chain_ptr[k + 1]].
+    """
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    assert np.all(edges[:, 0] < edges[:, 1])
+
+    # outgoing edges of every node in CSR format, in the order of edges
+    order = np.argsort(edges[:, 0], kind='mergesort')
+    targets = edges[order, 1].tolist()
+    adj_ptr = np.hstack([[0], np.cumsum(np.bincount(edges[:, 0],
+                                                    minlength=n_nodes))])
+
+    # a walk always leaves a node by its first unused edge, so the used
+    # edges of every node are a prefix of its row
+    next_edge = adj_ptr[:-1].tolist()
+    row_end = adj_ptr[1:].tolist()
+
+    nodes = []
+    chain_ptr = [0]
+    for start_node in xrange(n_nodes):
+        while next_edge[start_node] < row_end[start_node]:
+            i = start_node
+            while next_edge[i] < row_end[i]:
+                nodes.append(i)
+                next_edge[i] += 1
+                i = targets[next_edge[i] - 1]
+            nodes.append(i)
+            chain_ptr.append(len(nodes))
+
+    return (np.array(nodes, dtype=np.int32),
+            np.array(chain_ptr, dtype=np.int32))
+
+
+def split_chains(nodes, chain_ptr):
+    return [nodes[chain_ptr[k]:chain_ptr[k + 1]]
+            for k in xrange(chain_ptr.shape[0] - 1)]
+
+
+def _edge_index(edges):
+    edge_index = {}
     for i, edge in enumerate(edges):
         edge_index[(edge[0], edge[1])] = i
+    return edge_index
 
-    start_node = 0
-    k = 0
-    chains.append([])
-
-    while start_node < n_nodes:
-        i = start_node
-        flag1 = False
-        while True:
-            flag2 = False
-            for j in incidence[i]:
-                assert i < j
-                if (i, j) not in used_edges:
-                    chains[k].append(i)
-                    contains[i].append(k)
-                    used_edges.add((i, j))
-                    i = j
-                    flag1 = True
-                    flag2 = True
-                    break
-            if not flag2 and flag1:
-                chains[k].append(i)
-                contains[i].append(k)
-                break
-            if not flag2:
-                break
-        if not flag1:
-            start_node += 1
-        else:
-#            print chains[-1]
-            chains.append([])
-            k += 1
 
-    _chains = []
-    for chain in chains[:-1]:
-        assert len(chain) > 0
-        _chains.append(np.array(chain, dtype=np.int32))
+def _group_by_length(chains):
+    by_length = {}
+    for i, chain in enumerate(chains):
+        by_length.setdefault(chain.shape[0], []).append(i)
+    return [(length, np.array(by_length[length], dtype=np.int32))
+            for length in sorted(by_length.keys())]
 
-    return contains, _chains, edge_index
+
+def edge_lookup(n_nodes, edges, u, v):
+    """Vectorized edge_index: returns the indices of edges (u, v)."""
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    keys = edges[:, 0] * n_nodes + edges[:, 1]
+    order = np.argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+
+    query = np.asarray(u, dtype=np.int64) * n_nodes + np.asarray(v)
+    pos = np.searchsorted(sorted_keys, query)
+    pos = np.minimum(pos, max(sorted_keys.shape[0] - 1, 0))
+    if query.size and (sorted_keys.shape[0] == 0
+                       or np.any(sorted_keys[pos] != query)):
+        raise ValueError("Chain uses an edge that is not in the graph")
+    return order[pos].astype(np.int32)
+
+
+def _chain_ptr(chains):
+    return np.hstack([[0], np.cumsum([chain.shape[0] for chain in chains])])
 
 
 def decompose_graph(X):
@@ -70,59 +101,188 @@ def decompose_graph(X):
     edge_index = []
 
     for x in X:
-        _contains, _chains, _edge_index = monotonic_chains(x[0].shape[0], x[1])
-        contains.append(_contains)
-        chains.append(_chains)
-        edge_index.append(_edge_index)
+        decomposition = get_decomposition(x[0].shape[0], x[1], kind='general')
+        contains.append([list(c) for c in decomposition.contains_node])
+        chains.append(list(decomposition.chains))
+        edge_index.append(_edge_index(x[1]))
 
     return contains, chains, edge_index
 
 
-def decompose_grid_graph(X, get_sign=False):
-    contains_node = []
-    chains = []
-    edge_index = []
-    sign = []
-
-    n_states = 10
-    n_nodes = 400
-    width = 20
-    height = 20
-
-    for k in xrange(len(X)):
-        x = X[k]
-        _edge_index = {}
-        for i, edge in enumerate(x[1]):
-            _edge_index[(edge[0], edge[1])] = i
-
-        _sign = []
-        _chains = []
-        _contains = [[] for i in xrange(n_nodes)]
-
-        #vertical
-        for i in xrange(0, n_nodes, width):
-            _sign.append(1)
-            _chains.append(np.arange(i, i + width))
-            assert _chains[-1].shape[0] == width
-            tree_number = len(_chains) - 1
-            for node in _chains[-1]:
-                _contains[node].append(tree_number)
-
-        #horizontal
-        for i in xrange(0, width):
-            _sign.append(-1)
-            _chains.append(np.arange(i, n_nodes, width))
-            assert _chains[-1].shape[0] == height
-            tree_number = len(_chains) - 1
-            for node in _chains[-1]:
-                _contains[node].append(tree_number)
-
-        sign.append(_sign)
-        contains_node.append(_contains)
-        chains.append(_chains)
-        edge_index.append(_edge_index)
-
-    if get_sign:
-        return contains_node, chains, edge_index, sign
+def grid_shape(n_nodes, edges, width=None, height=None):
+    """Returns (height, width) of a 4-connected grid graph.
+
+    Nodes are expected in row-major order, so every edge connects either
+    i and i + 1 or i and i + width. Missing dimensions are inferred from
+    the edges. If all edges connect i and i + 1, as in a single column,
+    the graph is taken as a single row: the decomposition has the same
+    chains, with rows and columns, and so their signs, swapped.
+    """
+    if width is None and height is not None:
+        width = n_nodes // height
+    if width is None:
+        edges = np.asarray(edges).reshape(-1, 2)
+        diff = np.abs(edges[:, 1] - edges[:, 0])
+        width = n_nodes
+        if diff.size and diff.max() > 1:
+            width = int(diff.max())
+        if np.any((diff != 1) & (diff != width)):
+            raise ValueError("Graph is not a grid: edges should connect "
+                             "horizontal or vertical neighbours")
+    if height is None:
+        height = n_nodes // width if width else 0
+    if width * height != n_nodes:
+        raise ValueError("Grid %dx%d does not match n_nodes=%d"
+                         % (height, width, n_nodes))
+    return height, width
+
+
+def _grid_layout(n_nodes, edges, width, height):
+    # rows of the grid have sign 1, columns have sign -1
+    height, width = grid_shape(n_nodes, edges, width, height)
+    grid = np.arange(n_nodes).reshape(height, width)
+    chains = list(grid) + list(np.ascontiguousarray(grid.T))
+    sign = [1] * height + [-1] * width
+    return chains, sign
+
+
+def _readonly(a):
+    a.flags.writeable = False
+    return a
+
+
+class ChainDecomposition(object):
+    """Chain decomposition of a graph, stored in read-only arrays.
+
+    Parameters
+    ----------
+    n_nodes : int
+        Number of nodes in the graph.
+
+    chains : list of nd-arrays
+        Node indices of every chain.
+
+    edges : nd-array, shape=(n_edges, 2)
+        Edges of the graph.
+
+    sign : list of ints or None
+        Sign of every chain, used by the unconstrained solvers.
+
+    Attributes
+    ----------
+    nodes : nd-array
+        Concatenation of all chains. Per-position solver state (labels,
+        lambdas) uses the same flat layout.
+
+    chain_ptr : nd-array, shape=(n_chains + 1,)
+        Chain i occupies positions chain_ptr[i]:chain_ptr[i + 1] of nodes.
+
+    position_chain : nd-array
+        Chain of every position in nodes.
+
+    node_ptr, node_chains, node_positions : nd-arrays
+        (chain, position) pairs of every node in CSR format.
+
+    contains_node : tuple of tuples
+        Chains containing every node, built from node_chains on first use.
+
+    groups : tuple
+        Chains of equal length, to be optimized in one call of
+        optimize_chains, as (chain ids, nodes, edge ids, positions); nodes
+        and positions are (n_chains, length) arrays of the nodes and of
+        their positions in ``nodes``, edge ids the (n_chains, length - 1)
+        indices of the edges between them.
+
+    multiplier : nd-array, shape=(n_nodes, 1)
+        Inverse of the number of chains containing every node.
+
+    position_multiplier : nd-array
+        Multiplier of the node at every position in nodes.
+    """
+
+    def __init__(self, n_nodes, chains, edges, sign=None):
+        self.n_nodes = n_nodes
+        self.chains = tuple(_readonly(np.array(chain)) for chain in chains)
+
+        # all chains concatenated; labels and lambdas of the solvers are
+        # stored in the same flat layout
+        self.chain_ptr = _readonly(_chain_ptr(self.chains))
+        lengths = np.diff(self.chain_ptr)
+        if lengths.shape[0]:
+            self.nodes = _readonly(np.concatenate(self.chains))
+        else:
+            self.nodes = _readonly(np.zeros(0, dtype=np.int32))
+        self.position_chain = _readonly(
+            np.repeat(np.arange(lengths.shape[0]), lengths).astype(np.int32))
+
+        groups = []
+        for length, ids in _group_by_length(self.chains):
+            nodes = np.vstack([self.chains[i] for i in ids])
+            edge_ids = edge_lookup(n_nodes, edges,
+                                   nodes[:, :-1], nodes[:, 1:])
+            positions = self.chain_ptr[ids][:, np.newaxis] + np.arange(length)
+            groups.append((_readonly(ids), _readonly(nodes),
+                           _readonly(edge_ids), _readonly(positions)))
+        self.groups = tuple(groups)
+
+        # (chain, position) pairs of every node in CSR format: for node p
+        # they are node_chains[node_ptr[p]:node_ptr[p + 1]] and the same
+        # slice of node_positions (positions in the flat layout)
+        order = np.argsort(self.nodes, kind='mergesort')
+        counts = np.bincount(self.nodes, minlength=n_nodes)
+        self.node_ptr = _readonly(np.hstack([[0], np.cumsum(counts)]))
+        self.node_chains = _readonly(self.position_chain[order])
+        self.node_positions = _readonly(order.astype(np.int32))
+        self._contains_node = None
+
+        self.multiplier = _readonly((1.0 / counts).reshape(n_nodes, 1))
+        self.position_multiplier = _readonly(self.multiplier[self.nodes, 0])
+
+        self.sign = None
+        if sign is not None:
+            self.sign = _readonly(np.array(sign))
+
+    @property
+    def contains_node(self):
+        # list view of node_chains, built on first use
+        if self._contains_node is None:
+            self._contains_node = tuple(
+                tuple(self.node_chains[self.node_ptr[p]:self.node_ptr[p + 1]])
+                for p in xrange(self.n_nodes))
+        return self._contains_node
+
+
+_decomposition_cache = OrderedDict()
+DECOMPOSITION_CACHE_SIZE = 64
+
+
+def get_decomposition(n_nodes, edges, kind='grid', width=None, height=None):
+    """Returns a cached ChainDecomposition of the graph.
+
+    The topology does not change between calls of the inference on the same
+    image, so decompositions are cached by the content of the edge array and
+    the least recently used one is evicted when the cache is full.
+    For grids width and height are inferred from the edges if not given.
+    """
+    if kind not in ['grid', 'general']:
+        raise ValueError("Unknown decomposition kind: %s" % kind)
+
+    edges = np.ascontiguousarray(edges)
+    key = (kind, n_nodes, width, height, edges.shape, edges.dtype.str,
+           hashlib.sha1(edges.tobytes()).hexdigest())
+
+    if key in _decomposition_cache:
+        decomposition = _decomposition_cache.pop(key)
     else:
-        return contains_node, chains, edge_index
+        if kind == 'grid':
+            chains, sign = _grid_layout(n_nodes, edges, width, height)
+        else:
+            chains = split_chains(*monotonic_chains(n_nodes, edges))
+            sign = None
+        decomposition = ChainDecomposition(n_nodes, chains, edges, sign)
+
+    _decomposition_cache[key] = decomposition
+    while len(_decomposition_cache) > DECOMPOSITION_CACHE_SIZE:
+        _decomposition_cache.popitem(last=False)
+
+    return decomposition
@@ -3,12 +3,14 @@
 # (c) 2012 Andreas Mueller <amueller@ais.uni-bonn.de>
 
 import numpy as np
+import scipy.sparse as sps
 
 from pystruct.models.base import StructuredModel
 
 from sklearn.utils.extmath import safe_sparse_dot
 
-from label import Label
+from label import Label, LabelBatch
+from potentials import PottsPotentials, gco_pairwise_cost
 
 
 def _validate_params(unary_potentials, pairwise_params, edges):
@@ -69,7 +71,8 @@ def inference_ad3(unary_potentials, pairwise_potentials, edges, relaxed=False,
     """
     import ad3
     n_states, pairwise_potentials = \
-        _validate_params(unary_potentials, pairwise_potentials, edges)
+        _validate_params(unary_potentials, np.asarray(pairwise_potentials),
+                         edges)
 
     unaries = unary_potentials.reshape(-1, n_states)
     res = ad3.general_graph(unaries, edges, pairwise_potentials, verbose=1,
@@ -93,22 +96,17 @@ def inference_gco(unary_potentials, pairwise_potentials, edges,
     from pygco import cut_from_graph_gen_potts
 
     shape_org = unary_potentials.shape[:-1]
-    n_states = unary_potentials.shape[-1]
 
-    pairwise_cost = {}
-    count = 0
-    for i in xrange(0, pairwise_potentials.shape[0]):
-        count += np.sum(np.diag(pairwise_potentials[i, :]) < 0)
-        pairwise_cost[(edges[i, 0], edges[i, 1])] = list(np.maximum(
-            np.diag(pairwise_potentials[i, :]), 0))
+    pairwise_cost = gco_pairwise_cost(edges, pairwise_potentials)
 
-    unary_potentials *= -1
+    # negate out of place, the caller's potentials are left untouched
+    unary_cost = -unary_potentials
 
     if 'n_iter' in kwargs:
-        y = cut_from_graph_gen_potts(unary_potentials, pairwise_cost, 
+        y = cut_from_graph_gen_potts(unary_cost, pairwise_cost,
                                      label_cost=label_costs, n_iter=kwargs['n_iter'])
     else:
-        y = cut_from_graph_gen_potts(unary_potentials, pairwise_cost,
+        y = cut_from_graph_gen_potts(unary_cost, pairwise_cost,
                                      label_cost=label_costs)
 
     if 'return_energy' in kwargs and kwargs['return_energy']:
@@ -185,8 +183,8 @@ class HCRF(StructuredModel):
 
         Returns
         -------
-        pairwise : ndarray, shape=(n_edges, n_states, n_states)
-            Pairwise weights.
+        pairwise : PottsPotentials, shape=(n_edges, n_states, n_states)
+            Pairwise weights, only the diagonal is stored.
         """
         self._check_size_w(w)
         self._check_size_x(x)
@@ -194,10 +192,7 @@ class HCRF(StructuredModel):
         pairwise = np.asarray(w[self.n_states * self.n_features:])
         pairwise = pairwise.reshape(self.n_edge_features, -1)
         pairwise = np.dot(edge_features, pairwise)
-        res = np.zeros((edge_features.shape[0], self.n_states, self.n_states))
-        for i in range(edge_features.shape[0]):
-            res[i, :, :] = np.diag(pairwise[i, :])
-        return res
+        return PottsPotentials(pairwise)
 
     def _get_unary_potentials(self, x, w):
         """Computes unary potentials for x and w.
@@ -223,6 +218,30 @@ class HCRF(StructuredModel):
         result = safe_sparse_dot(features, unary_params.T, dense_output=True)
         return result
 
+    def _integral_joint_feature(self, features, edges, edge_features, y,
+                                weights):
+        # sum of features by label with a sparse (n_states, n_nodes)
+        # indicator, pairwise part by a bincount over (label, edge feature)
+        # of the edges whose nodes share a label; weights scale every node
+        # and the edges leaving it
+        n_nodes = features.shape[0]
+        indicator = sps.csr_matrix((weights, (y, np.arange(n_nodes))),
+                                   shape=(self.n_states, n_nodes))
+        unaries_acc = safe_sparse_dot(indicator, features, dense_output=True)
+
+        same = y[edges[:, 0]] == y[edges[:, 1]]
+        labels = y[edges[same, 0]]
+        edge_weights = weights[edges[same, 0]]
+        index = (labels[:, np.newaxis] * self.n_edge_features
+                 + np.arange(self.n_edge_features))
+        pw = np.bincount(index.ravel(),
+                         weights=(edge_features[same]
+                                  * edge_weights[:, np.newaxis]).ravel(),
+                         minlength=self.n_states * self.n_edge_features)
+        pw = pw.reshape(self.n_states, self.n_edge_features).T
+
+        return np.hstack([np.asarray(unaries_acc).ravel(), pw.ravel()])
+
     def joint_feature(self, x, y):
         self._check_size_x(x)
         features, edges = self._get_features(x), self._get_edges(x)
@@ -236,32 +255,103 @@ class HCRF(StructuredModel):
             unary_marginals, pw = y
             unary_marginals = unary_marginals.reshape(n_nodes, self.n_states)
 
-            pw_new = np.zeros((pw.shape[0], self.n_states))
-            for i in xrange(self.n_states):
-                pw_new[:, i] = pw[:, self.n_states * i + i]
+            diagonal = np.arange(self.n_states) * (self.n_states + 1)
+            pw = np.dot(edge_features.T, pw[:, diagonal])
+
+            unaries_acc = safe_sparse_dot(unary_marginals.T, features,
+                                          dense_output=True)
 
-            pw = np.dot(edge_features.T, pw_new)
+            joint_feature_vector = np.hstack([unaries_acc.ravel(), pw.ravel()])
         else:
             y = y.reshape(n_nodes)
-            gx = np.ogrid[:n_nodes]
-
-            unary_marginals = np.zeros((n_nodes, self.n_states), dtype=np.float64)
-            gx = np.ogrid[:n_nodes]
-            unary_marginals[gx, y] = 1
-
-            pw = np.zeros((self.n_edge_features, self.n_states))
-            for label in xrange(self.n_states):
-                mask = (y[edges[:, 0]] == label) & (y[edges[:, 1]] == label)
-                pw[:, label] = np.sum(edge_features[mask], axis=0)
-
-        unaries_acc = safe_sparse_dot(unary_marginals.T, features,
-                                      dense_output=True)
+            joint_feature_vector = self._integral_joint_feature(
+                features, edges, edge_features, y, np.ones(n_nodes))
 
-        joint_feature_vector = np.hstack([unaries_acc.ravel(), pw.ravel()])
         if not full_labeled:
             joint_feature_vector *= self.alpha
         return joint_feature_vector
 
+    def score_bound(self, x, w):
+        """Upper bound on np.dot(w, joint_feature(x, y)) over all y.
+
+        Every node takes its best state and every edge the best of its
+        agreeing states or none; this also bounds relaxed labelings.
+        """
+        unary = self._get_unary_potentials(x, w)
+        pairwise = self._get_pairwise_potentials(x, w).diagonal
+        bound = (np.sum(np.max(unary, axis=1))
+                 + np.sum(np.maximum(np.max(pairwise, axis=1), 0)))
+        # joint features of weakly labeled samples are scaled by alpha
+        return max(bound, self.alpha * bound)
+
+    def stack(self, X):
+        """Keeps the stacked dataset of X for batch_joint_feature.
+
+        OneSlackSSVM.fit stacks its training data once and calls
+        clear_stack when it is done; the arrays of X must not change in
+        between.
+        """
+        self._stacked = (list(X), self._stack_samples(X))
+
+    def clear_stack(self):
+        """Drops the dataset kept by stack."""
+        self._stacked = None
+
+    def _stack(self, X):
+        # the dataset kept by stack if X are its samples, else a new one
+        cached = getattr(self, '_stacked', None)
+        if cached is not None and len(cached[0]) == len(X) \
+                and all(a is b for a, b in zip(cached[0], X)):
+            return cached[1]
+        return self._stack_samples(X)
+
+    def _stack_samples(self, X):
+        # features, edges and edge features of all samples concatenated,
+        # edges are shifted by node offsets
+        node_ptr = np.cumsum([0] + [self._get_features(x).shape[0] for x in X])
+        features = [self._get_features(x) for x in X]
+        if any(sps.issparse(f) for f in features):
+            features = sps.vstack(features, format='csr')
+        else:
+            features = np.vstack(features)
+        edges = np.vstack([self._get_edges(x) + node_ptr[i]
+                           for i, x in enumerate(X)])
+        edge_features = np.vstack([self._get_edge_features(x) for x in X])
+        return node_ptr, features, edges, edge_features
+
+    def __getstate__(self):
+        # the stacked dataset is only a cache
+        state = self.__dict__.copy()
+        state.pop('_stacked', None)
+        return state
+
+    def batch_joint_feature(self, X, Y, Y_true=None):
+        """Sum of joint_feature(x, y) over all samples.
+
+        Integral labelings of all samples are processed together on the
+        stacked dataset, relaxed labelings fall back to joint_feature.
+        """
+        joint_feature_ = np.zeros(self.size_joint_feature)
+        if not len(X):
+            return joint_feature_
+
+        node_ptr, features, edges, edge_features = self._stack(X)
+
+        y = np.zeros(node_ptr[-1], dtype=np.intp)
+        weights = np.zeros(node_ptr[-1])
+        for i, (x, y_i) in enumerate(zip(X, Y)):
+            if isinstance(y_i.full, tuple):
+                joint_feature_ += self.joint_feature(x, y_i)
+                continue
+            y[node_ptr[i]:node_ptr[i + 1]] = y_i.full.ravel()
+            weights[node_ptr[i]:node_ptr[i + 1]] = \
+                1 if y_i.full_labeled else self.alpha
+
+        joint_feature_ += self._integral_joint_feature(features, edges,
+                                                       edge_features, y,
+                                                       weights)
+        return joint_feature_
+
     def loss(self, y, y_hat):
         if y.full_labeled:
             if isinstance(y_hat.full, tuple):
@@ -293,6 +383,24 @@ class HCRF(StructuredModel):
                     loss += np.sum(y.weights * (y_hat.full == label))
             return loss * self.alpha
 
+    def batch_loss(self, Y, Y_hat):
+        # loss of integral labelings of all samples at once, as loss does
+        # sample by sample
+        if (any(getattr(y, 'relaxed', False) for y in Y)
+                or any(getattr(y, 'relaxed', False) for y in Y_hat)):
+            return [self.loss(y, y_hat) for y, y_hat in zip(Y, Y_hat)]
+        Y = LabelBatch.from_labels(Y, self.n_states)
+        Y_hat = LabelBatch.from_labels(Y_hat, self.n_states)
+        hamming = Y.sum_nodes(Y.weights * (Y.full != Y_hat.full))
+
+        c = Y.sum_nodes(Y.weights) / float(self.n_states)
+        present = Y.state_sums(Y_hat.full) > 0
+        weighted = Y.state_sums(Y_hat.full, Y.weights)
+        missing = np.sum(Y.weak & ~present, axis=1)
+        other = np.sum(np.where(Y.weak, 0, weighted), axis=1)
+        weak_loss = (c * missing + other) * self.alpha
+        return np.where(Y.full_labeled, hamming, weak_loss)
+
     def max_loss(self, y):
         return np.sum(y.weights)
 
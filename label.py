@@ -21,3 +21,117 @@ class Label(object):
             return np.all(self.full[0] == other.full[0]) \
                 and np.all(self.full[1] == other.full[1])
         return np.all(self.full == other.full)
+
+
+class LabelBatch(object):
+    """Integral labels of many samples in a few flat arrays.
+
+    The full labelings and the node weights of all samples are concatenated,
+    sample i owning the nodes offsets[i]:offsets[i + 1]; its weak labels are
+    row i of a boolean (n_samples, n_states) mask. Comparisons and losses
+    over all samples are then single numpy operations. Indexing returns a
+    Label whose full and weights are views into the batch.
+
+    Parameters
+    ----------
+    full : nd-array, shape=(n_nodes,)
+        Concatenated full labelings.
+
+    offsets : nd-array, shape=(n_samples + 1,)
+        Start of the nodes of every sample, and the total number of nodes.
+
+    weak : nd-array, shape=(n_samples, n_states)
+        Whether a state is a weak label of a sample.
+
+    weights : nd-array, shape=(n_nodes,)
+        Concatenated node weights, ones for labels without weights.
+
+    full_labeled : nd-array, shape=(n_samples,)
+    """
+
+    def __init__(self, full, offsets, weak, weights, full_labeled):
+        self.full = full
+        self.offsets = offsets
+        self.weak = weak
+        self.weights = weights
+        self.full_labeled = full_labeled
+
+    @classmethod
+    def from_labels(cls, Y, n_states=None):
+        """Builds a batch from a list of integral Labels."""
+        Y = list(Y)
+        if any(getattr(y, 'relaxed', False) for y in Y):
+            raise ValueError("LabelBatch holds integral labels only")
+        n_samples = len(Y)
+        sizes = np.array([y.full.shape[0] for y in Y], dtype=np.intp)
+        offsets = np.zeros(n_samples + 1, dtype=np.intp)
+        np.cumsum(sizes, out=offsets[1:])
+        full = np.concatenate([y.full for y in Y] or [[]])
+        full = full.astype(np.int32, copy=False)
+        # labels from inference have no weights, they count as ones
+        weights = np.concatenate([np.ones(y.full.shape[0]) if y.weights is None
+                                  else y.weights for y in Y] or [[]])
+        weights = weights.astype(np.float64, copy=False)
+        full_labeled = np.array([y.full_labeled for y in Y], dtype=np.bool)
+
+        weak_sizes = np.array([len(y.weak) for y in Y], dtype=np.intp)
+        weak_labels = np.concatenate([y.weak for y in Y] or [[]])
+        weak_labels = weak_labels.astype(np.intp, copy=False)
+        if n_states is None:
+            n_states = max(np.max(full) if full.size else -1,
+                           np.max(weak_labels) if weak_labels.size else -1)
+            n_states += 1
+        weak = np.zeros((n_samples, n_states), dtype=np.bool)
+        weak[np.repeat(np.arange(n_samples), weak_sizes), weak_labels] = True
+        return cls(full, offsets, weak, weights, full_labeled)
+
+    @property
+    def n_states(self):
+        return self.weak.shape[1]
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, i):
+        i = xrange(len(self))[i]
+        nodes = slice(self.offsets[i], self.offsets[i + 1])
+        return Label(self.full[nodes],
+                     np.flatnonzero(self.weak[i]).astype(np.int32),
+                     self.weights[nodes], bool(self.full_labeled[i]))
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def samples(self):
+        """Returns the index of the sample of every node."""
+        return np.repeat(np.arange(len(self)), np.diff(self.offsets))
+
+    def _reduce(self, ufunc, values, empty=0):
+        # ufunc.reduceat over the nodes of every sample; reduceat does not
+        # skip empty segments, so only the starts of nonempty ones are used
+        starts = self.offsets[:-1]
+        nonempty = starts < self.offsets[1:]
+        result = np.empty(len(self), dtype=values.dtype)
+        result[~nonempty] = empty
+        if values.shape[0]:
+            result[nonempty] = ufunc.reduceat(values, starts[nonempty])
+        return result
+
+    def sum_nodes(self, values):
+        """Sums values given per node over the nodes of every sample."""
+        return self._reduce(np.add, np.asarray(values, dtype=np.float64))
+
+    def changed(self, other):
+        """Returns for every sample whether its full labeling differs."""
+        if not np.array_equal(self.offsets, other.offsets):
+            raise ValueError("batches of different samples")
+        return self._reduce(np.logical_or, self.full != other.full, False)
+
+    def state_sums(self, states, values=None):
+        """Sums values (default 1) over the nodes of every sample in every
+        state, returns an (n_samples, n_states) array."""
+        n_samples, n_states = self.weak.shape
+        sums = np.bincount(self.samples() * n_states + states, weights=values,
+                           minlength=n_samples * n_states)
+        return sums.reshape(n_samples, n_states)
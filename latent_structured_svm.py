@@ -9,9 +9,31 @@ from time import time
 
 from pystruct.utils import objective_primal
 from pystruct.learners.ssvm import BaseSSVM
-from joblib import Parallel, delayed
 
-from common import latent
+from common import LatentCompletion, inference
+from label import LabelBatch
+from scheduling import staged_map
+
+# histories of LatentSSVM, appended to on every iteration
+HISTORIES = ['number_of_changes_', 'w_history_', 'number_of_iterations_',
+             'timestamps_', 'qp_time_', 'inference_time_', 'completion_time_',
+             'number_of_constraints_', 'objective_curve_',
+             'primal_objective_curve_', 'inference_calls_',
+             'latent_objective_', 'inner_sz', 'inner_objective',
+             'inner_primal', 'inner_staged_inference', 'inner_timestamps']
+
+
+def weighted_score(model, Y, Y_pred):
+    """1 - loss normalized by the weights of a sample, averaged."""
+    losses = np.asarray(model.batch_loss(Y, Y_pred), dtype=np.float64)
+    weights = np.array([np.sum(y.weights) for y in Y], dtype=np.float64)
+    return 1. - np.sum(losses / weights) / float(len(Y))
+
+
+def mean_loss(model, Y, Y_pred):
+    """Average loss."""
+    return np.mean(model.batch_loss(Y, Y_pred))
+
 
 class LatentSSVM(BaseSSVM):
     """
@@ -30,6 +52,18 @@ class LatentSSVM(BaseSSVM):
     tol : float (default=0.01)
         Tolerance, when to stop iterations of latent SSVM
 
+    exact_objective : bool (default=False)
+        Whether the latent objective is always computed by loss augmented
+        inference on all samples. Otherwise, when base_ssvm is warm started
+        at w, it is taken from its first (relaxed) inference pass.
+
+    checkpoint : string or None (default=None)
+        HDF5 file to save the training state to, see Checkpoint. Training
+        is continued from it with ``resume``.
+
+    checkpoint_every : int (default=1)
+        Number of latent iterations between checkpoints.
+
     Attributes
     ----------
     w : nd-array, shape=(model.size_joint_feature,)
@@ -37,13 +71,17 @@ class LatentSSVM(BaseSSVM):
     """
 
     def __init__(self, base_ssvm, latent_iter=5, verbose=0, tol=0.1,
-                 min_changes=0, n_jobs=1):
+                 min_changes=0, n_jobs=1, exact_objective=False,
+                 checkpoint=None, checkpoint_every=1):
         self.base_ssvm = base_ssvm
         self.latent_iter = latent_iter
         self.verbose = verbose
         self.tol = tol
         self.n_jobs = n_jobs
         self.min_changes = min_changes
+        self.exact_objective = exact_objective
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
 
     def fit(self, X, Y, initialize=True,
             continued=False, warm_start=False,
@@ -69,9 +107,22 @@ class LatentSSVM(BaseSSVM):
             If True than it is assumed that every internal model data are set up.
             And we continue learning. It may be used to perform additional iterations
             without restarting the method.
+
+        warm_start : bool or string
+            How base_ssvm is warm started after the first iteration, see
+            OneSlackSSVM.fit. With 'rescore' it keeps its cutting planes,
+            moved to the new completion of the latent variables.
         """
 
         self.save_inner_w = save_inner_w
+        self._fit_params = {'warm_start': warm_start,
+                            'save_inner_w': save_inner_w}
+        if self.checkpoint is not None and (
+                not continued or getattr(self, '_checkpoint', None) is None):
+            # h5py is only needed with checkpoints
+            from checkpoint import Checkpoint
+            self._checkpoint = Checkpoint(self.checkpoint)
+            self._checkpoint.clear()
 
         if not continued:
             w = np.zeros(self.model.size_joint_feature)
@@ -82,6 +133,7 @@ class LatentSSVM(BaseSSVM):
             self.timestamps_ = []
             self.qp_time_ = []
             self.inference_time_ = []
+            self.completion_time_ = []
             self.number_of_constraints_ = []
             self.objective_curve_ = []
             self.primal_objective_curve_ = []
@@ -106,6 +158,7 @@ class LatentSSVM(BaseSSVM):
                 self.timestamps_ = np.array([time() - start_time])
                 self.qp_time_ = np.array([self.base_ssvm.qp_time])
                 self.inference_time_ = np.array([self.base_ssvm.inference_time])
+                self.completion_time_ = np.array([])
                 self.number_of_constraints_ = np.array([len(self.base_ssvm.constraints_)])
                 self.objective_curve_ = np.array([self.base_ssvm.objective_curve_[-1]])
                 self.primal_objective_curve_ = np.array([self.base_ssvm.primal_objective_curve_[-1]])
@@ -169,9 +222,12 @@ class LatentSSVM(BaseSSVM):
 
             begin = 0
         else:
-            begin = self.iter_done
+            # the first entry of w_history_ is from the initialization
+            begin = len(self.w_history_) - 1
             w = self.w_history_[-1]
-            start_time = time()
+            start_time = time() - self.timestamps_[-1]
+            for name in HISTORIES:
+                setattr(self, name, list(getattr(self, name, [])))
 
 # reset strong labels
 #        from simple_dataset import Label
@@ -179,16 +235,20 @@ class LatentSSVM(BaseSSVM):
 #        Y = Y_new
     
         too_small_changes = False
+        # only weakly labeled samples are completed
+        completion = LatentCompletion(X, Y, self.n_jobs)
+        labels = LabelBatch.from_labels(Y)
 
         try:
             for iteration in xrange(begin, self.latent_iter):
                 if self.verbose:
                     print("LATENT SVM ITERATION %d" % iteration)
                 # complete latent variables
-                Y_new = Parallel(n_jobs=self.n_jobs, verbose=0, max_nbytes=1e8)(
-                    delayed(latent)(self.model, x, y, w) for x, y in zip(X, Y))
+                Y_new = completion(self.model, Y, w)
+                self.completion_time_.append(completion.times[-1])
     
-                changes = [np.any(y_new.full != y.full) for y_new, y in zip(Y_new, Y)]
+                labels_new = LabelBatch.from_labels(Y_new)
+                changes = labels_new.changed(labels)
                 if np.sum(changes) <= self.min_changes:
                     if self.verbose:
                         print("too few changes in latent variables of ground truth."
@@ -199,17 +259,29 @@ class LatentSSVM(BaseSSVM):
                 self.number_of_changes_.append(np.sum(changes))
     
                 Y = Y_new
-
-                latent_objective = objective_primal(self.model, w,
-                                                    X, Y, self.C, 'one_slack', self.n_jobs)
-
-                self.latent_objective_.append(latent_objective)
-                if self.verbose:
-                    print("Previous Latent SSVM objective: %f" % latent_objective)
+                labels = labels_new
+
+                # a warm started OneSlackSSVM begins with inference at w on
+                # the new completion, its first primal objective is the
+                # latent one
+                reuse_objective = (
+                    not self.exact_objective and iteration > 0
+                    and warm_start and warm_start != 'soft'
+                    and hasattr(self.base_ssvm, 'cached_constraint_')
+                    and not too_small_changes)
+                if not reuse_objective:
+                    latent_objective = objective_primal(self.model, w,
+                                                        X, Y, self.C, 'one_slack', self.n_jobs)
+                    self.latent_objective_.append(latent_objective)
+                    if self.verbose:
+                        print("Previous Latent SSVM objective: %f" % latent_objective)
 
                 if too_small_changes:
                     break
 
+                if reuse_objective:
+                    n_primal = len(self.base_ssvm.primal_objective_curve_)
+
                 if not warm_start:
                     self.base_ssvm.fit(X, Y, warm_start=False,
                                        initialize=False, save_history=self.save_inner_w)
@@ -221,6 +293,18 @@ class LatentSSVM(BaseSSVM):
                         self.base_ssvm.fit(X, Y, warm_start=False,
                                            initialize=False, save_history=self.save_inner_w)
 
+                if reuse_objective:
+                    if not self.base_ssvm.cached_constraint_[n_primal]:
+                        latent_objective = \
+                            self.base_ssvm.primal_objective_curve_[n_primal]
+                    else:
+                        # the first constraint came from the inference cache
+                        latent_objective = objective_primal(self.model, w,
+                                                            X, Y, self.C, 'one_slack', self.n_jobs)
+                    self.latent_objective_.append(latent_objective)
+                    if self.verbose:
+                        print("Previous Latent SSVM objective: %f" % latent_objective)
+
                 w = self.base_ssvm.w
 
                 self.w_history_.append(w)
@@ -255,9 +339,14 @@ class LatentSSVM(BaseSSVM):
                     print("Time elapsed: %f s" % (self.timestamps_[-1] - self.timestamps_[-2]))
                     print("Time spent by QP: %f s" % self.base_ssvm.qp_time)
                     print("Time spent by inference: %f s" % self.base_ssvm.inference_time)
+                    print("Time spent by latent completion: %f s" % self.completion_time_[-1])
                     print("Number of constraints: %d" % self.number_of_constraints_[-1])
                     print("----------------------------------------")
 
+                if (self.checkpoint is not None
+                        and (iteration + 1) % self.checkpoint_every == 0):
+                    self._checkpoint.save(self, Y, iteration)
+
                 if q_delta < self.tol:
                     if self.verbose:
                         print("objective value did not change a lot, break")
@@ -269,11 +358,11 @@ class LatentSSVM(BaseSSVM):
 
         # some copy paste
         if not too_small_changes:
-            Y_new = Parallel(n_jobs=self.n_jobs, verbose=0, max_nbytes=1e8)(
-                delayed(latent)(self.model, x, y, w) for x, y in zip(X, Y))
+            Y_new = completion(self.model, Y, w)
+            self.completion_time_.append(completion.times[-1])
             latent_objective = objective_primal(self.model, w, X, Y_new, self.C,
                                                 'one_slack', self.n_jobs)
-            changes = [np.any(y_new.full != y.full) for y_new, y in zip(Y_new, Y)]
+            changes = LabelBatch.from_labels(Y_new).changed(labels)
             if self.verbose:
                 print("changes in H: %d" % np.sum(changes))
             self.number_of_changes_.append(np.sum(changes))
@@ -288,6 +377,7 @@ class LatentSSVM(BaseSSVM):
         self.timestamps_ = np.array(self.timestamps_)
         self.qp_time_ = np.array(self.qp_time_)
         self.inference_time_ = np.array(self.inference_time_)
+        self.completion_time_ = np.array(self.completion_time_)
         self.number_of_constraints_ = np.array(self.number_of_constraints_)
         self.objective_curve_ = np.array(self.objective_curve_)
         self.primal_objective_curve_ = np.array(self.primal_objective_curve_)
@@ -304,6 +394,26 @@ class LatentSSVM(BaseSSVM):
         self.inner_staged_inference = np.array(self.inner_staged_inference)
         self.inner_timestamps = np.array(self.inner_timestamps)
 
+    def resume(self, X, Y):
+        """Continues training from the checkpoint file.
+
+        The training restarts after the last saved latent iteration, with
+        the arguments of the fit that saved it.
+
+        Parameters
+        ----------
+        X : iterable
+            Training instances of the interrupted fit.
+
+        Y : iterable
+            Training labels of the interrupted fit, the completion of the
+            weakly labeled ones is read from the checkpoint.
+        """
+        from checkpoint import Checkpoint
+        self._checkpoint = Checkpoint(self.checkpoint)
+        Y = self._checkpoint.load(self, Y)
+        self.fit(X, Y, continued=True, **self._fit_params)
+
     def _get_data(self):
         # get all model data as a dict
         data = {}
@@ -313,6 +423,7 @@ class LatentSSVM(BaseSSVM):
         data['timestamps'] = self.timestamps_
         data['qp_timestamps'] = self.qp_time_
         data['inference_timestamps'] = self.inference_time_
+        data['completion_timestamps'] = self.completion_time_
         data['number_of_constraints'] = self.number_of_constraints_
         data['objective_curve'] = self.objective_curve_
         data['primal_objective_curve'] = self.primal_objective_curve_
@@ -337,36 +448,80 @@ class LatentSSVM(BaseSSVM):
         self.timestamps_ = list(data['timestamps'])
         self.qp_time_ = list(data['qp_timestamps'])
         self.inference_time_ = list(data['inference_timestamps'])
+        self.completion_time_ = []
+        if 'completion_timestamps' in data:
+            self.completion_time_ = list(data['completion_timestamps'])
         self.number_of_constraints_ = list(data['number_of_constraints'])
         self.primal_objective_curve_ = list(data['primal_objective_curve'])
         self.objective_curve_ = list(data['objective_curve'])
         self.inference_calls_ = list(data['inference_calls'])
         self.iter_done = len(self.objective_curve_)
 
-    def _predict_from_iter(self, X, i):
-        saved_w = self.base_ssvm.w
-        self.base_ssvm.w = self.w_history_[i]
-        Y_pred = self.base_ssvm.predict(X)
-        self.base_ssvm.w = saved_w
-        return Y_pred
+    def staged_predictions(self, X, cache=None):
+        """Predictions for X at every w of w_history_.
+
+        Inference for all stages runs in a single parallel map. If a dict
+        is given as cache, predictions are looked up and stored in it by
+        (stage, sample), so that later calls on the same X only run the
+        missing ones.
+
+        Returns
+        -------
+        Y_pred : list
+            For every stage the list of predictions for X.
+        """
+        if cache is None:
+            cache = {}
+        n_stages = self.iter_done
+        missing = [np.array([i for i in xrange(len(X))
+                             if (stage, i) not in cache], dtype=np.intp)
+                   for stage in xrange(n_stages)]
+        if any(len(indices) for indices in missing):
+            results = staged_map(inference, self.model, X, [None] * len(X),
+                                 self.w_history_[:n_stages], self.n_jobs,
+                                 indices=missing)
+            for stage, indices in enumerate(missing):
+                for i in indices:
+                    cache[stage, i] = results[stage][i]
+        return [[cache[stage, i] for i in xrange(len(X))]
+                for stage in xrange(n_stages)]
+
+    def staged_evaluate(self, X, metrics, cache=None):
+        """Evaluates several metrics on the predictions of every stage.
+
+        Parameters
+        ----------
+        X : iterable
+            Evaluation data.
+
+        metrics : list
+            Pairs (metric, Y) of a function metric(model, Y, Y_pred) and
+            the labels it compares to, e.g. weighted_score or mean_loss.
+
+        cache : dict or None
+            Predictions by (stage, sample), see staged_predictions.
+
+        Returns
+        -------
+        scores : nd-array, shape=(n_stages, n_metrics)
+        """
+        stages = self.staged_predictions(X, cache)
+        return np.array([[metric(self.model, Y, Y_pred)
+                          for metric, Y in metrics]
+                         for Y_pred in stages]).reshape(len(stages),
+                                                        len(metrics))
 
     def staged_predict_latent(self, X):
-        for i in xrange(self.iter_done):
-            yield self._predict_from_iter(X, i)
+        for Y_pred in self.staged_predictions(X):
+            yield Y_pred
 
     def staged_score(self, X, Y):
-        for i in xrange(self.iter_done):
-            Y_pred = self._predict_from_iter(X, i)
-            losses = [self.model.loss(y, y_pred) / float(np.sum(y.weights))
-                      for y, y_pred in zip(Y, Y_pred)]
-            score = 1. - np.sum(losses) / float(len(X))
+        for score in self.staged_evaluate(X, [(weighted_score, Y)])[:, 0]:
             yield score
 
     def staged_score2(self, X, Y):
-        for i in xrange(self.iter_done):
-            Y_pred = self._predict_from_iter(X, i)
-            losses = [self.model.loss(y, y_pred) for y, y_pred in zip(Y, Y_pred)]
-            yield np.mean(losses)
+        for score in self.staged_evaluate(X, [(mean_loss, Y)])[:, 0]:
+            yield score
 
     def predict_latent(self, X):
         return self.base_ssvm.predict(X)
@@ -395,12 +550,12 @@ class LatentSSVM(BaseSSVM):
         return 1. - np.sum(losses) / float(len(X))
 
     def staged_latent_objective(self, X, Y):
+        completion = LatentCompletion(X, Y, self.n_jobs)
         for i in xrange(self.iter_done):
             w = self.w_history_[i]
-            Y = Parallel(n_jobs=self.n_jobs, verbose=0, max_nbytes=1e8)(
-                delayed(latent)(self.model, x, y, w) for x, y in zip(X, Y))
+            Y = completion(self.model, Y, w)
             yield objective_primal(self.model, w, X, Y, self.C,
-                                   'one_slack', self.njobs)
+                                   'one_slack', self.n_jobs)
 
     @property
     def model(self):
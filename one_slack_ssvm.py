@@ -7,7 +7,10 @@
 
 from time import time
 
+import hashlib
+import multiprocessing
 import numpy as np
+import scipy.sparse as sps
 import cvxopt
 import cvxopt.solvers
 
@@ -16,18 +19,714 @@ from joblib import Parallel, delayed
 from pystruct.learners.ssvm import BaseSSVM
 from pystruct.utils import loss_augmented_inference
 
+from scheduling import CostScheduler, n_workers
+
 
 class NoConstraint(Exception):
     # raised if we can not construct a constraint from cache
     pass
 
 
+# model and training data of an inference worker, set once by the pool
+# initializer; forked workers share the arrays with the parent process
+_worker_state = {}
+
+
+def _init_inference_worker(model, X, Y):
+    _worker_state['model'] = model
+    _worker_state['X'] = X
+    _worker_state['Y'] = Y
+
+
+def _inference_worker(task):
+    # loss augmented inference of the samples in indices, with the time
+    # spent on every sample
+    indices, w, inference_method = task
+    model = _worker_state['model']
+    # the parent may have switched the inference method (switch_to)
+    model.inference_method = inference_method
+    X, Y = _worker_state['X'], _worker_state['Y']
+    Y_hat, times = [], []
+    for i in indices:
+        start = time()
+        Y_hat.append(loss_augmented_inference(model, X[i], Y[i], w,
+                                              relaxed=True))
+        times.append(time() - start)
+    return Y_hat, times
+
+
+class SimplexQP(object):
+    """Active set solver for the dual of the 1-slack QP.
+
+    Minimizes 0.5 a^T P a - losses^T a subject to a >= 0, sum(a) = C, where
+    P is the Gram matrix of the cutting planes. On the support of the
+    solution the QP reduces to a linear system (its KKT conditions); the
+    solver keeps the inverse of its KKT matrix and updates it in O(k^2) when
+    a constraint enters or leaves a support of size k. Directions of zero
+    curvature (P is usually singular) are followed until a coefficient
+    drops to zero.
+
+    The solution and the factorization are kept between calls of ``solve``:
+    constraints appended to the problem start at zero weight and ``delete``
+    follows the pruning of the constraints, so adding a cutting plane
+    usually costs a few updates.
+
+    Parameters
+    ----------
+    tol : float, default=1e-14
+        Tolerance on the gradient, relative to its scale
+        max|losses| + C max(diag(P)).
+
+    max_iter : int or None, default=None
+        Maximum number of support changes per call, 10 * n + 100 if None.
+
+    refactor_every : int, default=100
+        Number of updates after which the inverse of the KKT matrix is
+        recomputed from scratch, to keep rounding errors from accumulating.
+    """
+
+    def __init__(self, tol=1e-14, max_iter=None, refactor_every=100):
+        self.tol = tol
+        self.max_iter = max_iter
+        self.refactor_every = refactor_every
+        self.reset()
+
+    def reset(self):
+        self.alpha = None
+        self._support = []
+        self._inverse = None
+        self._updates = 0
+
+    def changed(self):
+        """Keeps the solution after a change of the Gram matrix.
+
+        The inverse of the KKT matrix is recomputed by the next ``solve``,
+        which starts from the previous solution if its support is still
+        nonsingular.
+        """
+        self._inverse = None
+
+    def delete(self, indices):
+        """Removes constraints from the problem, as ConstraintStore.delete."""
+        if self.alpha is None:
+            return
+        indices = np.unique(np.asarray(indices, dtype=np.intp))
+        if not indices.size:
+            return
+        for i in indices[np.in1d(indices, self._support)]:
+            self._remove(self._support.index(i))
+        self.alpha = np.delete(self.alpha, indices)
+        support = np.array(self._support, dtype=np.intp)
+        self._support = (support - np.searchsorted(indices, support)).tolist()
+        if not self._support:
+            self.reset()
+
+    def _factorize(self, P):
+        # inverse of the KKT matrix [[0, 1^T], [1, P_SS]] of the support
+        support = self._support
+        kkt = np.ones((len(support) + 1, len(support) + 1))
+        kkt[0, 0] = 0
+        kkt[1:, 1:] = P[np.ix_(support, support)]
+        self._inverse = np.linalg.inv(kkt)
+        self._updates = 0
+
+    def _add(self, P, j, threshold):
+        # bordering update of the inverse; returns False if the KKT matrix
+        # of the support together with j is singular
+        b = np.hstack([1, P[self._support, j]])
+        u = np.dot(self._inverse, b)
+        schur = P[j, j] - np.dot(b, u)
+        if schur <= threshold:
+            return u
+        k = u.shape[0]
+        inverse = np.empty((k + 1, k + 1))
+        inverse[:k, :k] = self._inverse + np.outer(u, u) / schur
+        inverse[:k, k] = inverse[k, :k] = -u / schur
+        inverse[k, k] = 1. / schur
+        self._inverse = inverse
+        self._support.append(j)
+        self._updates += 1
+        return None
+
+    def _remove(self, position):
+        q = position + 1
+        column = np.delete(self._inverse[:, q], q)
+        pivot = self._inverse[q, q]
+        inverse = np.delete(np.delete(self._inverse, q, axis=0), q, axis=1)
+        self._inverse = inverse - np.outer(column, column) / pivot
+        del self._support[position]
+        self._updates += 1
+
+    def _remove_zeros(self, alpha):
+        for position in reversed(xrange(len(self._support))):
+            if alpha[self._support[position]] <= 0:
+                alpha[self._support[position]] = 0
+                self._remove(position)
+
+    def solve(self, P, losses, C):
+        """Solves the QP, starting from the previous solution.
+
+        Parameters
+        ----------
+        P : nd-array, shape=(n, n)
+            Gram matrix of the constraints. The first rows must be the
+            constraints of the previous call, after ``delete``.
+
+        losses : nd-array, shape=(n,)
+
+        C : float
+
+        Returns
+        -------
+        alpha : nd-array, shape=(n,)
+
+        objective : float
+
+        converged : bool
+            False if max_iter support changes did not reach the optimum.
+        """
+        P = np.asarray(P, dtype=np.float64)
+        losses = np.asarray(losses, dtype=np.float64)
+        n = losses.shape[0]
+        max_iter = self.max_iter
+        if max_iter is None:
+            max_iter = 10 * n + 100
+        if self.alpha is not None and self._inverse is None:
+            try:
+                self._factorize(P)
+            except np.linalg.LinAlgError:
+                self.reset()
+        diag = np.diag(P)
+        scale = np.max(np.abs(losses)) + C * np.max(diag)
+        gtol = self.tol * scale
+        threshold = 1e-10 * max(np.max(diag), 1e-300)
+
+        if self.alpha is None or self.alpha.shape[0] > n:
+            # start from the best single constraint
+            alpha = np.zeros(n)
+            i = np.argmax(losses - 0.5 * C * diag)
+            alpha[i] = C
+            self._support = [i]
+            self._factorize(P)
+        else:
+            alpha = np.zeros(n)
+            alpha[:self.alpha.shape[0]] = self.alpha
+            alpha *= C / np.sum(alpha)
+
+        converged = False
+        for n_iter in xrange(max_iter):
+            if self._updates >= self.refactor_every:
+                self._factorize(P)
+            support = np.array(self._support)
+            solution = np.dot(self._inverse, np.hstack([C, losses[support]]))
+            level, a = -solution[0], solution[1:]
+
+            if np.all(a > 0):
+                alpha[support] = a
+                grad = np.dot(P[:, support], a) - losses
+                grad[support] = np.inf
+                j = np.argmin(grad)
+                if grad[j] >= level - gtol:
+                    converged = True
+                    break
+                u = self._add(P, j, threshold)
+                while u is not None:
+                    # j and the support are affinely dependent: moving
+                    # weight to j along u does not change the curvature and
+                    # decreases the objective, until a coefficient is zero
+                    support = np.array(self._support)
+                    direction = -u[1:]
+                    blocking = direction < 0
+                    ratios = alpha[support][blocking] / -direction[blocking]
+                    t = np.min(ratios)
+                    alpha[support] += t * direction
+                    alpha[j] += t
+                    alpha[support[blocking][ratios <= t]] = 0
+                    self._remove_zeros(alpha)
+                    u = self._add(P, j, threshold)
+                continue
+
+            # step towards the solution on the support until a coefficient
+            # drops to zero
+            current = alpha[support]
+            direction = a - current
+            blocking = a <= 0
+            ratios = current[blocking] / -direction[blocking]
+            t = np.min(ratios)
+            alpha[support] = np.maximum(current + t * direction, 0)
+            alpha[support[blocking][ratios <= t]] = 0
+            self._remove_zeros(alpha)
+
+        alpha *= C / np.sum(alpha)
+        self.alpha = alpha.copy()
+        objective = 0.5 * np.dot(alpha, np.dot(P, alpha)) - np.dot(losses,
+                                                                   alpha)
+        return alpha, objective, converged
+
+
+def _fingerprint(djoint_feature, loss):
+    # adding zero turns -0. into 0., so that equal vectors hash equally
+    djoint_feature = np.ascontiguousarray(djoint_feature, dtype=np.float64)
+    return hashlib.sha1((djoint_feature + 0.).tobytes()
+                        + np.float64(loss + 0.).tobytes()).digest()
+
+
+class ConstraintStore(object):
+    """Cutting planes of the 1-slack QP together with their Gram matrix.
+
+    The joint feature vectors are rows of a preallocated array that grows
+    by doubling. The Gram matrix is updated with every change: appending a
+    constraint computes one row of dot products and deleting constraints
+    compacts rows and columns in place. Iterating yields
+    (djoint_feature, loss) pairs like the list of tuples it replaces.
+
+    Constraints are indexed by a hash of their joint feature vector and
+    loss, so ``(djoint_feature, loss) in store`` compares vectors only on a
+    hash hit.
+
+    The joint feature vectors can be stored in a smaller dtype or as sparse
+    rows. The Gram matrix and the products with w and with the dual
+    variables are computed in float64 from the stored values.
+
+    Parameters
+    ----------
+    size_joint_feature : int
+        Length of the joint feature vectors.
+
+    capacity : int, default=16
+        Number of constraints to allocate space for initially.
+
+    dtype : numpy dtype, default=np.float64
+        Type of the stored joint feature vectors.
+
+    sparse : bool, default=False
+        Whether to store the joint feature vectors as sparse rows.
+    """
+
+    # rows converted to float64 at once by dot and combine
+    chunk_size = 256
+
+    def __init__(self, size_joint_feature, capacity=16, dtype=np.float64,
+                 sparse=False):
+        self.n_constraints = 0
+        self.size_joint_feature = size_joint_feature
+        self.dtype = np.dtype(dtype)
+        self.sparse = sparse
+        if sparse:
+            self._rows = []
+            self._matrix = None
+        else:
+            self._joint_features = np.zeros((capacity, size_joint_feature),
+                                            dtype=self.dtype)
+        self._losses = np.zeros(capacity)
+        self._gram = np.zeros((capacity, capacity))
+        self._fingerprints = []
+        self._index = {}
+
+    @property
+    def joint_features(self):
+        """Stored joint feature vectors, a csr matrix if sparse."""
+        if not self.sparse:
+            return self._joint_features[:self.n_constraints]
+        if self._matrix is None:
+            if self._rows:
+                self._matrix = sps.vstack(self._rows, format='csr')
+            else:
+                self._matrix = sps.csr_matrix((0, self.size_joint_feature),
+                                              dtype=self.dtype)
+        return self._matrix
+
+    @property
+    def losses(self):
+        return self._losses[:self.n_constraints]
+
+    @property
+    def gram(self):
+        return self._gram[:self.n_constraints, :self.n_constraints]
+
+    def dot(self, w):
+        """Returns joint_features times w, in float64."""
+        w = np.asarray(w, dtype=np.float64)
+        if self.sparse:
+            return np.asarray(self.joint_features.dot(w), dtype=np.float64)
+        if self.dtype == np.float64:
+            return np.dot(self.joint_features, w)
+        result = np.zeros(self.n_constraints)
+        for start in xrange(0, self.n_constraints, self.chunk_size):
+            stop = start + self.chunk_size
+            result[start:stop] = np.dot(
+                self._joint_features[start:min(stop, self.n_constraints)]
+                .astype(np.float64), w)
+        return result
+
+    def combine(self, a):
+        """Returns a times joint_features, in float64."""
+        a = np.asarray(a, dtype=np.float64)
+        if self.sparse:
+            return np.asarray(self.joint_features.T.dot(a), dtype=np.float64)
+        if self.dtype == np.float64:
+            return np.dot(a, self.joint_features)
+        result = np.zeros(self.size_joint_feature)
+        for start in xrange(0, self.n_constraints, self.chunk_size):
+            stop = min(start + self.chunk_size, self.n_constraints)
+            result += np.dot(a[start:stop], self._joint_features[start:stop]
+                             .astype(np.float64))
+        return result
+
+    def dense(self):
+        """Returns the joint feature vectors as a float64 array."""
+        if self.sparse:
+            return self.joint_features.toarray().astype(np.float64)
+        return self.joint_features.astype(np.float64)
+
+    def _row(self, i):
+        if self.sparse:
+            return self._rows[i].toarray().ravel().astype(np.float64)
+        if self.dtype == np.float64:
+            return self._joint_features[i]
+        return self._joint_features[i].astype(np.float64)
+
+    def _stored(self, djoint_feature):
+        # djoint_feature as it reads after storing, in float64
+        return np.asarray(djoint_feature, dtype=self.dtype).astype(np.float64)
+
+    def _grow(self):
+        n = self.n_constraints
+        capacity = max(2 * self._losses.shape[0], 1)
+        if not self.sparse:
+            joint_features = np.zeros((capacity, self.size_joint_feature),
+                                      dtype=self.dtype)
+            joint_features[:n] = self.joint_features
+            self._joint_features = joint_features
+        losses = np.zeros(capacity)
+        losses[:n] = self.losses
+        gram = np.zeros((capacity, capacity))
+        gram[:n, :n] = self.gram
+        self._losses, self._gram = losses, gram
+
+    def append(self, constraint):
+        djoint_feature, loss = constraint
+        n = self.n_constraints
+        if n == self._losses.shape[0]:
+            self._grow()
+        if self.sparse:
+            self._rows.append(sps.csr_matrix(
+                np.asarray(djoint_feature, dtype=self.dtype).reshape(1, -1)))
+            self._matrix = None
+        else:
+            self._joint_features[n] = djoint_feature
+        self._losses[n] = loss
+        self.n_constraints += 1
+        row = self._row(n)
+        dots = self.dot(row)
+        self._gram[n, :n + 1] = dots
+        self._gram[:n + 1, n] = dots
+        fingerprint = _fingerprint(row, self._losses[n])
+        self._fingerprints.append(fingerprint)
+        self._index.setdefault(fingerprint, []).append(n)
+
+    def find(self, constraint):
+        """Returns the index of an equal constraint, or None."""
+        djoint_feature, loss = constraint
+        djoint_feature = self._stored(djoint_feature)
+        for i in self._index.get(_fingerprint(djoint_feature, loss), []):
+            if (np.all(self._row(i) == djoint_feature)
+                    and self._losses[i] == loss):
+                return i
+        return None
+
+    def __contains__(self, constraint):
+        return self.find(constraint) is not None
+
+    def delete(self, indices):
+        """Removes the constraints with the given indices in place."""
+        keep = np.ones(self.n_constraints, dtype=np.bool)
+        keep[indices] = False
+        m = np.sum(keep)
+        if self.sparse:
+            self._rows = [row for row, k in zip(self._rows, keep) if k]
+            self._matrix = None
+        else:
+            self._joint_features[:m] = self.joint_features[keep]
+        self._losses[:m] = self.losses[keep]
+        self._gram[:m, :m] = self.gram[np.ix_(keep, keep)]
+        self.n_constraints = m
+        self._fingerprints = [fingerprint for fingerprint, k
+                              in zip(self._fingerprints, keep) if k]
+        self._index = {}
+        for i, fingerprint in enumerate(self._fingerprints):
+            self._index.setdefault(fingerprint, []).append(i)
+
+    def shift(self, offset, start=1):
+        """Adds offset to the joint feature vectors from index start on.
+
+        The Gram matrix is recomputed from the stored values.
+        """
+        n = self.n_constraints
+        offset = np.asarray(offset, dtype=np.float64)
+        for i in xrange(start, n):
+            row = self._row(i) + offset
+            if self.sparse:
+                self._rows[i] = sps.csr_matrix(
+                    row.astype(self.dtype).reshape(1, -1))
+            else:
+                self._joint_features[i] = row
+        self._matrix = None
+        gram = np.array([self.dot(self._row(i)) for i in xrange(n)])
+        gram = gram.reshape(n, n)
+        # both halves from the same products, the QP wants it symmetric
+        gram = np.triu(gram) + np.triu(gram, 1).T
+        self._gram[:n, :n] = gram
+        self._fingerprints = [_fingerprint(self._row(i), self._losses[i])
+                              for i in xrange(n)]
+        self._index = {}
+        for i, fingerprint in enumerate(self._fingerprints):
+            self._index.setdefault(fingerprint, []).append(i)
+
+    def __len__(self):
+        return self.n_constraints
+
+    def __getitem__(self, i):
+        i = xrange(self.n_constraints)[i]
+        return self._row(i), self._losses[i]
+
+    def __delitem__(self, i):
+        self.delete([xrange(self.n_constraints)[i]])
+
+    def __iter__(self):
+        for i in xrange(self.n_constraints):
+            yield self._row(i), self._losses[i]
+
+    def __getstate__(self):
+        # only the used part of the buffers is pickled
+        state = self.__dict__.copy()
+        if self.sparse:
+            state['_matrix'] = None
+        else:
+            state['_joint_features'] = self.joint_features.copy()
+        state['_losses'] = self.losses.copy()
+        state['_gram'] = self.gram.copy()
+        return state
+
+
+def _label_parts(y):
+    # arrays that determine a labeling: y.full of a Label, the marginals of
+    # a relaxed labeling or y itself
+    full = getattr(y, 'full', y)
+    if isinstance(full, tuple):
+        return [np.ascontiguousarray(part, dtype=np.float64) + 0.
+                for part in full]
+    return [np.ascontiguousarray(full, dtype=np.int64)]
+
+
+def _label_fingerprint(parts):
+    fingerprint = hashlib.sha1()
+    for part in parts:
+        fingerprint.update(str(part.shape))
+        fingerprint.update(part.tobytes())
+    return fingerprint.digest()
+
+
+class InferenceCache(object):
+    """Results of loss augmented inference of every sample.
+
+    Joint feature vectors are stored in one (n_samples, cache_size,
+    size_joint_feature) array, in memory or memory mapped from a file, and
+    every sample is a ring buffer that evicts its oldest labeling first.
+    Labelings are recognized by a hash, so a labeling that is already
+    cached is not stored again.
+
+    Parameters
+    ----------
+    n_samples : int
+
+    size_joint_feature : int
+
+    cache_size : int
+        Number of labelings to cache per sample.
+
+    dtype : numpy dtype, default=np.float64
+        Type of the stored joint feature vectors.
+
+    max_memory : int or None, default=None
+        Upper bound in bytes for the joint feature vectors; cache_size is
+        reduced to fit, possibly to zero.
+
+    filename : string or None, default=None
+        If given, the joint feature vectors are memory mapped from this
+        file.
+    """
+
+    def __init__(self, n_samples, size_joint_feature, cache_size,
+                 dtype=np.float64, max_memory=None, filename=None):
+        dtype = np.dtype(dtype)
+        if max_memory is not None:
+            per_slot = n_samples * size_joint_feature * dtype.itemsize
+            cache_size = min(cache_size, int(max_memory // max(per_slot, 1)))
+        self.cache_size = cache_size
+
+        shape = (n_samples, cache_size, size_joint_feature)
+        if filename is not None and cache_size > 0:
+            self.joint_features = np.memmap(filename, dtype=dtype, mode='w+',
+                                            shape=shape)
+        else:
+            self.joint_features = np.zeros(shape, dtype=dtype)
+        self.losses = np.zeros((n_samples, cache_size))
+        self.labels = [[None] * cache_size for i in xrange(n_samples)]
+        self.n_cached = np.zeros(n_samples, dtype=np.int64)
+        # slot of the oldest labeling of every sample
+        self.start = np.zeros(n_samples, dtype=np.int64)
+        self._fingerprints = [{} for i in xrange(n_samples)]
+
+    def __contains__(self, item):
+        sample, y = item
+        parts = _label_parts(y)
+        slot = self._fingerprints[sample].get(_label_fingerprint(parts))
+        if slot is None:
+            return False
+        cached = _label_parts(self.labels[sample][slot])
+        return (len(cached) == len(parts)
+                and all(np.array_equal(a, b) for a, b in zip(cached, parts)))
+
+    def add(self, sample, joint_feature, loss, y):
+        """Caches a labeling, replacing the oldest if the sample is full."""
+        if self.cache_size == 0:
+            return
+        fingerprints = self._fingerprints[sample]
+        if self.n_cached[sample] < self.cache_size:
+            slot = self.n_cached[sample]
+            self.n_cached[sample] += 1
+        else:
+            slot = self.start[sample]
+            self.start[sample] = (slot + 1) % self.cache_size
+            old = _label_fingerprint(_label_parts(self.labels[sample][slot]))
+            if fingerprints.get(old) == slot:
+                del fingerprints[old]
+        self.joint_features[sample, slot] = joint_feature
+        self.losses[sample, slot] = loss
+        self.labels[sample][slot] = y
+        fingerprints[_label_fingerprint(_label_parts(y))] = slot
+
+    def most_violated(self, w):
+        """Returns the most violating cached labeling of every sample.
+
+        Violations of all cached labelings are computed in one product; ties
+        go to the oldest labeling.
+
+        Returns
+        -------
+        Y_hat : list
+            Labelings, one per sample.
+
+        joint_feature : nd-array, shape=(size_joint_feature,)
+            Sum of their joint feature vectors.
+
+        loss : float
+            Sum of their losses.
+        """
+        n_samples = self.n_cached.shape[0]
+        w = np.asarray(w, dtype=self.joint_features.dtype)
+        violations = np.dot(self.joint_features, w) + self.losses
+        # slots of every sample from the oldest to the newest
+        order = np.arange(self.cache_size)
+        slots = (self.start[:, np.newaxis] + order) % self.cache_size
+        samples = np.arange(n_samples)[:, np.newaxis]
+        violations = np.where(order < self.n_cached[:, np.newaxis],
+                              violations[samples, slots], -np.inf)
+        best = slots[np.arange(n_samples), np.argmax(violations, axis=1)]
+
+        Y_hat = [labels[slot] for labels, slot in zip(self.labels, best)]
+        joint_feature = np.sum(self.joint_features[np.arange(n_samples), best],
+                               axis=0, dtype=np.float64)
+        loss = np.sum(self.losses[np.arange(n_samples), best])
+        return Y_hat, joint_feature, loss
+
+    def __getstate__(self):
+        # memory mapped caches are pickled as plain arrays
+        state = self.__dict__.copy()
+        state['joint_features'] = np.array(self.joint_features)
+        return state
+
+
+class LazyInference(object):
+    """Last loss augmented inference result of every sample.
+
+    If y_old maximized the loss augmented score of a sample at w_old, its
+    violation at w = w_old + dw is at most
+    max_y dw . joint_feature(x, y) - dw . joint_feature(x, y_old)
+    below the one of the best labeling at w. Samples whose labeling is
+    reused are chosen such that the mean of these gaps over all samples,
+    and with it the error in the violation of the 1-slack constraint,
+    stays below a tolerance.
+
+    Parameters
+    ----------
+    n_samples : int
+        Number of training samples.
+
+    size_joint_feature : int
+        Length of the joint feature vectors.
+    """
+
+    def __init__(self, n_samples, size_joint_feature):
+        self.Y_hat = [None] * n_samples
+        self.joint_features = np.zeros((n_samples, size_joint_feature))
+        self.losses = np.zeros(n_samples)
+        # w the labeling of a sample was found at, by snapshot number;
+        # -1 if the sample has no labeling
+        self.origin = -np.ones(n_samples, dtype=np.intp)
+        self._snapshots = {}
+        self._n_snapshots = 0
+
+    def stale(self, w, tol, score_bound):
+        """Indices of the samples that need inference at w.
+
+        score_bound(i, dw) is an upper bound on dw . joint_feature(x_i, y)
+        over all y, see HCRF.score_bound.
+        """
+        n_samples = self.origin.shape[0]
+        gaps = np.empty(n_samples)
+        gaps.fill(np.inf)
+        for key, w_old in self._snapshots.items():
+            dw = w - w_old
+            for i in np.where(self.origin == key)[0]:
+                gaps[i] = score_bound(i, dw) - np.dot(dw,
+                                                      self.joint_features[i])
+        # reuse the labelings with the smallest gaps
+        order = np.argsort(gaps, kind='mergesort')
+        mean_gap = np.cumsum(np.maximum(gaps[order], 0)) / n_samples
+        n_reused = np.searchsorted(mean_gap, tol, side='right')
+        return np.sort(order[n_reused:])
+
+    def update(self, indices, w, Y_hat, joint_features, losses):
+        if not len(indices):
+            return
+        key = self._n_snapshots
+        self._n_snapshots += 1
+        self._snapshots[key] = w.copy()
+        for i, y_hat in zip(indices, Y_hat):
+            self.Y_hat[i] = y_hat
+        self.joint_features[indices] = joint_features
+        self.losses[indices] = losses
+        self.origin[indices] = key
+        # drop the snapshots no sample refers to anymore
+        used = set(np.unique(self.origin).tolist())
+        for key in list(self._snapshots):
+            if key not in used:
+                del self._snapshots[key]
+
+    def invalidate(self):
+        self.origin.fill(-1)
+        self._snapshots = {}
+
+
 class OneSlackSSVM(BaseSSVM):
     """Structured SVM solver for the 1-slack QP with l1 slack penalty.
 
     Implements margin rescaled structural SVM using
-    the 1-slack formulation and cutting plane method, solved using CVXOPT.
-    The optimization is restarted in each iteration.
+    the 1-slack formulation and cutting plane method. The dual QP is solved
+    by an active set method started from the previous solution, or by CVXOPT
+    (see ``qp_solver``), in which case it is restarted in each iteration.
 
     Parameters
     ----------
@@ -85,6 +784,17 @@ class OneSlackSSVM(BaseSSVM):
         If None, ``tol`` will be used. Higher values might lead to faster
         learning.
 
+    cache_dtype : numpy dtype, default=np.float64
+        Type of the joint feature vectors in the inference cache. float32
+        halves its memory.
+
+    cache_max_memory : int or None, default=None
+        Upper bound in bytes for the inference cache. The number of cached
+        results per sample is reduced to fit.
+
+    cache_file : string or None, default=None
+        If given, the inference cache is memory mapped from this file.
+
     inactive_threshold : float, default=1e-5
         Threshold for dual variable of a constraint to be considered inactive.
 
@@ -101,6 +811,42 @@ class OneSlackSSVM(BaseSSVM):
         Pystruct logger for storing the model or extracting additional
         information.
 
+    qp_solver : string, default='active_set'
+        Solver for the dual QP. 'active_set' solves it over the scaled
+        simplex and starts from the previous solution, 'cvxopt' uses the
+        interior point method of cvxopt. With negativity_constraint, or if
+        the active set method does not converge, cvxopt is used.
+
+    lazy_tol : float or None, default=None
+        If given, samples keep their last labeling as long as the violation
+        of the constraint is guaranteed to be within lazy_tol of the one
+        from inference on all samples, see LazyInference. The model needs
+        a ``score_bound(x, w)`` method. If the resulting constraint is not
+        violated enough, inference is rerun on all samples before
+        stopping.
+
+    exact_objective : bool, default=False
+        Whether the final primal objective is recomputed by integral loss
+        augmented inference on all samples. Otherwise it is taken from the
+        last (relaxed) inference pass, if that pass ran at the final w,
+        which is the case when training converged.
+
+    n_planes : int, default=1
+        Cutting planes per inference sweep. After a sweep, up to
+        n_planes - 1 further constraints are built from the inference cache
+        at the updated w, as long as they are violated enough, without the
+        gap test of cache_tol='auto'. The cache holds at least n_planes - 1
+        labelings per sample, also with inference_cache=0.
+
+    constraint_dtype : numpy dtype, default=np.float64
+        Type of the stored cutting planes and of ``w_history``. float32
+        halves their memory; the Gram matrix, w and all products with the
+        planes are still computed in float64.
+
+    sparse_constraints : bool, default=False
+        Whether to store the cutting planes as sparse rows, which saves
+        memory if the features are sparse.
+
     Attributes
     ----------
     w : nd-array, shape=(model.size_joint_feature,)
@@ -121,6 +867,14 @@ class OneSlackSSVM(BaseSSVM):
     ``timestamps_`` : list of int
        Total training time stored before each iteration.
 
+    ``skipped_inference_calls_`` : list of int
+       Number of samples without inference, for every iteration that ran
+       inference.
+
+    ``planes_per_sweep_`` : list of int
+       Number of cutting planes from every inference sweep, including the
+       ones from the cache that followed it; 0 if it found no constraint.
+
     """
 
     def __init__(self, model, max_iter=10000, C=1.0, check_constraints=False,
@@ -128,7 +882,11 @@ class OneSlackSSVM(BaseSSVM):
                  break_on_bad=False, show_loss_every=0, tol=1e-3,
                  inference_cache=0, inactive_threshold=1e-5,
                  inactive_window=50, logger=None, cache_tol='auto',
-                 switch_to=None):
+                 switch_to=None, qp_solver='active_set',
+                 cache_dtype=np.float64, cache_max_memory=None,
+                 cache_file=None, lazy_tol=None, exact_objective=False,
+                 n_planes=1, constraint_dtype=np.float64,
+                 sparse_constraints=False):
 
         BaseSSVM.__init__(self, model, max_iter, C, verbose=verbose,
                           n_jobs=n_jobs, show_loss_every=show_loss_every,
@@ -143,35 +901,38 @@ class OneSlackSSVM(BaseSSVM):
         self.inactive_threshold = inactive_threshold
         self.inactive_window = inactive_window
         self.switch_to = switch_to
+        self.qp_solver = qp_solver
+        self.cache_dtype = cache_dtype
+        self.cache_max_memory = cache_max_memory
+        self.cache_file = cache_file
+        self.lazy_tol = lazy_tol
+        self.exact_objective = exact_objective
+        self.n_planes = n_planes
+        self.constraint_dtype = constraint_dtype
+        self.sparse_constraints = sparse_constraints
         self.qp_time = 0
         self.inference_time = 0
         self.inference_calls = 0
         self.iterations_done = 0
 
-    def _solve_1_slack_qp(self, constraints, n_samples):
-        C = np.float(self.C) * n_samples  # this is how libsvm/svmstruct do it
-        joint_features = [c[0] for c in constraints]
-        losses = [c[1] for c in constraints]
-
-        joint_feature_matrix = np.vstack(joint_features)
-        n_constraints = len(joint_features)
-        P = cvxopt.matrix(np.dot(joint_feature_matrix, joint_feature_matrix.T))
+    def _solve_qp_cvxopt(self, constraints, C):
+        P = cvxopt.matrix(np.ascontiguousarray(constraints.gram))
+        n_constraints = len(constraints)
         # q contains loss from margin-rescaling
-        q = cvxopt.matrix(-np.array(losses, dtype=np.float))
+        q = cvxopt.matrix(-np.array(constraints.losses, dtype=np.float))
         # constraints: all alpha must be >zero
-        idy = np.identity(n_constraints)
+        idy = cvxopt.spmatrix(-1.0, range(n_constraints), range(n_constraints))
         tmp1 = np.zeros(n_constraints)
         # positivity constraints:
         if self.negativity_constraint is None:
-            #empty constraints
+            G = idy
             zero_constr = np.zeros(0)
-            joint_features_constr = np.zeros((0, n_constraints))
         else:
-            joint_features_constr = joint_feature_matrix.T[self.negativity_constraint]
+            joint_features_constr = \
+                constraints.dense().T[self.negativity_constraint]
+            G = cvxopt.sparse([idy, cvxopt.matrix(joint_features_constr)])
             zero_constr = np.zeros(len(self.negativity_constraint))
 
-        # put together
-        G = cvxopt.sparse(cvxopt.matrix(np.vstack((-idy, joint_features_constr))))
         h = cvxopt.matrix(np.hstack((tmp1, zero_constr)))
 
         # equality constraint: sum of all alpha must be = C
@@ -180,39 +941,57 @@ class OneSlackSSVM(BaseSSVM):
 
         # solve QP model
         cvxopt.solvers.options['feastol'] = 1e-5
-        #if hasattr(self, 'old_solution'):
-            #s = self.old_solution['s']
-            ## put s slightly inside the cone..
-            #s = cvxopt.matrix(np.vstack([s, [[1e-10]]]))
-            #z = self.old_solution['z']
-            #z = cvxopt.matrix(np.vstack([z, [[1e-10]]]))
-            #initvals = {'x': self.old_solution['x'], 'y':
-                        #self.old_solution['y'], 'z': z,
-                        #'s': s}
-        #else:
-            #initvals = {}
-        #solution = cvxopt.solvers.qp(P, q, G, h, A, b, initvals=initvals)
-
-#        import mosek
-#        cvxopt.solvers.options['MOSEK'] = {mosek.iparam.log: 0}
 
-        start_time = time()
         try:
-            solution = cvxopt.solvers.qp(P, q, G, h, A, b)#, solver='mosek')
+            solution = cvxopt.solvers.qp(P, q, G, h, A, b)
         except ValueError:
             solution = {'status': 'error'}
         if solution['status'] != "optimal":
             print("regularizing QP!")
-            P = cvxopt.matrix(np.dot(joint_feature_matrix, joint_feature_matrix.T)
-                              + 1e-8 * np.eye(joint_feature_matrix.shape[0]))
-            solution = cvxopt.solvers.qp(P, q, G, h, A, b)#, solver='mosek')
+            P = cvxopt.matrix(constraints.gram + 1e-8 * np.eye(n_constraints))
+            solution = cvxopt.solvers.qp(P, q, G, h, A, b)
             if solution['status'] != "optimal":
                 raise ValueError("QP solver failed. Try regularizing your QP.")
+        self.old_solution = solution
+        return np.ravel(solution['x']), solution['primal objective']
+
+    def _solve_qp_active_set(self, constraints, C):
+        # the solver keeps the last dual solution, the new constraint starts
+        # with zero weight
+        if getattr(self, '_simplex_qp', None) is None:
+            self._simplex_qp = SimplexQP()
+        a, objective, converged = self._simplex_qp.solve(constraints.gram,
+                                                         constraints.losses,
+                                                         C)
+        if not converged:
+            # degenerate support, leave it to the interior point method
+            if self.verbose > 1:
+                print("active set QP did not converge, using cvxopt")
+            self._simplex_qp.reset()
+            return self._solve_qp_cvxopt(constraints, C)
+        self.old_solution = {'x': a, 'primal objective': objective,
+                             'status': 'optimal'}
+        return a, objective
+
+    def _solve_1_slack_qp(self, constraints, n_samples):
+        C = np.float(self.C) * n_samples  # this is how libsvm/svmstruct do it
+        # constraints is a ConstraintStore, the Gram matrix is up to date
+        n_constraints = len(constraints)
+
+        start_time = time()
+        if (self.qp_solver == 'active_set'
+                and self.negativity_constraint is None):
+            a, primal_objective = self._solve_qp_active_set(constraints, C)
+        elif self.qp_solver in ['active_set', 'cvxopt']:
+            # the negativity constraints do not fit the simplex solver
+            a, primal_objective = self._solve_qp_cvxopt(constraints, C)
+        else:
+            raise ValueError("Unknown qp_solver: %s" % self.qp_solver)
         self.qp_time += time() - start_time
 
         # Lagrange multipliers
-        a = np.ravel(solution['x'])
-        self.old_solution = solution
+        # pruning compacts the store in place, compute w before
+        self.w = constraints.combine(a)
         self.prune_constraints(constraints, a)
 
         # Support vectors have non zero lagrange multipliers
@@ -220,10 +999,9 @@ class OneSlackSSVM(BaseSSVM):
         if self.verbose > 1:
             print("%d support vectors out of %d points" % (np.sum(sv),
                                                            n_constraints))
-        self.w = np.dot(a, joint_feature_matrix)
         # we needed to flip the sign to make the dual into a minimization
         # model
-        return -solution['primal objective']
+        return -primal_objective
 
     def prune_constraints(self, constraints, a):
         # append list for new constraint
@@ -242,10 +1020,15 @@ class OneSlackSSVM(BaseSSVM):
             strongest = np.max(max_active[1:])
             inactive = np.where(max_active
                                 < self.inactive_threshold * strongest)[0]
+            # the ground truth constraint is kept, rescoring moves all
+            # others to a new ground truth
+            inactive = inactive[inactive != 0]
 
+            constraints.delete(inactive)
+            if getattr(self, '_simplex_qp', None) is not None:
+                self._simplex_qp.delete(inactive)
             for idx in reversed(inactive):
                 # if we don't reverse, we'll mess the indices up
-                del constraints[idx]
                 del self.alphas[idx]
 
     def _check_bad_constraint(self, violation, djoint_feature_mean, loss,
@@ -263,77 +1046,78 @@ class OneSlackSSVM(BaseSSVM):
             if self.verbose:
                 print("new constraint too weak.")
             return True
-        equals = [True for djoint_feature_, loss_ in old_constraints
-                  if (np.all(djoint_feature_ == djoint_feature_mean) and loss == loss_)]
-
-        if np.any(equals):
+        if (djoint_feature_mean, loss) in old_constraints:
             return True
 
         if self.check_constraints:
-            for con in old_constraints:
-                # compute violation for old constraint
-                violation_tmp = max(con[1] - np.dot(self.w, con[0]), 0)
-                if self.verbose > 5:
+            # violations of all old constraints in one product
+            violations = np.maximum(
+                old_constraints.losses - old_constraints.dot(self.w), 0)
+            if self.verbose > 5:
+                for violation_tmp in violations:
                     print("violation old constraint: %f" % violation_tmp)
-                # if violation of new constraint is smaller or not
-                # significantly larger, don't add constraint.
-                # if smaller, complain about approximate inference.
-                if violation - violation_tmp < -1e-5:
-                    print("bad inference: %f" % (violation_tmp - violation))
-                    if break_on_bad:
-                        raise ValueError("Bad inference: new violation is"
-                                         " weaker than previous constraint.")
-                    return True
+            # if violation of new constraint is smaller or not
+            # significantly larger, don't add constraint.
+            # if smaller, complain about approximate inference.
+            weaker = np.where(violation - violations < -1e-5)[0]
+            if weaker.shape[0]:
+                print("bad inference: %f"
+                      % (violations[weaker[0]] - violation))
+                if break_on_bad:
+                    raise ValueError("Bad inference: new violation is"
+                                     " weaker than previous constraint.")
+                return True
         return False
 
+    def _inference_cache_size(self):
+        # the cache also feeds the additional planes of n_planes
+        return max(self.inference_cache, self.n_planes - 1)
+
     def _update_cache(self, X, Y, Y_hat):
         """Updated cached constraints."""
-        if self.inference_cache == 0:
+        if self._inference_cache_size() == 0:
             return
         if (not hasattr(self, "inference_cache_")
                 or self.inference_cache_ is None):
-            self.inference_cache_ = [[] for y in Y_hat]
-
-        for sample, x, y, y_hat in zip(self.inference_cache_, X, Y, Y_hat):
-            already_there = [y_hat == cache[2] for cache in sample]
-            if np.any(already_there):
+            # the cache keeps inference_cache + 1 labelings per sample, as
+            # the list based cache it replaces
+            self.inference_cache_ = InferenceCache(
+                len(Y_hat), self.model.size_joint_feature,
+                self._inference_cache_size() + 1, dtype=self.cache_dtype,
+                max_memory=self.cache_max_memory, filename=self.cache_file)
+            if self.verbose and self.inference_cache_.cache_size == 0:
+                print("Inference cache does not fit in cache_max_memory.")
+
+        for sample, (x, y, y_hat) in enumerate(zip(X, Y, Y_hat)):
+            if (sample, y_hat) in self.inference_cache_:
                 continue
-            if len(sample) > self.inference_cache:
-                sample.pop(0)
             # we computed both of these before, but summed them up immediately
             # this makes it a little less efficient in the caching case.
             # the idea is that if we cache, inference is way more expensive
             # and this doesn't matter much.
-            sample.append((self.model.joint_feature(x, y_hat),
-                           self.model.loss(y, y_hat), y_hat))
+            self.inference_cache_.add(sample,
+                                      self.model.joint_feature(x, y_hat),
+                                      self.model.loss(y, y_hat), y_hat)
 
     def _constraint_from_cache(self, X, Y, joint_feature_gt, constraints):
-        if self.inference_cache == 0:
+        if self._inference_cache_size() == 0:
             raise NoConstraint
-        if (not getattr(self, 'inference_cache_', False) or
-                self.inference_cache_ is False):
+        if (getattr(self, 'inference_cache_', None) is None
+                or self.inference_cache_.cache_size == 0):
             if self.verbose > 10:
                 print("Empty cache.")
             raise NoConstraint
         gap = self.primal_objective_curve_[-1] - self.objective_curve_[-1]
-        if (self.cache_tol == 'auto' and gap < self.cache_tol_):
+        if (self.cache_tol == 'auto' and gap < self.cache_tol_
+                and self._planes_left == 0):
             # do inference if gap has become to small
             if self.verbose > 1:
                 print("Last gap too small (%f < %f), not loading constraint from cache."
                       % (gap, self.cache_tol_))
             raise NoConstraint
 
-        Y_hat = []
-        joint_feature_acc = np.zeros(self.model.size_joint_feature)
-        loss_mean = 0
-        for cached in self.inference_cache_:
-            # cached has entries of form (joint_feature, loss, y_hat)
-            violations = [np.dot(joint_feature, self.w) + loss
-                          for joint_feature, loss, _ in cached]
-            joint_feature, loss, y_hat = cached[np.argmax(violations)]
-            Y_hat.append(y_hat)
-            joint_feature_acc += joint_feature
-            loss_mean += loss
+        Y_hat, joint_feature_acc, loss_mean = \
+            self.inference_cache_.most_violated(self.w)
 
         djoint_feature = (joint_feature_gt - joint_feature_acc) / len(X)
         loss_mean = loss_mean / len(X)
@@ -346,36 +1130,161 @@ class OneSlackSSVM(BaseSSVM):
             raise NoConstraint
         return Y_hat, djoint_feature, loss_mean
 
-    def _find_new_constraint(self, X, Y, joint_feature_gt, constraints, check=True):
+    def _start_pool(self, X, Y):
+        # long-lived workers get the model and the data once, every
+        # iteration only sends w and sample indices
+        self._n_workers = n_workers(self.n_jobs)
+        self._pool = multiprocessing.Pool(self._n_workers,
+                                          _init_inference_worker,
+                                          (self.model, X, Y))
+        self._scheduler = CostScheduler(X, Y)
+
+    def _stop_pool(self):
+        if getattr(self, '_pool', None) is not None:
+            self._pool.terminate()
+            self._pool.join()
+        self._pool = None
+
+    def __getstate__(self):
+        # the worker pool only lives during fit
+        state = self.__dict__.copy()
+        state.pop('_pool', None)
+        return state
+
+    def _loss_augmented_inference(self, X, Y, indices=None):
+        # relaxed loss augmented inference at the current w on all samples
+        # or the given indices, in that order
         start_time = time()
-        if self.n_jobs != 1:
+        if indices is None:
+            indices = np.arange(len(X))
+        if not len(indices):
+            return []
+        if self.n_jobs != 1 and getattr(self, '_pool', None) is not None:
+            # a few chunks of similar cost per worker, the most expensive
+            # are dispatched first
+            chunks = self._scheduler.chunks(4 * self._n_workers, indices)
+            results = self._pool.map(_inference_worker, [
+                (chunk, self.w, self.model.inference_method)
+                for chunk in chunks], chunksize=1)
+            Y_hat = {}
+            for chunk, (chunk_Y_hat, times) in zip(chunks, results):
+                self._scheduler.record(chunk, times)
+                Y_hat.update(zip(chunk, chunk_Y_hat))
+            Y_hat = [Y_hat[i] for i in indices]
+        elif self.n_jobs != 1:
             # do inference in parallel
             verbose = max(0, self.verbose - 3)
             Y_hat = Parallel(n_jobs=self.n_jobs, verbose=verbose, max_nbytes=1e8)(
                 delayed(loss_augmented_inference)(
-                    self.model, x, y, self.w, relaxed=True)
-                for x, y in zip(X, Y))
-        else:
+                    self.model, X[i], Y[i], self.w, relaxed=True)
+                for i in indices)
+        elif len(indices) == len(X):
             Y_hat = self.model.batch_loss_augmented_inference(
                 X, Y, self.w, relaxed=True)
-        self.inference_calls += len(Y)
+        else:
+            Y_hat = self.model.batch_loss_augmented_inference(
+                [X[i] for i in indices], [Y[i] for i in indices], self.w,
+                relaxed=True)
+        self.inference_calls += len(indices)
         self.inference_time += time() - start_time
-        # compute the mean over joint_features and losses
+        return Y_hat
+
+    def _lazy_constraint(self, X, Y, joint_feature_gt):
+        # inference on the stale samples only, the others keep their
+        # labeling, joint feature and loss
+        if not hasattr(self.model, 'score_bound'):
+            raise ValueError("lazy_tol needs a model with score_bound.")
+        if self._lazy is None:
+            self._lazy = LazyInference(len(X), self.model.size_joint_feature)
+        stale = self._lazy.stale(
+            self.w, self.lazy_tol,
+            lambda i, dw: self.model.score_bound(X[i], dw))
+        Y_hat = self._loss_augmented_inference(X, Y, stale)
+
+        rescale_C = getattr(self.model, 'rescale_C', False)
+        joint_features = np.zeros((len(stale), self.model.size_joint_feature))
+        for k, (i, y_hat) in enumerate(zip(stale, Y_hat)):
+            if rescale_C:
+                joint_features[k] = self.model.joint_feature(X[i], y_hat, Y[i])
+            else:
+                joint_features[k] = self.model.joint_feature(X[i], y_hat)
+        losses = self.model.batch_loss([Y[i] for i in stale], Y_hat)
+        self._lazy.update(stale, self.w, Y_hat, joint_features, losses)
+
+        djoint_feature = ((joint_feature_gt
+                           - np.sum(self._lazy.joint_features, axis=0))
+                          / len(X))
+        loss_mean = np.mean(self._lazy.losses)
+        return (list(self._lazy.Y_hat), djoint_feature, loss_mean,
+                len(X) - len(stale))
 
-        if getattr(self.model, 'rescale_C', False):
-            djoint_feature = (joint_feature_gt - self.model.batch_joint_feature(X, Y_hat, Y)) / len(X)
+    def _find_new_constraint(self, X, Y, joint_feature_gt, constraints, check=True):
+        skipped = 0
+        if self.lazy_tol is not None:
+            Y_hat, djoint_feature, loss_mean, skipped = \
+                self._lazy_constraint(X, Y, joint_feature_gt)
         else:
-            djoint_feature = (joint_feature_gt - self.model.batch_joint_feature(X, Y_hat)) / len(X)
+            Y_hat = self._loss_augmented_inference(X, Y)
+            # compute the mean over joint_features and losses
+            if getattr(self.model, 'rescale_C', False):
+                djoint_feature = (joint_feature_gt - self.model.batch_joint_feature(X, Y_hat, Y)) / len(X)
+            else:
+                djoint_feature = (joint_feature_gt - self.model.batch_joint_feature(X, Y_hat)) / len(X)
 
-        loss_mean = np.mean(self.model.batch_loss(Y, Y_hat))
+            loss_mean = np.mean(self.model.batch_loss(Y, Y_hat))
 
         violation = loss_mean - np.dot(self.w, djoint_feature)
+        if not skipped:
+            # slack at w, for the final primal objective
+            self._inference_slack = (self.w.copy(), violation)
         if check and self._check_bad_constraint(
                 violation, djoint_feature, loss_mean, constraints,
                 break_on_bad=self.break_on_bad):
+            if skipped:
+                # reused labelings may hide a violated constraint, decide
+                # with inference on all samples
+                if self.verbose > 1:
+                    print("No constraint with %d skipped samples, running "
+                          "full inference." % skipped)
+                self._lazy.invalidate()
+                return self._find_new_constraint(X, Y, joint_feature_gt,
+                                                 constraints, check)
+            self.skipped_inference_calls_.append(skipped)
             raise NoConstraint
+        self.skipped_inference_calls_.append(skipped)
         return Y_hat, djoint_feature, loss_mean
 
+    def _rescore_constraints(self, constraints, joint_feature_gt, n_samples):
+        # a cutting plane is (joint_feature_gt - sum of the joint features of
+        # its labelings) / n_samples with their losses; for the new ground
+        # truth only the first term changes, the ground truth constraint
+        # stays zero
+        if getattr(self, '_ground_truth', (None,))[0] != n_samples:
+            raise ValueError("warm_start='rescore' needs a previous fit on "
+                             "the same samples")
+        offset = (joint_feature_gt - self._ground_truth[1]) / n_samples
+        if not np.any(offset):
+            return
+        constraints.shift(offset)
+        if getattr(self, '_simplex_qp', None) is not None:
+            self._simplex_qp.changed()
+        if self.verbose > 0:
+            print("moved %d constraints to the new ground truth, "
+                  "|offset|: %f" % (len(constraints) - 1,
+                                    np.linalg.norm(offset)))
+
+    def _final_objective(self, X, Y):
+        # primal objective at the final w, from the slack of the last
+        # inference pass if it ran at this w
+        if not self.exact_objective and self._inference_slack is not None:
+            w, slack = self._inference_slack
+            if np.array_equal(w, self.w):
+                # with approximate inference the slack can fall below the
+                # one of the working set, which also bounds it from below
+                slack = max(slack, self.last_slack_, 0)
+                return self.C * len(X) * slack + np.sum(self.w ** 2) / 2
+        return self._objective(X, Y)
+
     def fit(self, X, Y, constraints=None, warm_start=False,
             initialize=True, save_history=False, train_scorer=None, test_scorer=None):
         """Learn parameters using cutting plane method.
@@ -392,8 +1301,13 @@ class OneSlackSSVM(BaseSSVM):
 
         contraints : ignored
 
-        warm_start : bool, default=False
-            Whether we are warmstarting from a previous fit.
+        warm_start : bool or string, default=False
+            Whether we are warmstarting from a previous fit. 'soft' keeps
+            only w and the inference cache. 'rescore' also moves the
+            cutting planes of the previous fit on the same samples to the
+            ground truth Y and resumes the QP from its solution; this
+            assumes that the losses of the planes do not change with Y, as
+            for labels that are only completed in their latent part.
 
         initialize : boolean, default=True
             Whether to initialize the model for the data.
@@ -413,22 +1327,28 @@ class OneSlackSSVM(BaseSSVM):
 
         if not warm_start:
             self.w = np.zeros(self.model.size_joint_feature)
-            constraints = []
+            constraints = ConstraintStore(self.model.size_joint_feature,
+                                          dtype=self.constraint_dtype,
+                                          sparse=self.sparse_constraints)
             self.objective_curve_, self.primal_objective_curve_ = [], []
             self.cached_constraint_ = []
             self.alphas = []  # dual solutions
             # append constraint given by ground truth to make our life easier
             constraints.append((np.zeros(self.model.size_joint_feature), 0))
             self.alphas.append([self.C])
+            self._simplex_qp = None
             self.inference_cache_ = None
             self.timestamps_ = [time()]
         elif warm_start == "soft":
             self.w = np.zeros(self.model.size_joint_feature)
-            constraints = []
+            constraints = ConstraintStore(self.model.size_joint_feature,
+                                          dtype=self.constraint_dtype,
+                                          sparse=self.sparse_constraints)
             self.alphas = []  # dual solutions
             # append constraint given by ground truth to make our life easier
             constraints.append((np.zeros(self.model.size_joint_feature), 0))
             self.alphas.append([self.C])
+            self._simplex_qp = None
 
         else:
             constraints = self.constraints_
@@ -442,17 +1362,34 @@ class OneSlackSSVM(BaseSSVM):
         self.iterations_done = 0
         self.inference_calls = 0
         self.staged_inference_calls = []
+        self.skipped_inference_calls_ = []
+        self._lazy = None
+        self._inference_slack = None
+        self.planes_per_sweep_ = []
+        # cache planes still to take after the last sweep
+        self._planes_left = 0
 
         self.qp_time = 0
         self.inference_time = 0
 
         self.last_slack_ = -1
 
+        if hasattr(self.model, 'stack'):
+            # the training data is stacked once for all batch_joint_feature
+            # calls of this fit, clear_stack drops it at the end
+            self.model.stack(X)
+
         # get the joint_feature of the ground truth
         if getattr(self.model, 'rescale_C', False):
             joint_feature_gt = self.model.batch_joint_feature(X, Y, Y)
         else:
             joint_feature_gt = self.model.batch_joint_feature(X, Y)
+        if warm_start == 'rescore':
+            self._rescore_constraints(constraints, joint_feature_gt, len(X))
+        self._ground_truth = (len(X), joint_feature_gt)
+
+        if self.n_jobs != 1:
+            self._start_pool(X, Y)
 
         try:
             # catch ctrl+c to stop training
@@ -471,12 +1408,19 @@ class OneSlackSSVM(BaseSSVM):
                     Y_hat, djoint_feature, loss_mean = self._constraint_from_cache(
                         X, Y, joint_feature_gt, constraints)
                     cached_constraint = True
+                    self._planes_left = max(self._planes_left - 1, 0)
+                    if self.planes_per_sweep_:
+                        self.planes_per_sweep_[-1] += 1
                 except NoConstraint:
+                    self._planes_left = 0
                     try:
                         Y_hat, djoint_feature, loss_mean = self._find_new_constraint(
                             X, Y, joint_feature_gt, constraints)
                         self._update_cache(X, Y, Y_hat)
+                        self.planes_per_sweep_.append(1)
+                        self._planes_left = self.n_planes - 1
                     except NoConstraint:
+                        self.planes_per_sweep_.append(0)
                         if self.verbose:
                             print("no additional constraints")
                         if (self.switch_to is not None
@@ -488,6 +1432,8 @@ class OneSlackSSVM(BaseSSVM):
                             self.model.inference_method_ = \
                                 self.model.inference_method
                             self.model.inference_method = self.switch_to
+                            # labelings of the previous method
+                            self._lazy = None
                             continue
                         else:
                             break
@@ -512,8 +1458,8 @@ class OneSlackSSVM(BaseSSVM):
                 if self.cache_tol == "auto" and not cached_constraint:
                     self.cache_tol_ = (primal_objective - objective) / 4
 
-                self.last_slack_ = np.max([(-np.dot(self.w, djoint_feature) + loss_mean)
-                                           for djoint_feature, loss_mean in constraints])
+                self.last_slack_ = np.max(constraints.losses
+                                          - constraints.dot(self.w))
                 self.last_slack_ = max(self.last_slack_, 0)
 
                 if self.verbose > 0:
@@ -532,7 +1478,7 @@ class OneSlackSSVM(BaseSSVM):
                     print(self.w)
 
                 if save_history:
-                    self.w_history.append(self.w)
+                    self.w_history.append(self.w.astype(self.constraint_dtype))
 
                 if train_scorer is not None:
                     self.train_scores.append(train_scorer(self.w))
@@ -542,11 +1488,19 @@ class OneSlackSSVM(BaseSSVM):
                     print self.test_scores[-1]
         except KeyboardInterrupt:
             pass
+        finally:
+            self._stop_pool()
+            if hasattr(self.model, 'clear_stack'):
+                self.model.clear_stack()
         if self.verbose and self.n_jobs == 1:
             print("calls to inference: %d" % self.model.inference_calls)
+        if self.verbose:
+            print("%d inference sweeps, %d cutting planes"
+                  % (len(self.planes_per_sweep_),
+                     np.sum(self.planes_per_sweep_)))
         # compute final objective:
         self.timestamps_.append(time() - self.timestamps_[0])
-        primal_objective = self._objective(X, Y)
+        primal_objective = self._final_objective(X, Y)
         self.primal_objective_curve_.append(primal_objective)
         self.objective_curve_.append(objective)
         self.cached_constraint_.append(False)
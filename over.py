@@ -4,33 +4,9 @@ import sys
 import numpy as np
 
 from sklearn.utils.extmath import safe_sparse_dot
-from chain_opt import optimize_chain_fast
-from graph_utils import decompose_graph, decompose_grid_graph
-
-
-def optimize_chain(chain, unary_cost, pairwise_cost, edge_index):
-    n_nodes = chain.shape[0]
-    n_states = unary_cost.shape[1]
-
-    p = np.zeros((n_states, n_nodes))
-    track = np.zeros((n_states, n_nodes), dtype=np.int32)
-    p[:,0] = unary_cost[0,:]
-    track[:,0] = -1
-
-    for i in xrange(1, n_nodes):
-        p[:,i] = unary_cost[i,:]
-        p_cost = pairwise_cost[edge_index[(chain[i - 1], chain[i])]]
-        for k in xrange(n_states):
-            p[k,i] += np.min(p[:,i - 1] + p_cost[:,k])
-            track[k,i] = np.argmin(p[:,i - 1] + p_cost[:,k])
-
-    x = np.zeros(n_nodes, dtype=np.int32)
-    current = np.argmin(p[:,n_nodes - 1])
-    for i in xrange(n_nodes - 1, -1, -1):
-        x[i] = current
-        current = track[current,i]
-
-    return x, np.min(p[:,n_nodes - 1])
+from potentials import PottsPotentials
+from graph_utils import get_decomposition
+from trw_utils import optimize_chains_fast, consensus
 
 
 class Over(object):
@@ -61,10 +37,7 @@ class Over(object):
         pairwise = np.asarray(w[self.n_states * self.n_features:])
         pairwise = pairwise.reshape(self.n_edge_features, -1)
         pairwise = np.dot(edge_features, pairwise)
-        res = np.zeros((edge_features.shape[0], self.n_states, self.n_states))
-        for i in range(edge_features.shape[0]):
-            res[i, :, :] = np.diag(pairwise[i, :])
-        return res
+        return PottsPotentials(pairwise)
     
     def _get_unary_potentials(self, x, w):
         features = self._get_features(x)
@@ -78,20 +51,15 @@ class Over(object):
             unaries[mask, label] -= weights[mask]
         return unaries
 
-    def _joint_features(self, chain, x, y, edge_index, multiplier):
+    def _joint_features(self, chain, x, y, edge_ids, multiplier):
+        # edge_ids[i] is the edge between chain[i] and chain[i + 1]
         features = self._get_features(x)[chain,:]
         n_nodes = features.shape[0]
 
         features *= multiplier[chain,:]
 
-        e_ind = []
-        edges = []
-        for i in xrange(chain.shape[0] - 1):
-            edges.append((i, i + 1))
-            e_ind.append(edge_index[(chain[i], chain[i + 1])])
-
-        edges = np.array(edges)
-        edge_features = self._get_edge_features(x)[e_ind,:]
+        edges = np.c_[np.arange(n_nodes - 1), np.arange(1, n_nodes)]
+        edge_features = self._get_edge_features(x)[edge_ids,:]
 
         unary_marginals = np.zeros((n_nodes, self.n_states), dtype=np.float64)
         unary_marginals[np.ogrid[:n_nodes], y] = 1
@@ -127,31 +95,21 @@ class Over(object):
     def fit(self, X, Y, train_scorer, test_scorer, decompose='general'):
         self.logger.info('Initialization')
 
-        if decompose == 'general':
-            contains_node, chains, edge_index = decompose_graph(X)
-        elif decompose == 'grid':
-            contains_node, chains, edge_index = decompose_grid_graph(X)
-        else:
+        if decompose not in ['general', 'grid']:
             raise ValueError
 
+        decompositions = [get_decomposition(x[0].shape[0], self._get_edges(x),
+                                            kind=decompose)
+                          for x in X]
+
+        # labels and lambdas of all chains of an object are stored in the
+        # flat layout of decomposition.nodes
         y_hat = []
         lambdas = []
-        multiplier = []
-        for k in xrange(len(X)):
-            n_nodes = X[k][0].shape[0]
-            _lambdas = []
-            _y_hat = []
-            _multiplier = []
-            for p in xrange(n_nodes):
-                _multiplier.append(1.0 / len(contains_node[k][p]))
-            for chain in chains[k]:
-                _lambdas.append(np.zeros((len(chain), self.n_states)))
-                _y_hat.append(np.zeros(len(chain)))
-            lambdas.append(_lambdas)
-            y_hat.append(_y_hat)
-            _multiplier = np.array(_multiplier)
-            _multiplier.shape = (n_nodes, 1)
-            multiplier.append(_multiplier)
+        for decomposition in decompositions:
+            n_positions = decomposition.nodes.shape[0]
+            y_hat.append(np.zeros(n_positions, dtype=np.int32))
+            lambdas.append(np.zeros((n_positions, self.n_states)))
 
         w = np.zeros(self.size_w)
         self.w = w.copy()
@@ -178,21 +136,24 @@ class Over(object):
                 n_nodes = x[0].shape[0]
 
                 unaries = self._loss_augment_unaries(self._get_unary_potentials(x, w), y.full, y.weights)
-                unaries *= multiplier[k]
+                decomposition = decompositions[k]
+                multiplier = decomposition.multiplier
+                unaries *= multiplier
 
                 pairwise = self._get_pairwise_potentials(x, w)
 
                 objective += np.dot(w, self._joint_features_full(x, y.full))
                 dw -= self._joint_features_full(x, y.full)
 
-                for i in xrange(len(chains[k])):
-                    y_hat[k][i], energy = optimize_chain(chains[k][i],
-                                                         lambdas[k][i] + unaries[chains[k][i],:],
-                                                         pairwise,
-                                                         edge_index[k])
+                for ids, nodes, edge_ids, positions in decomposition.groups:
+                    chain_unaries = lambdas[k][positions] + unaries[nodes]
+                    labels, energy = optimize_chains_fast(chain_unaries, pairwise, edge_ids,
+                                                          minimize=True)
+                    y_hat[k][positions] = labels
+                    objective -= np.sum(energy)
 
-                    dw += self._joint_features(chains[k][i], x, y_hat[k][i], edge_index[k], multiplier[k])
-                    objective -= energy
+                    for j in xrange(ids.shape[0]):
+                        dw += self._joint_features(nodes[j], x, labels[j], edge_ids[j], multiplier)
 
             dw -= w / self.C
 
@@ -209,19 +170,15 @@ class Over(object):
             self.logger.info('Update lambda')
 
             for k in xrange(len(X)):
-                n_nodes = X[k][0].shape[0]
-                lambda_sum = np.zeros((n_nodes, self.n_states), dtype=np.float64)
-
-                for p in xrange(n_nodes):
-                    for i in contains_node[k][p]:
-                        pos = np.where(chains[k][i] == p)[0][0]
-                        lambda_sum[p, y_hat[k][i][pos]] += multiplier[k][p]
-
-                for i in xrange(len(chains[k])):
-                    N = lambdas[k][i].shape[0]
-
-                    lambdas[k][i][np.ogrid[:N], y_hat[k][i]] += learning_rate
-                    lambdas[k][i] -= learning_rate * lambda_sum[chains[k][i],:]
+                decomposition = decompositions[k]
+                nodes = decomposition.nodes
+                lambda_sum = consensus(nodes, y_hat[k],
+                                       decomposition.position_multiplier,
+                                       decomposition.n_nodes, self.n_states)
+
+                N = nodes.shape[0]
+                lambdas[k][np.arange(N), y_hat[k]] += learning_rate
+                lambdas[k] -= learning_rate * lambda_sum[nodes]
 
             self.logger.info('diff: %f', np.sum((w-self.w)**2))
             if iteration:
@@ -5,7 +5,8 @@ import numpy as np
 
 from scipy.optimize import fmin_l_bfgs_b
 from sklearn.utils.extmath import safe_sparse_dot
-from graph_utils import decompose_graph, decompose_grid_graph
+from potentials import PottsPotentials
+from graph_utils import get_decomposition
 from trw_utils import *
 from heterogenous_crf import inference_gco
 
@@ -38,10 +39,7 @@ class OverLbfgs(object):
         pairwise = np.asarray(w[self.n_states * self.n_features:])
         pairwise = pairwise.reshape(self.n_edge_features, -1)
         pairwise = np.dot(edge_features, pairwise)
-        res = np.zeros((edge_features.shape[0], self.n_states, self.n_states))
-        for i in range(edge_features.shape[0]):
-            res[i, :, :] = np.diag(pairwise[i, :])
-        return res
+        return PottsPotentials(pairwise)
     
     def _get_unary_potentials(self, x, w):
         features = self._get_features(x)
@@ -55,20 +53,15 @@ class OverLbfgs(object):
             unaries[mask, label] += weights[mask]
         return unaries
 
-    def _joint_features(self, chain, x, y, edge_index, multiplier):
+    def _joint_features(self, chain, x, y, edge_ids, multiplier):
+        # edge_ids[i] is the edge between chain[i] and chain[i + 1]
         features = self._get_features(x)[chain,:]
         n_nodes = features.shape[0]
 
         features *= multiplier[chain,:]
 
-        e_ind = []
-        edges = []
-        for i in xrange(chain.shape[0] - 1):
-            edges.append((i, i + 1))
-            e_ind.append(edge_index[(chain[i], chain[i + 1])])
-
-        edges = np.array(edges)
-        edge_features = self._get_edge_features(x)[e_ind,:]
+        edges = np.c_[np.arange(n_nodes - 1), np.arange(1, n_nodes)]
+        edge_features = self._get_edge_features(x)[edge_ids,:]
 
         unary_marginals = np.zeros((n_nodes, self.n_states), dtype=np.float64)
         unary_marginals[np.ogrid[:n_nodes], y] = 1
@@ -116,29 +109,17 @@ class OverLbfgs(object):
     def fit(self, X, Y, train_scorer, test_scorer, decompose='grid', w0=None):
         print('over unconstr begin')
 
-        if decompose == 'general':
-            contains_node, chains, edge_index = decompose_graph(X)
-        elif decompose == 'grid':
-            contains_node, chains, edge_index, sign = decompose_grid_graph(X, get_sign=True)
-        else:
+        # the signs of the chains are only defined for grids
+        if decompose != 'grid':
             raise ValueError
 
-        y_hat = []
-        lambdas = []
-        multiplier = []
-        for k in xrange(len(X)):
-            n_nodes = X[k][0].shape[0]
-            _y_hat = []
-            _multiplier = []
-            for p in xrange(n_nodes):
-                _multiplier.append(1.0 / len(contains_node[k][p]))
-            for chain in chains[k]:
-                _y_hat.append(np.zeros(len(chain)))
-            lambdas.append(np.zeros((n_nodes, self.n_states)))
-            y_hat.append(_y_hat)
-            _multiplier = np.array(_multiplier)
-            _multiplier.shape = (n_nodes, 1)
-            multiplier.append(_multiplier)
+        decompositions = [get_decomposition(x[0].shape[0], self._get_edges(x),
+                                            kind=decompose)
+                          for x in X]
+
+        # labels in the flat layout of decomposition.nodes, used by f
+        y_hat = [np.zeros(decomposition.nodes.shape[0], dtype=np.int32)
+                 for decomposition in decompositions]
 
         w = np.zeros(self.size_w)
         self.w = w.copy()
@@ -158,7 +139,7 @@ class OverLbfgs(object):
         self.train_scorer = train_scorer
         self.test_scorer = test_scorer
 
-        #x0 = np.zeros(self.size_w + 4000 * len(X))
+        #x0 = np.zeros(self.size_w + sum(x[0].shape[0] for x in X) * self.n_states)
         x0 = np.zeros(self.size_w)
         if w0 is not None:
             x0 = w0
@@ -224,7 +205,7 @@ def f2(xx, model, X, Y, history):
     return objective, dw
 
 
-def f(xx, model, X, Y, multiplier, chains, sign, edge_index, y_hat, contains_node, history):
+def f(xx, model, X, Y, decompositions, y_hat, history):
     w = xx[:model.size_w].copy()
     sz = xx.shape
 
@@ -232,29 +213,33 @@ def f(xx, model, X, Y, multiplier, chains, sign, edge_index, y_hat, contains_nod
     dw = np.zeros(w.shape)
     objective = 0
 
+    offsets = np.cumsum([model.size_w] + [x[0].shape[0] * model.n_states for x in X])
     for k in xrange(len(X)):
-        lambdas.append(xx[(model.size_w + k * 4000):(model.size_w + (k + 1) * 4000)].reshape((400,10)))
+        lambdas.append(xx[offsets[k]:offsets[k + 1]].reshape((-1, model.n_states)))
 
     for k in xrange(len(X)):
         x, y = X[k], Y[k]
         n_nodes = x[0].shape[0]
 
         unaries = model._loss_augment_unaries(model._get_unary_potentials(x, w), y.full, y.weights)
-        unaries *= multiplier[k]
+        decomposition = decompositions[k]
+        multiplier = decomposition.multiplier
+        sign = decomposition.sign
+        unaries *= multiplier
 
         pairwise = model._get_pairwise_potentials(x, w)
 
         dw -= model._joint_features_full(x, y.full)
         objective -= np.dot(w, model._joint_features_full(x, y.full))
 
-        for i in xrange(len(chains[k])):
-            y_hat[k][i], energy = optimize_chain(chains[k][i],
-                                                 sign[k][i] * lambdas[k][chains[k][i],:] + unaries[chains[k][i],:],
-                                                 pairwise,
-                                                 edge_index[k])
+        for ids, nodes, edge_ids, positions in decomposition.groups:
+            chain_unaries = sign[ids, np.newaxis, np.newaxis] * lambdas[k][nodes] + unaries[nodes]
+            labels, energy = optimize_chains_fast(chain_unaries, pairwise, edge_ids)
+            y_hat[k][positions] = labels
+            objective += np.sum(energy)
 
-            dw += model._joint_features(chains[k][i], x, y_hat[k][i], edge_index[k], multiplier[k])
-            objective += energy
+            for j in xrange(ids.shape[0]):
+                dw += model._joint_features(nodes[j], x, labels[j], edge_ids[j], multiplier)
 
     dw += w / model.C
     objective = model.C * objective + np.sum(w ** 2) / 2
@@ -263,15 +248,12 @@ def f(xx, model, X, Y, multiplier, chains, sign, edge_index, y_hat, contains_nod
     grad[:model.size_w] = dw
 
     for k in xrange(len(X)):
-        n_nodes = X[k][0].shape[0]
-
-        dlambda = np.zeros((n_nodes, model.n_states))
-        for p in xrange(n_nodes):
-            for i in contains_node[k][p]:
-                pos = np.where(chains[k][i] == p)[0][0]
-                dlambda[p,y_hat[k][i][pos]] += sign[k][i]
+        decomposition = decompositions[k]
+        dlambda = consensus(decomposition.nodes, y_hat[k],
+                            decomposition.sign[decomposition.position_chain],
+                            decomposition.n_nodes, model.n_states)
 
-        grad[(model.size_w + k * 4000):(model.size_w + (k + 1) * 4000)] = dlambda.reshape(4000)
+        grad[offsets[k]:offsets[k + 1]] = dlambda.ravel()
 
     history['iteration'] += 1
     history['objective'].append(objective)
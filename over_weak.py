@@ -4,12 +4,12 @@ import sys
 
 import numpy as np
 
-from joblib import Parallel, delayed
 from sklearn.utils.extmath import safe_sparse_dot
-from chain_opt import optimize_chain_fast
-from common import latent
-from trw_utils import optimize_chain, optimize_kappa
-from graph_utils import decompose_graph, decompose_grid_graph
+from potentials import PottsPotentials
+from common import LatentCompletion
+from label import LabelBatch
+from trw_utils import optimize_chains_fast, optimize_kappa, consensus
+from graph_utils import get_decomposition
 from heterogenous_crf import inference_gco
 
 from pyqpbo import binary_general_graph
@@ -72,10 +72,7 @@ class OverWeak(object):
         pairwise = np.asarray(w[self.n_states * self.n_features:])
         pairwise = pairwise.reshape(self.n_edge_features, -1)
         pairwise = np.dot(edge_features, pairwise)
-        res = np.zeros((edge_features.shape[0], self.n_states, self.n_states))
-        for i in range(edge_features.shape[0]):
-            res[i, :, :] = np.diag(pairwise[i, :])
-        return res
+        return PottsPotentials(pairwise)
     
     def _get_unary_potentials(self, x, w):
         features = self._get_features(x)
@@ -89,20 +86,15 @@ class OverWeak(object):
             unaries[mask, label] += weights[mask]
         return unaries
 
-    def _joint_features(self, chain, x, y, edge_index, multiplier):
+    def _joint_features(self, chain, x, y, edge_ids, multiplier):
+        # edge_ids[i] is the edge between chain[i] and chain[i + 1]
         features = self._get_features(x)[chain,:]
         n_nodes = features.shape[0]
 
         features *= multiplier[chain,:]
 
-        e_ind = []
-        edges = []
-        for i in xrange(chain.shape[0] - 1):
-            edges.append((i, i + 1))
-            e_ind.append(edge_index[(chain[i], chain[i + 1])])
-
-        edges = np.array(edges)
-        edge_features = self._get_edge_features(x)[e_ind,:]
+        edges = np.c_[np.arange(n_nodes - 1), np.arange(1, n_nodes)]
+        edge_features = self._get_edge_features(x)[edge_ids,:]
 
         unary_marginals = np.zeros((n_nodes, self.n_states), dtype=np.float64)
         unary_marginals[np.ogrid[:n_nodes], y] = 1
@@ -158,35 +150,26 @@ class OverWeak(object):
             use_latent_first_iter=500, undergenerating_weak=True, smd=False):
         self.logger.info('Initialization')
 
-        if decompose == 'general':
-            contains_node, chains, edge_index = decompose_graph(X)
-        elif decompose == 'grid':
-            contains_node, chains, edge_index = decompose_grid_graph(X)
-        else:
+        if decompose not in ['general', 'grid']:
             raise ValueError
-    
+
+        decompositions = [get_decomposition(x[0].shape[0], self._get_edges(x),
+                                            kind=decompose)
+                          for x in X]
+
+        # labels and lambdas of all chains of an object are stored in the
+        # flat layout of decomposition.nodes
         y_hat = []
         lambdas = []
-        multiplier = []
         xx = []
         mu = {}
         for k in xrange(len(X)):
             x, y = X[k], Y[k]
             n_nodes = x[0].shape[0]
+            n_positions = decompositions[k].nodes.shape[0]
             xx.append(np.zeros(n_nodes))
-            _lambdas = []
-            _y_hat = []
-            _multiplier = []
-            for p in xrange(n_nodes):
-                _multiplier.append(1.0 / len(contains_node[k][p]))
-            for chain in chains[k]:
-                _lambdas.append(np.zeros((len(chain), self.n_states)))
-                _y_hat.append(np.zeros(len(chain), dtype=np.int32))
-            lambdas.append(_lambdas)
-            y_hat.append(_y_hat)
-            _multiplier = np.array(_multiplier)
-            _multiplier.shape = (n_nodes, 1)
-            multiplier.append(_multiplier)
+            lambdas.append(np.zeros((n_positions, self.n_states)))
+            y_hat.append(np.zeros(n_positions, dtype=np.int32))
             if not y.full_labeled:
                 mu[k] = np.zeros((n_nodes, self.n_states))
 
@@ -203,6 +186,9 @@ class OverWeak(object):
         learning_rate1 = 0.1
         learning_rate2 = 0.1
 
+        # only weakly labeled samples are completed
+        completion = LatentCompletion(X, Y, self.n_jobs)
+
         for iteration in xrange(self.max_iter):
             self.logger.info('Iteration %d', iteration)
             self.logger.info('Optimize slave MRF and update w')
@@ -213,28 +199,30 @@ class OverWeak(object):
             for k in xrange(len(X)):
                 x, y = X[k], Y[k]
                 n_nodes = x[0].shape[0]
+                decomposition = decompositions[k]
+                multiplier = decomposition.multiplier
 
 #                self.logger.info('object %d', k)
 
                 if y.full_labeled:
                     unaries = self._loss_augment_unaries(self._get_unary_potentials(x, w),
                                                          y.full, y.weights)
-                    unaries *= multiplier[k]
+                    unaries *= multiplier
                     pairwise = self._get_pairwise_potentials(x, w)
 
                     jf = self._joint_features_full(x, y.full)
                     objective -= np.dot(w, jf)
                     dw -= jf
 
-                    for i in xrange(len(chains[k])):
-                        y_hat[k][i], energy = optimize_chain(chains[k][i],
-                                                             lambdas[k][i] + unaries[chains[k][i],:],
-                                                             pairwise,
-                                                             edge_index[k])
+                    for ids, nodes, edge_ids, positions in decomposition.groups:
+                        chain_unaries = lambdas[k][positions] + unaries[nodes]
+                        labels, energy = optimize_chains_fast(chain_unaries, pairwise, edge_ids)
+                        y_hat[k][positions] = labels
 
-                        dw += self._joint_features(chains[k][i], x, y_hat[k][i], edge_index[k], multiplier[k])
+                        objective += np.sum(energy)
 
-                        objective += energy
+                        for j in xrange(ids.shape[0]):
+                            dw += self._joint_features(nodes[j], x, labels[j], edge_ids[j], multiplier)
                 elif iteration > use_latent_first_iter:
                     if undergenerating_weak:
 # Use gco for full K oracle
@@ -270,7 +258,7 @@ class OverWeak(object):
                     elif not smd:
                         dmu = np.zeros((n_nodes, self.n_states))
 
-                        unaries = (self._get_unary_potentials(x, w) - mu[k]) * multiplier[k]
+                        unaries = (self._get_unary_potentials(x, w) - mu[k]) * multiplier
                         pairwise = self._get_pairwise_potentials(x, w)
 
                         jf = self._joint_features_full(x, y.full)
@@ -282,26 +270,20 @@ class OverWeak(object):
                         Eprev = -100
                         for j in xrange(self.update_mu):
                             E = 0
-                            for i in xrange(len(chains[k])):
-                                y_hat[k][i], energy = optimize_chain(chains[k][i],
-                                                                     lambdas[k][i] + unaries[chains[k][i],:],
-                                                                     pairwise,
-                                                                     edge_index[k])
-                                E += energy
+                            for ids, nodes, edge_ids, positions in decomposition.groups:
+                                chain_unaries = lambdas[k][positions] + unaries[nodes]
+                                labels, energy = optimize_chains_fast(chain_unaries, pairwise, edge_ids)
+                                y_hat[k][positions] = labels
+                                E += np.sum(energy)
 
 
-                            lambda_sum = np.zeros((n_nodes, self.n_states), dtype=np.float64)
+                            lambda_sum = consensus(decomposition.nodes, y_hat[k],
+                                                   decomposition.position_multiplier,
+                                                   n_nodes, self.n_states)
 
-                            for p in xrange(n_nodes):
-                                for i in contains_node[k][p]:
-                                    pos = np.where(chains[k][i] == p)[0][0]
-                                    lambda_sum[p, y_hat[k][i][pos]] += multiplier[k][p]
-
-                            for i in xrange(len(chains[k])):
-                                N = lambdas[k][i].shape[0]
-
-                                lambdas[k][i][np.ogrid[:N], y_hat[k][i]] -= learning_rate2
-                                lambdas[k][i] += learning_rate2 * lambda_sum[chains[k][i],:]
+                            N = decomposition.nodes.shape[0]
+                            lambdas[k][np.arange(N), y_hat[k]] -= learning_rate2
+                            lambdas[k] += learning_rate2 * lambda_sum[decomposition.nodes]
 
                             if np.abs(E - Eprev) < 0.1:
                                 break
@@ -309,17 +291,19 @@ class OverWeak(object):
 #end inner
 
 #last one
-                        for i in xrange(len(chains[k])):
-                            y_hat[k][i], energy = optimize_chain(chains[k][i],
-                                                                 lambdas[k][i] + unaries[chains[k][i],:],
-                                                                 pairwise,
-                                                                 edge_index[k])
+                        for ids, nodes, edge_ids, positions in decomposition.groups:
+                            chain_unaries = lambdas[k][positions] + unaries[nodes]
+                            labels, energy = optimize_chains_fast(chain_unaries, pairwise, edge_ids)
+                            y_hat[k][positions] = labels
 
-                            dw += self._joint_features(chains[k][i], x, y_hat[k][i], edge_index[k], multiplier[k])
+                            objective += np.sum(energy)
 
-                            objective += energy
+                            for j in xrange(ids.shape[0]):
+                                dw += self._joint_features(nodes[j], x, labels[j], edge_ids[j], multiplier)
 
-                            dmu[chains[k][i], y_hat[k][i]] -= multiplier[k][chains[k][i]].flatten()
+                        dmu -= consensus(decomposition.nodes, y_hat[k],
+                                         decomposition.position_multiplier,
+                                         n_nodes, self.n_states)
 #
 
                         y_hat_kappa, energy = optimize_kappa(y, mu[k], self.alpha, n_nodes, self.n_states)
@@ -345,19 +329,17 @@ class OverWeak(object):
                             edges = self._get_edges(x)
 
                             n_edges = edges.shape[0]
+                            diagonal = edge_weights.diagonal
                             y_hat2 = []
                             pairwise = []
                             for j in xrange(self.n_states):
                                 y_hat2.append(np.zeros(self.n_states))
                                 _pairwise = np.zeros((n_edges, 2, 2))
-                                for i in xrange(n_edges):
-                                    _pairwise[i,1,0] = _pairwise[i,0,1] = -0.5 * edge_weights[i,j,j]
+                                _pairwise[:,1,0] = _pairwise[:,0,1] = -0.5 * diagonal[:,j]
                                 pairwise.append(_pairwise)
                     
-                            for i in xrange(n_edges):
-                                e1, e2 = edges[i]
-                                unaries[e1,:] += 0.5 * np.diag(edge_weights[i,:,:])
-                                unaries[e2,:] += 0.5 * np.diag(edge_weights[i,:,:])
+                            np.add.at(unaries, edges[:,0], 0.5 * diagonal)
+                            np.add.at(unaries, edges[:,1], 0.5 * diagonal)
                     
                             xx[k], f_val, d = fmin_l_bfgs_b(f, xx[k],
                                                             args=(unaries, pairwise, edges),
@@ -396,25 +378,20 @@ class OverWeak(object):
                 if smd and not Y[k].full_labeled:
                     continue
 
-                n_nodes = X[k][0].shape[0]
-                lambda_sum = np.zeros((n_nodes, self.n_states), dtype=np.float64)
-
-                for p in xrange(n_nodes):
-                    for i in contains_node[k][p]:
-                        pos = np.where(chains[k][i] == p)[0][0]
-                        lambda_sum[p, y_hat[k][i][pos]] += multiplier[k][p]
-
-                for i in xrange(len(chains[k])):
-                    N = lambdas[k][i].shape[0]
+                decomposition = decompositions[k]
+                lambda_sum = consensus(decomposition.nodes, y_hat[k],
+                                       decomposition.position_multiplier,
+                                       decomposition.n_nodes, self.n_states)
 
-                    lambdas[k][i][np.ogrid[:N], y_hat[k][i]] -= learning_rate2
-                    lambdas[k][i] += learning_rate2 * lambda_sum[chains[k][i],:]
+                N = decomposition.nodes.shape[0]
+                lambdas[k][np.arange(N), y_hat[k]] -= learning_rate2
+                lambdas[k] += learning_rate2 * lambda_sum[decomposition.nodes]
 
             if iteration % self.complete_every == 0 or iteration in [51, 80, 101, 130]:
                 self.logger.info('Complete latent variables')
-                Y_new = Parallel(n_jobs=self.n_jobs, verbose=0, max_nbytes=1e8)(
-                    delayed(latent)(self.model, x, y, w) for x, y in zip(X, Y))
-                changes = np.sum([np.any(y_new.full != y.full) for y_new, y in zip(Y_new, Y)])
+                Y_new = completion(self.model, Y, w)
+                changes = np.sum(LabelBatch.from_labels(Y_new).changed(
+                    LabelBatch.from_labels(Y)))
                 self.logger.info('changes in latent variables: %d', changes)
                 Y = Y_new
 
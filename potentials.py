@@ -0,0 +1,82 @@
+import numpy as np
+
+
+def _dense_diagonal(diagonal):
+    # (..., n_states) -> (..., n_states, n_states) with diagonal on the diagonal
+    n_states = diagonal.shape[-1]
+    dense = np.zeros(diagonal.shape + (n_states,), dtype=diagonal.dtype)
+    states = np.arange(n_states)
+    dense[..., states, states] = diagonal
+    return dense
+
+
+class PottsPotentials(object):
+    """Pairwise potentials of a Potts model.
+
+    Only the (n_edges, n_states) diagonal is stored, the potential of two
+    different states is zero. Indexing by edges returns dense
+    (n_states, n_states) blocks of the selected edges, (edge, state, state)
+    index arrays are answered from the diagonal and np.asarray gives the
+    full dense (n_edges, n_states, n_states) array.
+
+    Parameters
+    ----------
+    diagonal : nd-array, shape=(n_edges, n_states)
+        Potential of both nodes of an edge taking the same state.
+    """
+
+    def __init__(self, diagonal):
+        self.diagonal = np.asarray(diagonal, dtype=np.float64)
+
+    @property
+    def shape(self):
+        n_edges, n_states = self.diagonal.shape
+        return (n_edges, n_states, n_states)
+
+    def __len__(self):
+        return self.diagonal.shape[0]
+
+    def __neg__(self):
+        return PottsPotentials(-self.diagonal)
+
+    def __mul__(self, other):
+        return PottsPotentials(self.diagonal * other)
+
+    __rmul__ = __mul__
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            return _dense_diagonal(self.diagonal[key])
+        if len(key) == 3 and not any(isinstance(k, slice) for k in key):
+            edges, first, second = np.broadcast_arrays(*key)
+            return np.where(first == second, self.diagonal[edges, first], 0)
+        return self.dense()[key]
+
+    def dense(self):
+        return _dense_diagonal(self.diagonal)
+
+    def __array__(self, dtype=None):
+        dense = self.dense()
+        if dtype is not None:
+            dense = dense.astype(dtype)
+        return dense
+
+
+def potts_diagonal(pairwise_potentials):
+    """Returns the (n_edges, n_states) diagonal of pairwise potentials."""
+    if isinstance(pairwise_potentials, PottsPotentials):
+        return pairwise_potentials.diagonal
+    return np.diagonal(pairwise_potentials, axis1=1, axis2=2)
+
+
+def gco_pairwise_cost(edges, pairwise_potentials):
+    """Pairwise costs in the format of pygco.cut_from_graph_gen_potts.
+
+    Returns a dict from (u, v) to the list of Potts costs of the edge,
+    clipped at zero. It is built from whole arrays by zip and dict, without
+    numpy calls per edge.
+    """
+    edges = np.asarray(edges)
+    costs = np.maximum(potts_diagonal(pairwise_potentials), 0)
+    return dict(zip(zip(edges[:, 0].tolist(), edges[:, 1].tolist()),
+                    costs.tolist()))
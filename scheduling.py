@@ -0,0 +1,152 @@
+import heapq
+import multiprocessing
+import numpy as np
+
+from time import time
+from joblib import Parallel, delayed
+
+
+def estimate_cost(x, y=None):
+    """Estimated relative cost of inference on a sample.
+
+    Inference is roughly linear in the size of the graph; latent completion
+    is repeated for every weak label of y.
+    """
+    n_nodes = x[0].shape[0]
+    n_edges = x[1].shape[0]
+    n_weak = 1
+    if y is not None and getattr(y, 'weak', None) is not None:
+        n_weak = max(len(y.weak), 1)
+    return float(n_nodes + n_edges) * n_weak
+
+
+def n_workers(n_jobs):
+    # number of processes joblib uses for n_jobs
+    if n_jobs < 0:
+        return max(multiprocessing.cpu_count() + 1 + n_jobs, 1)
+    return n_jobs
+
+
+class CostScheduler(object):
+    """Splits samples into chunks of similar total cost.
+
+    Costs start as estimates from the graph sizes and are replaced by the
+    measured inference times passed to ``record``; estimates of samples
+    without measurements are rescaled to the measured ones.
+
+    Parameters
+    ----------
+    X : list
+        Samples (features, edges, ...).
+
+    Y : list or None
+        Labels, used for the number of weak labels.
+    """
+
+    def __init__(self, X, Y=None):
+        if Y is None:
+            Y = [None] * len(X)
+        self.estimates = np.array([estimate_cost(x, y)
+                                   for x, y in zip(X, Y)])
+        self.times = np.zeros(len(X))
+        self.measured = np.zeros(len(X), dtype=np.bool)
+
+    def costs(self):
+        costs = self.estimates.copy()
+        if np.any(self.measured):
+            scale = (np.sum(self.times[self.measured])
+                     / max(np.sum(self.estimates[self.measured]), 1e-300))
+            costs *= scale
+            costs[self.measured] = self.times[self.measured]
+        return costs
+
+    def chunks(self, n_chunks, indices=None):
+        """Returns n_chunks index arrays, the most expensive chunk first.
+
+        Samples (all or the given indices) are assigned from the most
+        expensive one on to the chunk with the least total cost.
+        """
+        costs = self.costs()
+        if indices is None:
+            indices = np.arange(costs.shape[0])
+        indices = np.asarray(indices, dtype=np.intp)
+        n_chunks = max(min(n_chunks, indices.shape[0]), 1)
+        heap = [(0., i) for i in xrange(n_chunks)]
+        members = [[] for i in xrange(n_chunks)]
+        for sample in indices[np.argsort(-costs[indices], kind='mergesort')]:
+            total, chunk = heapq.heappop(heap)
+            members[chunk].append(sample)
+            heapq.heappush(heap, (total + costs[sample], chunk))
+        totals = dict((chunk, total) for total, chunk in heap)
+        order = sorted(xrange(n_chunks), key=lambda chunk: -totals[chunk])
+        return [np.array(members[chunk], dtype=np.intp) for chunk in order
+                if members[chunk]]
+
+    def record(self, indices, times):
+        self.times[indices] = times
+        self.measured[indices] = True
+
+
+def _timed_chunk(function, model, X, Y, w):
+    results = []
+    times = []
+    for x, y in zip(X, Y):
+        start = time()
+        results.append(function(model, x, y, w))
+        times.append(time() - start)
+    return results, times
+
+
+def scheduled_map(function, model, X, Y, w, n_jobs=1, scheduler=None,
+                  chunks_per_worker=4):
+    """Returns [function(model, x, y, w) for x, y in zip(X, Y)].
+
+    With joblib, samples are sent in chunks of similar cost, the most
+    expensive first, and the scheduler records the measured times for the
+    next call.
+    """
+    if scheduler is None:
+        scheduler = CostScheduler(X, Y)
+    chunks = scheduler.chunks(chunks_per_worker * n_workers(n_jobs))
+    out = Parallel(n_jobs=n_jobs, verbose=0, max_nbytes=1e8)(
+        delayed(_timed_chunk)(function, model, [X[i] for i in chunk],
+                              [Y[i] for i in chunk], w)
+        for chunk in chunks)
+
+    results = [None] * len(X)
+    for chunk, (chunk_results, times) in zip(chunks, out):
+        scheduler.record(chunk, times)
+        for i, result in zip(chunk, chunk_results):
+            results[i] = result
+    return results
+
+
+def staged_map(function, model, X, Y, W, n_jobs=1, scheduler=None,
+               indices=None, chunks_per_worker=4):
+    """Returns [[function(model, x, y, w) for x, y in zip(X, Y)] for w in W].
+
+    The samples of all stages are sent in a single joblib call, in chunks
+    of similar cost, the most expensive first. If indices is given, stage
+    s only runs on the samples indices[s], the other results are None.
+    """
+    if scheduler is None:
+        scheduler = CostScheduler(X, Y)
+    if indices is None:
+        indices = [np.arange(len(X))] * len(W)
+    costs = scheduler.costs()
+    n_chunks = chunks_per_worker * n_workers(n_jobs)
+    jobs = [(stage, chunk) for stage in xrange(len(W))
+            if len(indices[stage])
+            for chunk in scheduler.chunks(n_chunks, indices[stage])]
+    jobs.sort(key=lambda job: -np.sum(costs[job[1]]))
+    out = Parallel(n_jobs=n_jobs, verbose=0, max_nbytes=1e8)(
+        delayed(_timed_chunk)(function, model, [X[i] for i in chunk],
+                              [Y[i] for i in chunk], W[stage])
+        for stage, chunk in jobs)
+
+    results = [[None] * len(X) for w in W]
+    for (stage, chunk), (chunk_results, times) in zip(jobs, out):
+        scheduler.record(chunk, times)
+        for i, result in zip(chunk, chunk_results):
+            results[stage][i] = result
+    return results
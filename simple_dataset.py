@@ -5,7 +5,7 @@ from time import time
 from pystruct.models.base import StructuredModel
 
 from one_slack_ssvm import OneSlackSSVM
-from latent_structured_svm import LatentSSVM
+from latent_structured_svm import LatentSSVM, weighted_score, mean_loss
 from results import ExperimentResult, experiment
 
 def generate_sample(w, max_iter=1000, temp=0.125, a=2):
@@ -228,17 +228,10 @@ def test_simple_dataset(max_iter=1000, C=0.1, latent_iter=10, min_changes=0,
     print 'Norm of weight vector: |w|=%f' % np.linalg.norm(clf.w)
     print 'Elapsed time: %f s' % time_elapsed
 
-    test_scores = []
-    for score in clf.staged_score(x_test, y_test):
-        test_scores.append(score)
-
-    train_scores = []
-    for score in clf.staged_score(x_train, y_train_full):
-        train_scores.append(score)
-
-    raw_scores = []
-    for score in clf.staged_score2(x_train, y_train):
-        raw_scores.append(score)
+    # inference on the train set once per stage for both scores
+    test_scores = clf.staged_evaluate(x_test, [(weighted_score, y_test)])[:, 0]
+    train_scores, raw_scores = clf.staged_evaluate(
+        x_train, [(weighted_score, y_train_full), (mean_loss, y_train)]).T
 
     exp_data = clf._get_data()
     exp_data['test_scores'] = np.array(test_scores)
@@ -4,6 +4,7 @@ import sys
 import numpy as np
 
 from sklearn.utils.extmath import safe_sparse_dot
+from potentials import PottsPotentials, gco_pairwise_cost
 
 
 def inference_gco(unary_potentials, pairwise_potentials, edges,
@@ -11,22 +12,17 @@ def inference_gco(unary_potentials, pairwise_potentials, edges,
     from pygco import cut_from_graph_gen_potts
 
     shape_org = unary_potentials.shape[:-1]
-    n_states = unary_potentials.shape[-1]
 
-    pairwise_cost = {}
-    count = 0
-    for i in xrange(0, pairwise_potentials.shape[0]):
-        count += np.sum(np.diag(pairwise_potentials[i, :]) < 0)
-        pairwise_cost[(edges[i, 0], edges[i, 1])] = list(np.maximum(
-            np.diag(pairwise_potentials[i, :]), 0))
+    pairwise_cost = gco_pairwise_cost(edges, pairwise_potentials)
 
-    unary_potentials *= -1
+    # negate out of place, the caller's potentials are left untouched
+    unary_cost = -unary_potentials
 
     if 'n_iter' in kwargs:
-        y = cut_from_graph_gen_potts(unary_potentials, pairwise_cost, 
+        y = cut_from_graph_gen_potts(unary_cost, pairwise_cost,
                                      label_cost=label_costs, n_iter=kwargs['n_iter'])
     else:
-        y = cut_from_graph_gen_potts(unary_potentials, pairwise_cost,
+        y = cut_from_graph_gen_potts(unary_cost, pairwise_cost,
                                      label_cost=label_costs)
 
     if 'return_energy' in kwargs and kwargs['return_energy']:
@@ -63,10 +59,7 @@ class Subgrad(object):
         pairwise = np.asarray(w[self.n_states * self.n_features:])
         pairwise = pairwise.reshape(self.n_edge_features, -1)
         pairwise = np.dot(edge_features, pairwise)
-        res = np.zeros((edge_features.shape[0], self.n_states, self.n_states))
-        for i in range(edge_features.shape[0]):
-            res[i, :, :] = np.diag(pairwise[i, :])
-        return res
+        return PottsPotentials(pairwise)
     
     def _get_unary_potentials(self, x, w):
         features = self._get_features(x)
@@ -1,7 +1,7 @@
 import numpy as np
 
 from scipy.optimize import fmin_l_bfgs_b
-from graph_utils import decompose_graph, decompose_grid_graph
+from graph_utils import get_decomposition
 from trw_utils import *
 
 
@@ -12,23 +12,17 @@ def trw(node_weights, edges, edge_weights,
 
     assert strategy in ['best-dual', 'best-primal', 'sqrt', 'linear']
 
-    result = decompose_grid_graph([(node_weights, edges, edge_weights)])
-    contains_node, chains, edge_index = result[0][0], result[1][0], result[2][0]
-
     n_nodes, n_states = node_weights.shape
 
-    y_hat = []
-    lambdas = []
-    multiplier = []
-
-    for p in xrange(n_nodes):
-        multiplier.append(1.0 / len(contains_node[p]))
-    for chain in chains:
-        lambdas.append(np.zeros((len(chain), n_states)))
-        y_hat.append(np.zeros(len(chain)))
+    decomposition = get_decomposition(n_nodes, edges, kind='grid')
+    nodes = decomposition.nodes
+    groups = decomposition.groups
+    multiplier = decomposition.multiplier
+    weights = decomposition.position_multiplier
 
-    multiplier = np.array(multiplier)
-    multiplier.shape = (n_nodes, 1)
+    n_positions = nodes.shape[0]
+    y_hat = np.zeros(n_positions, dtype=np.int32)
+    lambdas = np.zeros((n_positions, n_states))
 
     delta = 1.
     learning_rate = 0.1
@@ -42,30 +36,19 @@ def trw(node_weights, edges, edge_weights,
         dual = 0.0
         unaries = node_weights * multiplier
 
-        for i, chain in enumerate(chains):
-            y_hat[i], e = optimize_chain(chain,
-                                         lambdas[i] + unaries[chain,:],
-                                         edge_weights,
-                                         edge_index)
-
-            dual += e
+        for ids, chain_nodes, edge_ids, positions in groups:
+            y_hat[positions], e = optimize_chains_fast(lambdas[positions] + unaries[chain_nodes],
+                                                       edge_weights, edge_ids)
+            dual += np.sum(e)
 
-        lambda_sum = np.zeros((n_nodes, n_states), dtype=np.float64)
-        for p in xrange(n_nodes):
-            for i in contains_node[p]:
-                pos = np.where(chains[i] == p)[0][0]
-                lambda_sum[p, y_hat[i][pos]] += multiplier[p]
+        lambda_sum = consensus(nodes, y_hat, weights, n_nodes, n_states)
 
-        p_norm = 0.0
-        for i in xrange(len(chains)):
-            N = lambdas[i].shape[0]
+        dlambda = lambda_sum[nodes]
+        dlambda[np.arange(n_positions), y_hat] -= 1
 
-            dlambda = lambda_sum[chains[i],:].copy()
-            dlambda[np.ogrid[:N], y_hat[i]] -= 1
+        p_norm = np.sum(dlambda ** 2)
 
-            p_norm += np.sum(dlambda ** 2)
-
-            lambdas[i] += learning_rate * dlambda
+        lambdas += learning_rate * dlambda
 
         primal = compute_energy(get_labelling(lambda_sum), unaries, edge_weights, edges)
         primal_history.append(primal)
@@ -111,23 +94,19 @@ def trw_unconstr(node_weights, edges, edge_weights,
 
     assert strategy in ['best-dual', 'best-primal', 'sqrt', 'linear']
 
-    result = decompose_grid_graph([(node_weights, edges, edge_weights)], get_sign=True)
-    contains_node, chains, edge_index, sign = result[0][0], result[1][0], result[2][0], result[3][0]
-
     n_nodes, n_states = node_weights.shape
 
-    y_hat = []
-    lambdas = np.zeros((n_nodes, n_states))
-    multiplier = []
-
-    for p in xrange(n_nodes):
-        multiplier.append(1.0 / len(contains_node[p]))
-        assert len(contains_node[p]) == 2
-    for chain in chains:
-        y_hat.append(np.zeros(len(chain)))
+    decomposition = get_decomposition(n_nodes, edges, kind='grid')
+    nodes = decomposition.nodes
+    groups = decomposition.groups
+    multiplier = decomposition.multiplier
+    sign = decomposition.sign
+    assert np.all(multiplier == 0.5)
+    weights = decomposition.position_multiplier
+    sign_weights = sign[decomposition.position_chain].astype(np.float64)
 
-    multiplier = np.array(multiplier)
-    multiplier.shape = (n_nodes, 1)
+    y_hat = np.zeros(nodes.shape[0], dtype=np.int32)
+    lambdas = np.zeros((n_nodes, n_states))
 
     delta = 1.
     learning_rate = 0.1
@@ -141,24 +120,15 @@ def trw_unconstr(node_weights, edges, edge_weights,
         dual = 0.0
         unaries = node_weights * multiplier
 
-        for i, chain in enumerate(chains):
-            y_hat[i], e = optimize_chain(chain,
-                                         sign[i] * lambdas[chain,:] + unaries[chain,:],
-                                         edge_weights,
-                                         edge_index)
-
-            dual += e
-
-        p_norm = 0.0
-        lambda_sum = np.zeros((n_nodes, n_states), dtype=np.float64)
-        for p in xrange(n_nodes):
-            dlambda = np.zeros(n_states)
-            for i in contains_node[p]:
-                pos = np.where(chains[i] == p)[0][0]
-                lambda_sum[p, y_hat[i][pos]] += multiplier[p]
-                dlambda[y_hat[i][pos]] += sign[i]
-            p_norm += np.sum(dlambda ** 2)
-            lambdas[p] -= learning_rate * dlambda
+        for ids, chain_nodes, edge_ids, positions in groups:
+            chain_unaries = sign[ids, np.newaxis, np.newaxis] * lambdas[chain_nodes] + unaries[chain_nodes]
+            y_hat[positions], e = optimize_chains_fast(chain_unaries, edge_weights, edge_ids)
+            dual += np.sum(e)
+
+        lambda_sum = consensus(nodes, y_hat, weights, n_nodes, n_states)
+        dlambda = consensus(nodes, y_hat, sign_weights, n_nodes, n_states)
+        p_norm = np.sum(dlambda ** 2)
+        lambdas -= learning_rate * dlambda
 
         primal = compute_energy(get_labelling(lambda_sum), unaries, edge_weights, edges)
         primal_history.append(primal)
@@ -197,73 +167,55 @@ def trw_unconstr(node_weights, edges, edge_weights,
     return lambda_sum, info
 
 
-def f(x, node_weights, multiplier, chains, edge_weights, edge_index, sign, y_hat, contains_node, history):
+def f(x, node_weights, decomposition, edge_weights, y_hat, history):
     dual = 0
     n_nodes, n_states = node_weights.shape
-    unaries = node_weights * multiplier
-    lambdas = x.reshape((400, 10))
-
-    for i, chain in enumerate(chains):
-        y_hat[i], e = optimize_chain(chain,
-                                     sign[i] * lambdas[chain,:] + unaries[chain,:],
-                                     edge_weights,
-                                     edge_index)
+    sign = decomposition.sign
+    unaries = node_weights * decomposition.multiplier
+    lambdas = x.reshape((n_nodes, n_states))
 
-        dual += e
+    for ids, chain_nodes, edge_ids, positions in decomposition.groups:
+        chain_unaries = sign[ids, np.newaxis, np.newaxis] * lambdas[chain_nodes] + unaries[chain_nodes]
+        y_hat[positions], e = optimize_chains_fast(chain_unaries, edge_weights, edge_ids)
+        dual += np.sum(e)
 
-    dlambda = np.zeros((n_nodes, n_states), dtype=np.float64)
-    for p in xrange(n_nodes):
-        for i in contains_node[p]:
-            pos = np.where(chains[i] == p)[0][0]
-            dlambda[p][y_hat[i][pos]] += sign[i]
+    dlambda = consensus(decomposition.nodes, y_hat,
+                        sign[decomposition.position_chain].astype(np.float64),
+                        n_nodes, n_states)
 
     history.append(dual)
 
-    return dual, dlambda.reshape(4000)
+    return dual, dlambda.ravel()
 
 
 def trw_lbfgs(node_weights, edges, edge_weights,
               max_iter=100, verbose=1, tol=1e-3):
 
-    result = decompose_grid_graph([(node_weights, edges, edge_weights)], get_sign=True)
-    contains_node, chains, edge_index, sign = result[0][0], result[1][0], result[2][0], result[3][0]
-
     n_nodes, n_states = node_weights.shape
 
-    y_hat = []
-    lambdas = np.zeros((n_nodes, n_states))
-    multiplier = []
-
-    for p in xrange(n_nodes):
-        multiplier.append(1.0 / len(contains_node[p]))
-        assert len(contains_node[p]) == 2
-    for chain in chains:
-        y_hat.append(np.zeros(len(chain)))
+    decomposition = get_decomposition(n_nodes, edges, kind='grid')
+    nodes = decomposition.nodes
+    multiplier = decomposition.multiplier
+    sign = decomposition.sign
+    assert np.all(multiplier == 0.5)
 
-    multiplier = np.array(multiplier)
-    multiplier.shape = (n_nodes, 1)
+    y_hat = np.zeros(nodes.shape[0], dtype=np.int32)
 
     history = []
     x, f_val, d = fmin_l_bfgs_b(f, np.zeros((n_nodes, n_states)),
-                                args=(node_weights, multiplier, chains, edge_weights, edge_index, sign, y_hat, contains_node, history),
+                                args=(node_weights, decomposition, edge_weights, y_hat, history),
                                 maxiter=max_iter,
                                 disp=verbose,
                                 pgtol=tol)
 
-    lambdas = x.reshape((400, 10))
+    lambdas = x.reshape((n_nodes, n_states))
     unaries = node_weights * multiplier
-    for i, chain in enumerate(chains):
-        y_hat[i], e = optimize_chain(chain,
-                                     sign[i] * lambdas[chain,:] + unaries[chain,:],
-                                     edge_weights,
-                                     edge_index)
-
+    for ids, chain_nodes, edge_ids, positions in decomposition.groups:
+        chain_unaries = sign[ids, np.newaxis, np.newaxis] * lambdas[chain_nodes] + unaries[chain_nodes]
+        y_hat[positions], e = optimize_chains_fast(chain_unaries, edge_weights, edge_ids)
 
-    lambda_sum = np.zeros((n_nodes, n_states), dtype=np.float64)
-    for p in xrange(n_nodes):
-        for i in contains_node[p]:
-            pos = np.where(chains[i] == p)[0][0]
-            lambda_sum[p, y_hat[i][pos]] += multiplier[p]
+    lambda_sum = consensus(nodes, y_hat, decomposition.position_multiplier,
+                           n_nodes, n_states)
 
     info = {}
     info['x'] = x
@@ -272,5 +224,3 @@ def trw_lbfgs(node_weights, edges, edge_weights,
     info['history'] = history
 
     return lambda_sum, info
-
-
@@ -1,6 +1,6 @@
 import numpy as np
 
-from graph_utils import decompose_graph, decompose_grid_graph
+from graph_utils import get_decomposition
 from trw_utils import *
 
 
@@ -8,23 +8,17 @@ def trw(node_weights, edges, edge_weights, y,
         max_iter=100, verbose=0, tol=1e-3,
         update_mu=50, get_energy=None):
 
-    result = decompose_grid_graph([(node_weights, edges, edge_weights)])
-    contains_node, chains, edge_index = result[0][0], result[1][0], result[2][0]
-
     n_nodes, n_states = node_weights.shape
 
-    y_hat = []
-    lambdas = []
-    multiplier = []
-
-    for p in xrange(n_nodes):
-        multiplier.append(1.0 / len(contains_node[p]))
-    for chain in chains:
-        lambdas.append(np.zeros((len(chain), n_states)))
-        y_hat.append(np.zeros(len(chain)))
+    decomposition = get_decomposition(n_nodes, edges, kind='grid')
+    nodes = decomposition.nodes
+    groups = decomposition.groups
+    multiplier = decomposition.multiplier
+    weights = decomposition.position_multiplier
 
-    multiplier = np.array(multiplier)
-    multiplier.shape = (n_nodes, 1)
+    n_positions = nodes.shape[0]
+    y_hat = np.zeros(n_positions, dtype=np.int32)
+    lambdas = np.zeros((n_positions, n_states))
 
     mu = np.zeros((n_nodes, n_states))
 
@@ -39,27 +33,17 @@ def trw(node_weights, edges, edge_weights, y,
         inner_energy = []
         for inner in xrange(update_mu):
             E = 0
-            for i, chain in enumerate(chains):
-                y_hat[i], energy = optimize_chain(chain,
-                                                  lambdas[i] + unaries[chain,:],
-                                                  edge_weights,
-                                                  edge_index)
-
-                E += energy
+            for ids, chain_nodes, edge_ids, positions in groups:
+                y_hat[positions], energy = optimize_chains_fast(lambdas[positions] + unaries[chain_nodes],
+                                                                edge_weights, edge_ids)
+                E += np.sum(energy)
 
             inner_energy.append(E)
 
-            lambda_sum = np.zeros((n_nodes, n_states), dtype=np.float64)
-            for p in xrange(n_nodes):
-                for i in contains_node[p]:
-                    pos = np.where(chains[i] == p)[0][0]
-                    lambda_sum[p, y_hat[i][pos]] += multiplier[p]
-
-            for i in xrange(len(chains)):
-                N = lambdas[i].shape[0]
+            lambda_sum = consensus(nodes, y_hat, weights, n_nodes, n_states)
 
-                lambdas[i][np.ogrid[:N], y_hat[i]] -= learning_rate
-                lambdas[i] += learning_rate * lambda_sum[chains[i],:]
+            lambdas[np.arange(n_positions), y_hat] -= learning_rate
+            lambdas += learning_rate * lambda_sum[nodes]
 
             if inner > 0 and np.abs(inner_energy[-2] - E) < 1e-2:
                 break
@@ -69,8 +53,7 @@ def trw(node_weights, edges, edge_weights, y,
         y_hat_kappa, energy = optimize_kappa(y, mu, 1, n_nodes, n_states)
         E += energy
 
-        for i in xrange(len(chains)):
-            dmu[chains[i], y_hat[i]] -= multiplier[chains[i]].flatten()
+        dmu -= lambda_sum
         dmu[np.ogrid[:dmu.shape[0]], y_hat_kappa] += 1
 
         mu -= learning_rate * dmu
@@ -1,30 +1,28 @@
 import numpy as np
 
-from graph_utils import decompose_graph, decompose_grid_graph
-from trw_utils import optimize_chain, optimize_kappa
+from graph_utils import get_decomposition
+from trw_utils import optimize_chains_fast, optimize_kappa, consensus
 
 # three dual variables; only projection subgradient; no nested optimization problems
 
 def trw(node_weights, edges, edge_weights, y,
         max_iter=100, verbose=0, tol=1e-3):
 
-    result = decompose_grid_graph([(node_weights, edges, edge_weights)])
-    contains_node, chains, edge_index = result[0][0], result[1][0], result[2][0]
-
     n_nodes, n_states = node_weights.shape
 
-    y_hat = []
-    lambdas = []
-    multiplier = []
-
-    for p in xrange(n_nodes):
-        multiplier.append(1.0 / (len(contains_node[p]) + 1))
-    for chain in chains:
-        lambdas.append(np.zeros((len(chain), n_states)))
-        y_hat.append(np.zeros(len(chain)))
+    decomposition = get_decomposition(n_nodes, edges, kind='grid')
+    nodes = decomposition.nodes
+    groups = decomposition.groups
 
-    multiplier = np.array(multiplier)
+    n_chains_per_node = np.diff(decomposition.node_ptr)
+    assert np.all(n_chains_per_node == 2)
+    multiplier = 1.0 / (n_chains_per_node + 1.0)
     multiplier.shape = (n_nodes, 1)
+    weights = multiplier[nodes, 0]
+
+    n_positions = nodes.shape[0]
+    y_hat = np.zeros(n_positions, dtype=np.int32)
+    lambdas = np.zeros((n_positions, n_states))
 
     mu = np.zeros((n_nodes, n_states))
 
@@ -39,41 +37,26 @@ def trw(node_weights, edges, edge_weights, y,
                 unaries[:,label] += y.weights
         unaries *= multiplier
 
-        for i, chain in enumerate(chains):
-            y_hat[i], energy = optimize_chain(chain,
-                                              lambdas[i] + unaries[chain,:],
-                                              edge_weights,
-                                              edge_index)
-
-            E += energy
+        for ids, chain_nodes, edge_ids, positions in groups:
+            y_hat[positions], energy = optimize_chains_fast(lambdas[positions] + unaries[chain_nodes],
+                                                            edge_weights, edge_ids)
+            E += np.sum(energy)
 
         y_hat_kappa, energy = optimize_kappa(y, mu + unaries, 1, n_nodes, n_states, augment=False)
         E += energy
 
-        lambda_sum = np.zeros((n_nodes, n_states), dtype=np.float64)
-        for p in xrange(n_nodes):
-            assert len(contains_node[p]) == 2
-            for i in contains_node[p]:
-                pos = np.where(chains[i] == p)[0][0]
-                lambda_sum[p, y_hat[i][pos]] += multiplier[p]
+        lambda_sum = consensus(nodes, y_hat, weights, n_nodes, n_states)
 
         lambda_sum[np.ogrid[:n_nodes], y_hat_kappa] += multiplier.flatten()
 
-        for i in xrange(len(chains)):
-            N = lambdas[i].shape[0]
-
-            lambdas[i][np.ogrid[:N], y_hat[i]] -= learning_rate
-            lambdas[i] += learning_rate * lambda_sum[chains[i],:]
+        lambdas[np.arange(n_positions), y_hat] -= learning_rate
+        lambdas += learning_rate * lambda_sum[nodes]
 
         mu[np.ogrid[:n_nodes], y_hat_kappa] -= learning_rate
         mu += learning_rate * lambda_sum
 
-        test_l = np.zeros((n_nodes, n_states))
-        for p in xrange(n_nodes):
-            for i in contains_node[p]:
-                pos = np.where(chains[i] == p)[0][0]
-                test_l[p, :] += lambdas[i][pos,:]
-        test_l += mu
+        test_l = mu.copy()
+        np.add.at(test_l, nodes, lambdas)
 
         assert np.sum(test_l) < 1e-10
 
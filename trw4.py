@@ -1,7 +1,6 @@
 import numpy as np
 
-from graph_utils import decompose_graph, decompose_grid_graph
-from trw_utils import optimize_chain, optimize_kappa
+from trw_utils import optimize_kappa
 from heterogenous_crf import inference_gco
 
 # gco instead of first argument
@@ -10,24 +9,8 @@ def trw(node_weights, edges, edge_weights, y,
         max_iter=100, verbose=0, tol=1e-3,
         relaxed=False):
 
-    result = decompose_grid_graph([(node_weights, edges, edge_weights)])
-    contains_node, chains, edge_index = result[0][0], result[1][0], result[2][0]
-
     n_nodes, n_states = node_weights.shape
 
-    y_hat = []
-    lambdas = []
-    multiplier = []
-
-    for p in xrange(n_nodes):
-        multiplier.append(1.0 / len(contains_node[p]))
-    for chain in chains:
-        lambdas.append(np.zeros((len(chain), n_states)))
-        y_hat.append(np.zeros(len(chain)))
-
-    multiplier = np.array(multiplier)
-    multiplier.shape = (n_nodes, 1)
-
     mu = np.zeros((n_nodes, n_states))
 
     learning_rate = 0.1
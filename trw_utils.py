@@ -1,5 +1,4 @@
 import numpy as np
-import itertools
 
 
 def optimize_chain(chain, unary_cost, pairwise_cost, edge_index):
@@ -27,51 +26,131 @@ def optimize_chain(chain, unary_cost, pairwise_cost, edge_index):
     return x, np.max(p[:,n_nodes - 1])
 
 
+def optimize_chains(unary_cost, pairwise_cost, edge_ids, minimize=False):
+    """Viterbi over a batch of chains of equal length.
+
+    unary_cost has shape (n_chains, chain_len, n_states), edge_ids has shape
+    (n_chains, chain_len - 1) and holds indices into pairwise_cost for the
+    edge between positions i and i + 1 of every chain. Returns the optimal
+    labellings (n_chains, chain_len) and their energies (n_chains,).
+    """
+    n_chains, n_nodes, n_states = unary_cost.shape
+    arg_best = np.argmin if minimize else np.argmax
+
+    rows = np.arange(n_chains)
+    gx = rows[:, np.newaxis]
+    gy = np.arange(n_states)[np.newaxis, :]
+
+    p = unary_cost[:, 0, :].copy()
+    track = np.zeros((n_chains, n_nodes, n_states), dtype=np.int32)
+
+    for i in xrange(1, n_nodes):
+        scores = p[:, :, np.newaxis] + pairwise_cost[edge_ids[:, i - 1]]
+        track[:, i, :] = arg_best(scores, axis=1)
+        p = scores[gx, track[:, i, :], gy] + unary_cost[:, i, :]
+
+    x = np.zeros((n_chains, n_nodes), dtype=np.int32)
+    current = arg_best(p, axis=1)
+    energy = p[rows, current]
+    for i in xrange(n_nodes - 1, -1, -1):
+        x[:, i] = current
+        current = track[rows, i, current]
+
+    return x, energy
+
+
+try:
+    # compiled Viterbi that runs without the GIL, with the same labelings
+    # and energies as optimize_chains (checked in bench_trw_utils.py)
+    from chain_opt import optimize_chains_fast
+except ImportError:
+    optimize_chains_fast = optimize_chains
+
+
+def consensus(nodes, labels, weights, n_nodes, n_states):
+    """Sums weights of the chain labels per node and state.
+
+    nodes, labels and weights are given for every position of the
+    concatenated chains. Returns an (n_nodes, n_states) array.
+    """
+    index = nodes.astype(np.int64) * n_states + labels
+    total = np.bincount(index, weights=weights, minlength=n_nodes * n_states)
+    return total.reshape(n_nodes, n_states)
+
+
+def _kappa_search(unaries, weak, j, best, arg, removed, visit):
+    # depth first search over the weak labels: weak[j] is either removed or
+    # allowed; best and arg are the per-node max and argmax over the allowed
+    # labels, ties go to the smaller label as in np.argmax
+    if j == len(weak):
+        visit(removed, best, arg)
+        return
+
+    _kappa_search(unaries, weak, j + 1, best, arg, removed + (j,), visit)
+
+    column = unaries[:, weak[j]]
+    better = (column > best) | ((column == best) & (weak[j] < arg))
+    _kappa_search(unaries, weak, j + 1, np.where(better, column, best),
+                  np.where(better, weak[j], arg), removed, visit)
+
+
 def optimize_kappa(y, unaries, alpha, n_nodes, n_states, augment=True):
+    """Maximizes sum of unaries minus c for every weak label present.
+
+    Every subset of y.weak is tried, but the per-node max and argmax over
+    the labels that are not removed are built incrementally, so a subset
+    costs O(n_nodes) instead of O(n_nodes * n_states). Among subsets of
+    equal energy the first one in the order of itertools.combinations
+    (fewest removed labels first) wins, so the result is the same as
+    enumerating the subsets and taking the argmax for every one of them.
+    """
     unaries = unaries.copy()
 
     c = np.sum(y.weights) / float(n_states)
     c *= alpha
 
+    weak = [int(label) for label in y.weak]
+    is_weak = np.zeros(n_states, dtype=np.bool)
+    is_weak[weak] = True
+    other = np.flatnonzero(~is_weak)
+
     if augment:
-        for label in xrange(n_states):
-            if label not in y.weak:
-                unaries[:,label] += y.weights * alpha
-
-    max_energy = -np.Inf
-    best_y = None
-    all_labels = set([l for l in xrange(n_states)])
-    gt_labels = set(y.weak)
-
-    for k in xrange(len(y.weak) + 1):
-        for l in itertools.combinations(y.weak, k):
-            labels = list(all_labels - set(l))
-            l = list(l)
-            t_unaries = unaries.copy()
-            t_unaries[:, l] = -np.Inf
-            y_hat = np.argmax(t_unaries, axis=1)
-            energy = np.sum(np.max(unaries[:,labels], axis=1))
-            energy2 = np.sum(t_unaries[np.ogrid[:unaries.shape[0]],y_hat])
-            present_labels = set(np.unique(y_hat))
-            energy -= c * len(present_labels.intersection(gt_labels))
-            if energy > max_energy:
-                max_energy = energy
-                best_y = y_hat
-
-    return best_y, max_energy
+        unaries[:, other] += (y.weights * alpha)[:, np.newaxis]
+
+    # max and argmax over the labels that are never removed
+    if other.shape[0]:
+        arg = other[np.argmax(unaries[:, other], axis=1)]
+        best = unaries[np.arange(unaries.shape[0]), arg]
+    else:
+        arg = np.repeat(n_states, unaries.shape[0])
+        best = np.repeat(-np.inf, unaries.shape[0])
+
+    result = {'energy': -np.Inf, 'key': None, 'y': None}
+
+    def visit(removed, best, arg):
+        if len(removed) == len(weak) and not other.shape[0]:
+            # no label left
+            return
+        present = np.bincount(arg, minlength=n_states + 1)[weak]
+        energy = np.sum(best) - c * np.count_nonzero(present)
+        key = (len(removed), removed)
+        if energy > result['energy'] or \
+                (energy == result['energy'] and key < result['key']):
+            result['energy'] = energy
+            result['key'] = key
+            result['y'] = arg
+
+    _kappa_search(unaries, weak, 0, best, arg, (), visit)
+
+    return result['y'], result['energy']
 
 
 def get_labelling(relaxed_y):
-    n_nodes = relaxed_y.shape[0]
-    y = np.zeros(n_nodes)
-    for i in xrange(n_nodes):
-        y[i] = np.where(relaxed_y[i,:])[0][0]
-    return y.astype(np.int32)
+    # first non-zero state of every node
+    return np.argmax(relaxed_y != 0, axis=1).astype(np.int32)
 
 
 def compute_energy(y, unaries, pairwise, edges):
-    energy = 0.0
-    for i, (u, v) in enumerate(edges):
-        energy += pairwise[i, y[u], y[v]]
+    energy = np.sum(pairwise[np.arange(edges.shape[0]), y[edges[:, 0]], y[edges[:, 1]]])
     energy += np.sum(unaries[np.ogrid[:y.shape[0]],y])
     return energy